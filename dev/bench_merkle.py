@@ -0,0 +1,46 @@
+'''
+Times merkle links for block templates, rebuilt from scratch and kept in a MerkleTree between work requests.
+
+usage: python dev/bench_merkle.py [TX_COUNT]
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+def timeit(f, number=20):
+    start = time.time()
+    for i in xrange(number):
+        f()
+    return (time.time() - start)/number
+
+def main():
+    p2pool.DEBUG = False
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    hashes = [random.randrange(2**256) for i in xrange(count)]
+    tree = bitcoin_data.MerkleTree([None] + hashes)
+    
+    def appended():
+        hashes.append(random.randrange(2**256))
+        tree.update([None] + hashes).get_link(0)
+    
+    def replaced():
+        hashes[random.randrange(len(hashes))] = random.randrange(2**256)
+        tree.update([None] + hashes).get_link(0)
+    
+    for name, f in [
+        ('from scratch', lambda: bitcoin_data.calculate_merkle_link([None] + hashes, 0)),
+        ('unchanged', lambda: tree.update([None] + hashes).get_link(0)),
+        ('one appended', appended),
+        ('one replaced', replaced),
+    ]:
+        print '%i transactions, %s: %.3f ms' % (len(hashes), name, timeit(f)*1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+'''
+Compares get_nth_parent_hash implementations on a long synthetic chain.
+
+usage: python dev/bench_nth_parent.py [SHARE_COUNT]
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool.util import forest
+
+class Item(object):
+    __slots__ = ['hash', 'previous_hash']
+    
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    hashes = [random.randrange(2**256) for i in xrange(count)]
+    tracker = forest.Tracker(Item(h, hashes[i - 1] if i else None) for i, h in enumerate(hashes))
+    
+    # mix of what score, generate_transaction's far_share_hash and get_pool_attempts_per_second ask for
+    queries = []
+    for i in xrange(20000):
+        pos = random.randrange(count//2, count)
+        queries.append((hashes[pos], random.choice([99, 720, count//2, random.randrange(pos + 1)])))
+    
+    for name, func in [('skiplist', forest.DistanceSkipList(tracker)), ('jump table', forest.AncestorTable(tracker))]:
+        for run in ['cold', 'warm']:
+            start = time.time()
+            for item_hash, n in queries:
+                func(item_hash, n)
+            print '%s, %s: %.1f us/query' % (name, run, (time.time() - start)/len(queries)*1e6)
+
+if __name__ == '__main__':
+    main()
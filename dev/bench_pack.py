@@ -0,0 +1,114 @@
+'''
+Times packing and unpacking of share_type, tx_type and block_header_type, with
+the struct-based codecs of ComposedType and ListType and with every field
+handled by its own type.
+
+usage: python dev/bench_pack.py [ITERATIONS] [NET]
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data, networks
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import pack
+
+def iter_types(type_, seen=None):
+    if seen is None:
+        seen = set()
+    if id(type_) in seen:
+        return
+    seen.add(id(type_))
+    yield type_
+    for value in getattr(type_, '__dict__', {}).values() + type(type_).__dict__.values() + [v for k, v in getattr(type_, 'fields', [])]:
+        if isinstance(value, pack.Type):
+            for x in iter_types(value, seen):
+                yield x
+
+def uncompile(type_):
+    # returns a function that undoes the change
+    if isinstance(type_, pack.ComposedType):
+        plan, type_._plan = type_._plan, [(key, type2, None) for key, type2 in type_.fields]
+        return lambda: setattr(type_, '_plan', plan)
+    elif isinstance(type_, pack.ListType):
+        codec, type_._codec = type_._codec, None
+        return lambda: setattr(type_, '_codec', codec)
+    return lambda: None
+
+def get_samples(net):
+    bits = bitcoin_data.FloatingInteger.from_target_upper_bound(2**240)
+    new_transaction_hashes = [random.randrange(2**256) for i in xrange(50)]
+    share = dict(
+        min_header=dict(version=4, previous_block=random.randrange(2**256), timestamp=1500000000, bits=bits, nonce=random.randrange(2**32)),
+        share_info=dict(
+            share_data=dict(previous_share_hash=random.randrange(2**256), coinbase=os.urandom(40), nonce=random.randrange(2**32),
+                pubkey_hash=random.randrange(2**160), pubkey_hash_version=net.PARENT.ADDRESS_VERSION, subsidy=5000000000,
+                donation=50, stale_info=None, desired_version=16),
+            new_transaction_hashes=new_transaction_hashes,
+            transaction_hash_refs=[x for i in xrange(len(new_transaction_hashes)) for x in [0, i]],
+            far_share_hash=random.randrange(2**256),
+            max_bits=bits,
+            bits=bits,
+            timestamp=1500000001,
+            absheight=100000,
+            abswork=2**80,
+        ),
+        ref_merkle_link=dict(branch=[random.randrange(2**256) for i in xrange(3)], index=0),
+        last_txout_nonce=random.randrange(2**64),
+        hash_link=dict(state=os.urandom(32), extra_data='', length=256),
+        merkle_link=dict(branch=[random.randrange(2**256) for i in xrange(8)], index=0),
+    )
+    tx = dict(
+        version=1,
+        tx_ins=[dict(previous_output=dict(hash=random.randrange(2**256), index=random.randrange(4)), script=os.urandom(107), sequence=None) for i in xrange(3)],
+        tx_outs=[dict(value=random.randrange(2**40), script=os.urandom(25)) for i in xrange(2)],
+        lock_time=0,
+    )
+    # tx_type reads the parent chain's layout but writes tx_id_type's, so unpacking is timed on the former
+    packed_tx = pack.IntType(16).pack(tx['version']) + pack.VarIntType().pack(len(tx['tx_ins'])) + pack.IntType(32).pack(tx['lock_time']) + \
+        ''.join(bitcoin_data.tx_in_type.pack(tx_in) for tx_in in tx['tx_ins']) + pack.ListType(bitcoin_data.tx_out_type).pack(tx['tx_outs'])
+    header = dict(version=4, previous_block=random.randrange(2**256), merkle_root=random.randrange(2**256), timestamp=1500000000,
+        bits=bits.bits, nonce=random.randrange(2**32))
+    share_type = data.Share.get_dynamic_types(net)['share_type']
+    return [
+        ('share_type', share_type, share, share_type.pack(share)),
+        ('tx_type', bitcoin_data.tx_type, tx, packed_tx),
+        ('block_header_type', bitcoin_data.block_header_type, header, bitcoin_data.block_header_type.pack(header)),
+    ]
+
+def best_time(func, iterations):
+    res = None
+    for run in xrange(3):
+        start = time.time()
+        for i in xrange(iterations):
+            func()
+        res = min(res, (time.time() - start)/iterations) if res is not None else (time.time() - start)/iterations
+    return res
+
+def time_type(type_, item, packed, iterations):
+    return type_.pack(item), type_._unpack(packed), best_time(lambda: type_.pack(item), iterations), best_time(lambda: type_._unpack(packed), iterations)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    net = networks.nets[sys.argv[2] if len(sys.argv) > 2 else 'veil']
+    
+    for name, type_, item, packed in get_samples(net):
+        res = time_type(type_, item, packed, iterations)
+        undos = map(uncompile, list(iter_types(type_)))
+        try:
+            res2 = time_type(type_, item, packed, iterations)
+        finally:
+            for undo in undos:
+                undo()
+        assert res[:2] == res2[:2]
+        
+        (packed, unpacked, pack_time, unpack_time), (packed2, unpacked2, pack_time2, unpack_time2) = res, res2
+        print '%s (%i bytes): pack %.1f us (%.1f us field by field), unpack %.1f us (%.1f us field by field)' % (
+            name, len(packed), pack_time*1e6, pack_time2*1e6, unpack_time*1e6, unpack_time2*1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+Loads a synthetic share store with 1, 2, 4 and 8 worker processes.
+
+usage: python dev/bench_share_load.py [SHARE_COUNT] [NET]
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data, networks, p2p
+from p2pool.bitcoin import data as bitcoin_data
+
+def get_bench_net(parent_name):
+    # same parent chain (and so the same PoW function), but any hash is a valid share
+    net = types.ModuleType('bench')
+    net.__dict__.update(networks.nets[parent_name].__dict__)
+    net.NAME = 'bench_' + parent_name
+    net.MAX_TARGET = 2**256 - 1
+    networks.nets[net.NAME] = net
+    return net
+
+def generate_shares(net, count):
+    bits = bitcoin_data.FloatingInteger.from_target_upper_bound(net.MAX_TARGET)
+    miners = [random.randrange(2**160) for i in xrange(100)]
+    previous_hash = None
+    i = 0
+    while i < count:
+        new_transaction_hashes = [random.randrange(2**256) for j in xrange(random.randrange(20))]
+        try:
+            share = data.Share(net, None, dict(
+                min_header=dict(version=4, previous_block=random.randrange(2**256), timestamp=1500000000 + 15*i, bits=bits, nonce=random.randrange(2**32)),
+                share_info=dict(
+                    share_data=dict(previous_share_hash=previous_hash, coinbase='\x01\x02' + os.urandom(20), nonce=0,
+                        pubkey_hash=random.choice(miners), pubkey_hash_version=net.PARENT.ADDRESS_VERSION,
+                        subsidy=5000000000, donation=0, stale_info=None, desired_version=data.Share.VOTING_VERSION),
+                    new_transaction_hashes=new_transaction_hashes,
+                    transaction_hash_refs=[x for j in xrange(len(new_transaction_hashes)) for x in [0, j]],
+                    far_share_hash=None,
+                    max_bits=bits,
+                    bits=bits,
+                    timestamp=1500000000 + 15*i,
+                    absheight=i + 1,
+                    abswork=0,
+                ),
+                ref_merkle_link=dict(branch=[], index=0),
+                last_txout_nonce=0,
+                hash_link=data.prefix_to_hash_link(os.urandom(200) + data.Share.gentx_before_refhash, data.Share.gentx_before_refhash),
+                merkle_link=dict(branch=[], index=0),
+            ))
+        except p2p.PeerMisbehavingError: # PoW above the (maximal) target
+            continue
+        i += 1
+        previous_hash = share.hash
+        yield share
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    net = get_bench_net(sys.argv[2] if len(sys.argv) > 2 else 'veil')
+
+    dirname = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(dirname, 'shares.')
+
+        start = time.time()
+        ss = data.ShareStore(prefix, net, None, None)
+        for share in generate_shares(net, count):
+            ss.add_share(share)
+            ss.add_verified_hash(share.hash)
+        ss.flush()
+        print 'generated %i shares in %.1f s (%.1f MB)' % (count, time.time() - start,
+            sum(os.path.getsize(os.path.join(dirname, x)) for x in os.listdir(dirname))/1e6)
+
+        for processes in [1, 2, 4, 8]:
+            shares = []
+            start = time.time()
+            pool = data.make_share_check_pool(net, processes)
+            try:
+                data.ShareStore(prefix, net, shares.append, lambda share_hash: None, verify_pow=True, pool=pool)
+            finally:
+                pool.close()
+                pool.join()
+            assert len(shares) == count
+            print '%i processes: %.2f s' % (processes, time.time() - start)
+
+        shares = []
+        start = time.time()
+        data.ShareStore(prefix, net, shares.append, lambda share_hash: None)
+        print 'cached PoW hashes, lazy: %.2f s' % (time.time() - start,)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+'''
+Measures the memory used per share while holding a full chain of synthetic shares.
+
+usage: python dev/bench_share_memory.py [SHARE_COUNT] [NET]
+'''
+
+import gc
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from p2pool import data
+from bench_share_load import get_bench_net, generate_shares
+
+def get_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def main():
+    net = get_bench_net(sys.argv[2] if len(sys.argv) > 2 else 'veil')
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else net.CHAIN_LENGTH
+
+    list(generate_shares(net, 10)) # warm up caches
+    gc.collect()
+    start = get_rss()
+    # round-tripped through the wire format, like shares received from peers or loaded from disk
+    shares = [data.load_share(data.share_type.unpack(data.share_type.pack(share.as_share())), net, None) for share in generate_shares(net, count)]
+    gc.collect()
+    used = get_rss() - start
+    print '%i shares: %.1f MB, %i bytes/share' % (len(shares), used/1e6, used//len(shares))
+
+if __name__ == '__main__':
+    main()
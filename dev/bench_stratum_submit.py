@@ -0,0 +1,50 @@
+'''
+Times mining.submit handling on a stratum connection, through jsonrpc's generic dispatch and through the stratum
+fast path. got_response is replaced with a stub so that only the per-submit overhead of p2pool is measured, not the
+PoW function.
+
+usage: python dev/bench_stratum_submit.py [SUBMIT_COUNT]
+'''
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor
+from twisted.test import proto_helpers
+
+import p2pool
+from p2pool.bitcoin import stratum
+from p2pool.test.bitcoin.fakes import FakeWorkerBridge
+from p2pool.util import jsonrpc
+
+def main():
+    p2pool.DEBUG = False
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    proto = stratum.StratumServerFactory(FakeWorkerBridge(coinb1='\x01'*100, coinb2='\x02'*50, merkle_branch=[random.randrange(2**256) for i in xrange(12)])).buildProtocol(None)
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto.factory.broadcaster.send_work(proto.svc_mining)
+    job_id = proto.svc_mining.handler_map.keys()[0]
+    lines = [json.dumps(dict(id=i, method='mining.submit', params=['worker', job_id, '%08x' % (i,), '%08x' % (int(time.time()),), '%08x' % (random.randrange(2**32),)])) for i in xrange(count)]
+    
+    for name, handle in [
+        ('generic jsonrpc dispatch', lambda line: jsonrpc.LineBasedPeer.lineReceived(proto, line)),
+        ('stratum fast path', proto.lineReceived),
+    ]:
+        proto.transport.clear()
+        start = time.time()
+        for line in lines:
+            handle(line)
+        duration = time.time() - start
+        assert len(proto.transport.value().splitlines()) == count
+        print '%s: %.1f us per submit, %i submits/s' % (name, duration/count*1e6, count/duration)
+    
+    for call in reactor.getDelayedCalls():
+        call.cancel()
+
+if __name__ == '__main__':
+    main()
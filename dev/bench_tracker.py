@@ -0,0 +1,80 @@
+'''
+Compares the memory and walk times of dict and compact share trackers holding
+a synthetic chain, with OkayTracker's delta attributes. each tracker is built
+in its own process, so their RSS doesn't mix.
+
+usage: python dev/bench_tracker.py [SHARE_COUNT]
+'''
+
+import gc
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data, networks
+from p2pool.bitcoin import data as bitcoin_data
+
+class Item(object):
+    __slots__ = ['hash', 'previous_hash', 'work', 'max_target', 'share_data', 'desired_version']
+    
+    def __init__(self, hash, previous_hash, target):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.work = bitcoin_data.target_to_average_attempts(target)
+        self.max_target = target*4
+        self.share_data = dict(stale_info=random.choice([None, None, None, 'orphan', 'doa']))
+        self.desired_version = random.choice([16, 17])
+
+def get_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def bench(items, compact):
+    gc.collect()
+    start_rss = get_rss()
+    start = time.time()
+    tracker = data.OkayTracker(networks.nets['veil'], compact=compact)
+    for item in items:
+        tracker.add(item)
+    add_time = time.time() - start
+    
+    head = max(tracker.heads, key=tracker.get_height)
+    height = tracker.get_height(head)
+    
+    hashes = [item.hash for item in items]
+    start = time.time()
+    for i in xrange(10000):
+        a, b = random.choice(hashes), random.choice(hashes)
+        if tracker.get_height(a) < tracker.get_height(b):
+            a, b = b, a
+        tracker.get_delta(a, tracker.get_nth_parent_hash(a, tracker.get_height(a) - tracker.get_height(b)))
+    delta_time = (time.time() - start)/10000
+    
+    start = time.time()
+    for item in tracker.get_chain(head, height):
+        pass
+    chain_time = time.time() - start
+    
+    gc.collect()
+    print '%s: %.1f MB, add %.2f s, get_delta %.1f us, get_chain %.1f ms' % (
+        'compact' if compact else 'dict', (get_rss() - start_rss)/1e6, add_time, delta_time*1e6, chain_time*1e3)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else networks.nets['veil'].CHAIN_LENGTH*2
+    hashes = [random.randrange(2**256) for i in xrange(count)]
+    items = [Item(h, hashes[i - 1] if i else None, random.choice([2**230, 2**231, 2**236])) for i, h in enumerate(hashes)]
+    random.shuffle(items) # parents are often added after their children
+    
+    for compact in [False, True]:
+        pid = os.fork()
+        if not pid:
+            bench(items, compact)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
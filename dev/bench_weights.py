@@ -0,0 +1,49 @@
+'''
+Compares PPLNS weight lookups through WeightsSkipList and OkayTracker.get_cumulative_weights on a long synthetic chain,
+for the ways the node asks for them: the best share advancing, think() verifying a chain one share at a time down
+from its head, and the same while the chain is still shorter than the PPLNS window.
+
+usage: python dev/bench_weights.py [QUERY_COUNT]
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data
+from p2pool.bitcoin import data as bitcoin_data, networks
+from p2pool.test.util.test_forest import FakeShare
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    max_shares = 8639
+    chain_length = 3*max_shares
+    scripts = [os.urandom(25) for i in xrange(500)]
+    tracker = data.OkayTracker(networks.nets['veil'])
+    for i in xrange(chain_length):
+        target = random.choice([2**240, 2**241])
+        tracker.add(FakeShare(hash=i, previous_hash=i - 1 if i else None, new_script=random.choice(scripts), target=target, max_target=2**250,
+            work=bitcoin_data.target_to_average_attempts(target), desired_version=16,
+            share_data=dict(donation=random.choice([0, 0, 1234, 65535]), stale_info=None)))
+    
+    # desired_weight cuts the window at about 4000 shares, and moves a little with each share's block target
+    desired_weights = [65535*2**16*x for x in [2990, 3000, 3010]]
+    patterns = [
+        ('best share advancing', [(i, max_shares, desired_weights[1]) for i in xrange(chain_length - count, chain_length)]),
+        ('verifying down the chain', [(i, max_shares, random.choice(desired_weights)) for i in xrange(chain_length - 1, chain_length - 1 - count, -1)]),
+        ('verifying a short chain', [(i, i + 1, random.choice(desired_weights)) for i in xrange(max_shares - 1, max_shares - 1 - count, -1)]),
+    ]
+    for name, queries in patterns:
+        skiplist = data.WeightsSkipList(tracker)
+        tracker.weights_windows.clear()
+        for func_name, func in [('skiplist', skiplist), ('window', tracker.get_cumulative_weights)]:
+            start = time.time()
+            for query in queries:
+                func(*query)
+            print '%s, %s: %.3f ms/query' % (name, func_name, (time.time() - start)/len(queries)*1e3)
+
+if __name__ == '__main__':
+    main()
@@ -77,13 +77,25 @@ class FloatingInteger(object):
 
 class FloatingIntegerType(pack.Type):
     _inner = pack.IntType(32)
+    _interned = {} # bits -> FloatingInteger, so that equal values decoded from different messages share one object
     
     def read(self, file):
         bits, file = self._inner.read(file)
-        return FloatingInteger(bits), file
+        return self._get(bits), file
     
     def write(self, file, item):
         return self._inner.write(file, item.bits)
+    
+    def get_fixed_codec(self):
+        return '<', 'I', self._get, lambda item: item.bits
+    
+    def _get(self, bits):
+        res = self._interned.get(bits)
+        if res is None:
+            if len(self._interned) >= 1000:
+                self._interned.clear()
+            res = self._interned[bits] = FloatingInteger(bits)
+        return res
 
 address_type = pack.ComposedType([
     ('services', pack.IntType(64)),
@@ -115,6 +127,60 @@ tx_id_type = pack.ComposedType([
     ('lock_time', pack.IntType(32))
 ])
 
+class Transaction(dict):
+    # a transaction that remembers its serializations and hashes once computed. values are treated as immutable, so
+    # only replacing a top-level key (as done when adding a witness) invalidates them
+    __slots__ = ['_packed', '_stripped', '_hash', '_txid']
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._invalidate()
+    
+    def _invalidate(self):
+        self._packed = self._stripped = self._hash = self._txid = None
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._invalidate()
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._invalidate()
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._invalidate()
+    
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+    
+    def pop(self, *args):
+        res = dict.pop(self, *args)
+        self._invalidate()
+        return res
+    
+    def popitem(self):
+        res = dict.popitem(self)
+        self._invalidate()
+        return res
+    
+    def clear(self):
+        dict.clear(self)
+        self._invalidate()
+    
+    def __reduce__(self):
+        return Transaction, (dict(self),)
+
+def _get_cached(tx, attr, func):
+    res = getattr(tx, attr, None)
+    if res is None:
+        res = func(tx)
+        if type(tx) is Transaction:
+            setattr(tx, attr, res)
+    return res
+
 class TransactionType(pack.Type):
     _int_type = pack.IntType(32)
     _int_type16 = pack.IntType(16)
@@ -145,23 +211,26 @@ class TransactionType(pack.Type):
             witness = [None]*len(next['tx_ins'])
             for i in xrange(len(next['tx_ins'])):
                 witness[i], file = self._witness_type.read(file)
-            return dict(version=version, marker=marker, flag=next['flag'], tx_ins=next['tx_ins'], tx_outs=next['tx_outs'], witness=witness, lock_time=locktime), file
+            return Transaction(version=version, marker=marker, flag=next['flag'], tx_ins=next['tx_ins'], tx_outs=next['tx_outs'], witness=witness, lock_time=locktime), file
         else:
             tx_ins = [None]*marker
             for i in xrange(marker):
                 tx_ins[i], file = tx_in_type.read(file)
             next, file = self._ntx_type.read(file)
-            return dict(version=version, tx_ins=tx_ins, tx_outs=next['tx_outs'], lock_time=locktime), file
+            return Transaction(version=version, tx_ins=tx_ins, tx_outs=next['tx_outs'], lock_time=locktime), file
     
     def write(self, file, item):
+        return file, _get_cached(item, '_packed', self._pack_tx)
+    
+    def _pack_tx(self, item):
         if is_segwit_tx(item):
             assert len(item['tx_ins']) == len(item['witness'])
             res = self._write_type.pack(item)
             for w in item['witness']:
                 res += self._witness_type.pack(w)
             res += self._int_type.pack(item['lock_time'])
-            return file, res
-        return tx_id_type.write(file, item)
+            return res
+        return tx_id_type.pack(item)
 
 tx_type = TransactionType()
 
@@ -181,7 +250,7 @@ block_header_type = pack.ComposedType([
     ('previous_block', pack.PossiblyNoneType(0, pack.IntType(256))),
     ('merkle_root', pack.IntType(256)),
     ('timestamp', pack.IntType(32)),
-    ('bits', pack.IntType(32)),
+    ('bits', FloatingIntegerType()),
     ('nonce', pack.IntType(32)),
 ])
 
@@ -239,32 +308,82 @@ def merkle_hash(hashes):
             for left, right in zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])]
     return hash_list[0]
 
-def calculate_merkle_link(hashes, index):
-    # XXX optimize this
+class MerkleTree(object):
+    # keeps every level of the tree, so updating it to a list of hashes that shares a prefix with the current one only
+    # recomputes the nodes right of the first difference. None hashes (like a coinbase that isn't built yet) are
+    # allowed as long as the requested links don't depend on them
     
-    hash_list = [(lambda _h=h: _h, i == index, []) for i, h in enumerate(hashes)]
+    def __init__(self, hashes=[]):
+        self.levels = [[]]
+        self.update(hashes)
+    
+    def update(self, hashes):
+        leaves = self.levels[0]
+        hashes = list(hashes)
+        if hashes == leaves:
+            return self
+        start = min(len(leaves), len(hashes))
+        if leaves[:start] != hashes[:start]:
+            start = 0
+            while leaves[start] == hashes[start]:
+                start += 1
+        del leaves[start:]
+        leaves.extend(hashes[start:])
+        self._rebuild(start)
+        return self
+    
+    def append(self, hash):
+        self.levels[0].append(hash)
+        self._rebuild(len(self.levels[0]) - 1)
+        return self
+    
+    def _rebuild(self, start):
+        level = 0
+        while len(self.levels[level]) > 1:
+            below = self.levels[level]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            above = self.levels[level + 1]
+            start //= 2
+            del above[start:]
+            for i in xrange(2*start, len(below), 2):
+                left = below[i]
+                right = below[i + 1] if i + 1 < len(below) else left
+                above.append(None if left is None or right is None else _merkle_pair_hash(left, right))
+            level += 1
+        del self.levels[level + 1:]
+    
+    def __len__(self):
+        return len(self.levels[0])
+    
+    @property
+    def root(self):
+        return self.levels[-1][0] if self.levels[0] else 0
+    
+    def get_link(self, index):
+        if not 0 <= index < len(self.levels[0]):
+            raise IndexError('index out of range')
+        branch = []
+        i = index
+        for level in self.levels[:-1]:
+            sibling = level[i ^ 1] if i ^ 1 < len(level) else level[i]
+            assert sibling is not None
+            branch.append(sibling)
+            i //= 2
+        return dict(branch=branch, index=index)
+
+def _merkle_pair_hash(left, right, _int256=pack.IntType(256)):
+    return hash256(_int256.pack(left) + _int256.pack(right))
+
+def calculate_merkle_link(hashes, index):
+    res = MerkleTree(hashes).get_link(index)
     
-    while len(hash_list) > 1:
-        hash_list = [
-            (
-                lambda _left=left, _right=right: hash256(merkle_record_type.pack(dict(left=_left(), right=_right()))),
-                left_f or right_f,
-                (left_l if left_f else right_l) + [dict(side=1, hash=right) if left_f else dict(side=0, hash=left)],
-            )
-            for (left, left_f, left_l), (right, right_f, right_l) in
-                zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])
-        ]
-    
-    res = [x['hash']() for x in hash_list[0][2]]
-    
-    assert hash_list[0][1]
     if p2pool.DEBUG:
         new_hashes = [random.randrange(2**256) if x is None else x
             for x in hashes]
-        assert check_merkle_link(new_hashes[index], dict(branch=res, index=index)) == merkle_hash(new_hashes)
-    assert index == sum(k*2**i for i, k in enumerate([1-x['side'] for x in hash_list[0][2]]))
+        assert check_merkle_link(new_hashes[index], res) == merkle_hash(new_hashes)
     
-    return dict(branch=res, index=index)
+    return res
 
 def check_merkle_link(tip_hash, link):
     if link['index'] >= 2**len(link['branch']):
@@ -359,12 +478,19 @@ def get_wtxid(tx, txid=None, txhash=None):
         assert len(tx['tx_ins']) == len(tx['witness'])
         has_witness = any(len(w) > 0 for w in tx['witness'])
     if has_witness:
-        return hash256(tx_type.pack(tx)) if txhash is None else txhash
+        return get_tx_hash(tx) if txhash is None else txhash
     else:
-        return hash256(tx_id_type.pack(tx)) if txid is None else txid
+        return get_txid(tx) if txid is None else txid
 
 def get_txid(tx):
-    return hash256(tx_id_type.pack(tx))
+    return _get_cached(tx, '_txid', lambda tx: hash256(_get_cached(tx, '_stripped', tx_id_type.pack)))
+
+def get_tx_hash(tx):
+    # hash of the full serialization, which is what known_txs and remembered txs are keyed by
+    return _get_cached(tx, '_hash', lambda tx: hash256(tx_type.pack(tx)))
+
+def get_stripped_size(tx):
+    return len(_get_cached(tx, '_stripped', tx_id_type.pack))
 
 def pubkey_to_script2(pubkey):
     assert len(pubkey) <= 75
@@ -1,5 +1,12 @@
+from __future__ import division
+
+import collections
+import hashlib
+import json
+import math
 import random
 import sys
+import time
 
 from twisted.internet import protocol, reactor
 from twisted.python import log
@@ -8,95 +15,292 @@ from p2pool.bitcoin import data as bitcoin_data, getwork
 from p2pool.util import expiring_dict, jsonrpc, pack
 
 
+class VarDiff(object):
+    '''Keeps one connection's pseudoshare rate near rate (submits per second). The miner's hash rate is measured from
+    a time-decayed sum of the work it submitted and target only changes when the resulting submit rate leaves
+    [rate/band, rate*band].'''
+    
+    def __init__(self, rate, target, max_target, half_life=60, band=2, min_time=30):
+        self.rate = rate
+        self.target = min(target, max_target)
+        self.max_target = max_target
+        self.tau = half_life/math.log(2)
+        self.band = band
+        self.min_time = min_time
+        
+        self.start = self.last = time.time()
+        self.work = 0
+    
+    def get_hash_rate(self, now=None):
+        if now is None:
+            now = time.time()
+        if now <= self.start:
+            return None
+        # decayed work over the decayed length of the time we've been measuring
+        return self.work*math.exp(-(now - self.last)/self.tau)/(self.tau*(1 - math.exp(-(now - self.start)/self.tau)))
+    
+    def got_pseudoshare(self, attempts, now=None):
+        if now is None:
+            now = time.time()
+        self.work = self.work*math.exp(-(now - self.last)/self.tau) + attempts
+        self.last = now
+        return self.update(now)
+    
+    def update(self, now=None):
+        '''Retargets if needed, returning whether target changed'''
+        
+        if now is None:
+            now = time.time()
+        attempts = bitcoin_data.target_to_average_attempts(self.target)
+        if now <= self.start or now - self.start < self.min_time and self.work < attempts*self.rate*self.min_time*self.band:
+            return False
+        hash_rate = self.get_hash_rate(now)
+        if 1/self.band <= hash_rate/attempts/self.rate <= self.band:
+            return False
+        # powers of two, so that connections with similar hash rates can share jobs
+        new_target = min(bitcoin_data.average_attempts_to_target(2**round(math.log(max(1, hash_rate/self.rate), 2))), self.max_target)
+        if new_target == self.target:
+            return False
+        self.target = new_target
+        return True
+
+def get_merkle_root(packed_gentx, packed_branch, index):
+    # check_merkle_link on already packed hashes, which saves packing the branch for every submit
+    h = hashlib.sha256(hashlib.sha256(packed_gentx).digest()).digest()
+    for i, branch_hash in enumerate(packed_branch):
+        h = hashlib.sha256(hashlib.sha256(branch_hash + h if (index >> i) & 1 else h + branch_hash).digest()).digest()
+    return pack.IntType(256).unpack(h)
+
+def make_job(jobid, x, got_response, clean):
+    '''Returns the arguments of StratumRPCMiningProvider.send_job for work x, including the serialized mining.notify
+    line'''
+    
+    packed_branch = [pack.IntType(256).pack(s) for s in x['merkle_link']['branch']]
+    return jobid, x, got_response, packed_branch, json.dumps(dict(jsonrpc='2.0', id=None, method='mining.notify', params=[
+        jobid, # jobid
+        getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex'), # prevhash
+        x['coinb1'].encode('hex'), # coinb1
+        x['coinb2'].encode('hex'), # coinb2
+        [s.encode('hex') for s in packed_branch], # merkle_branch
+        getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
+        getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
+        getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
+        clean, # clean_jobs
+    ])) + '\n'
+
+class WorkBroadcaster(object):
+    '''Sends work to stratum connections. Every connection gets its own extranonce1, so connections asking for the
+    same work share one job and one serialized mining.notify line. New work is written out in chunks of chunk_size
+    connections per reactor iteration so that a broadcast to many connections doesn't block everything else.'''
+    
+    chunk_size = 100
+    
+    def __init__(self, wb):
+        self.wb = wb
+        self.extranonce1_size = wb._inner.COINBASE_NONCE_LENGTH - wb.COINBASE_NONCE_LENGTH
+        self.last_extranonce1 = random.randrange(2**(8*self.extranonce1_size))
+        
+        self.providers = set()
+        self.queue = collections.OrderedDict() # provider -> whether its jobs need to be cleaned
+        self.delayed = None
+        self.jobs = {} # (get_work args, clean) -> jobid, x, got_response, packed merkle branch, notify line
+        self.jobs_times = None
+        
+        self.fanout_start = None
+        self.fanout_connections = self.fanout_chunks = 0
+        self.stats = dict(broadcasts=0, last_duration=0, max_duration=0, last_connections=0, last_chunks=0)
+        
+        wb.new_work_event.watch(lambda: self.broadcast(True))
+        wb.refresh_work_event.watch(lambda: self.broadcast(False))
+    
+    def get_extranonce1(self):
+        self.last_extranonce1 = (self.last_extranonce1 + 1) % 2**(8*self.extranonce1_size)
+        return pack.IntType(8*self.extranonce1_size).pack(self.last_extranonce1)
+    
+    def add(self, provider):
+        self.providers.add(provider)
+    
+    def remove(self, provider):
+        self.providers.discard(provider)
+        self.queue.pop(provider, None)
+    
+    def broadcast(self, clean):
+        for provider in self.providers:
+            self.queue[provider] = self.queue.get(provider, False) or clean
+        if not self.queue:
+            return # nothing to send, so no fanout to time
+        if self.fanout_start is None:
+            self.fanout_start = time.time()
+            self.fanout_connections = self.fanout_chunks = 0
+        if self.delayed is None:
+            self.delayed = reactor.callLater(0, self._send_chunk)
+    
+    def _send_chunk(self):
+        self.delayed = None
+        count = min(self.chunk_size, len(self.queue))
+        for i in xrange(count):
+            provider, clean = self.queue.popitem(last=False)
+            self.send_work(provider, clean)
+        self.fanout_connections += count
+        self.fanout_chunks += 1
+        
+        if self.queue:
+            self.delayed = reactor.callLater(0, self._send_chunk)
+            return
+        duration = time.time() - self.fanout_start
+        self.fanout_start = None
+        self.stats.update(
+            broadcasts=self.stats['broadcasts'] + 1,
+            last_duration=duration,
+            max_duration=max(self.stats['max_duration'], duration),
+            last_connections=self.fanout_connections,
+            last_chunks=self.fanout_chunks,
+        )
+    
+    def send_work(self, provider, clean=True):
+        self.queue.pop(provider, None)
+        times = self.wb.new_work_event.times, self.wb.refresh_work_event.times
+        if times != self.jobs_times:
+            self.jobs = {}
+            self.jobs_times = times
+        try:
+            key = provider.get_work_args(), clean
+            if key not in self.jobs:
+                x, got_response = self.wb._inner.get_work(*key[0])
+                self.jobs[key] = make_job(str(random.randrange(2**128)), x, got_response, clean)
+        except:
+            log.err()
+            provider.transport.loseConnection()
+            return
+        provider.send_job(*self.jobs[key])
+    
+    def get_stats(self):
+        return dict(self.stats, connections=len(self.providers), queued=len(self.queue))
+
 class StratumRPCMiningProvider(object):
-    def __init__(self, wb, other, transport):
+    def __init__(self, wb, other, transport, broadcaster):
         self.wb = wb
         self.other = other
         self.transport = transport
+        self.broadcaster = broadcaster
         
         self.username = None
         self.handler_map = expiring_dict.ExpiringDict(300)
+        self.extranonce1 = broadcaster.get_extranonce1()
+        
+        self.vardiff = None
+        if wb.share_rate_type == 'miner' and wb.share_rate is not None: # otherwise the node-wide pseudoshare target applies
+            max_target = bitcoin_data.difficulty_to_target_alt(wb.min_difficulty, wb.net.DUMB_SCRYPT_DIFF)
+            self.vardiff = VarDiff(wb.share_rate/60, max_target, max_target)
+        self.share_target = None # last target sent with mining.set_difficulty
         
-        self.watch_id = self.wb.new_work_event.watch(self._send_work)
+        self.broadcaster.add(self)
     
     def rpc_subscribe(self, miner_version=None, session_id=None):
-        reactor.callLater(0, self._send_work)
+        reactor.callLater(0, self.broadcaster.send_work, self)
         
         return [
             ["mining.notify", "ae6812eb4cd7735a302a8a9dd95cf71f"], # subscription details
-            "", # extranonce1
+            self.extranonce1.encode('hex'), # extranonce1
             self.wb.COINBASE_NONCE_LENGTH, # extranonce2_size
         ]
     
     def rpc_authorize(self, username, password):
         self.username = username
         
-        reactor.callLater(0, self._send_work)
+        reactor.callLater(0, self.broadcaster.send_work, self)
     
-    def _send_work(self):
-        try:
-            x, got_response = self.wb.get_work(*self.wb.preprocess_request('' if self.username is None else self.username))
-        except:
-            log.err()
-            self.transport.loseConnection()
-            return
-        jobid = str(random.randrange(2**128))
-        self.other.svc_mining.rpc_set_difficulty(bitcoin_data.target_to_difficulty_alt(x['share_target'], self.wb.net.DUMB_SCRYPT_DIFF) * self.wb.net.DUMB_SCRYPT_DIFF).addErrback(lambda err: None)
-        self.other.svc_mining.rpc_notify(
-            jobid, # jobid
-            getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex'), # prevhash
-            x['coinb1'].encode('hex'), # coinb1
-            x['coinb2'].encode('hex'), # coinb2
-            [pack.IntType(256).pack(s).encode('hex') for s in x['merkle_link']['branch']], # merkle_branch
-            getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
-            getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
-            getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
-            True, # clean_jobs
-        ).addErrback(lambda err: None)
-        self.handler_map[jobid] = x, got_response
+    def get_work_args(self):
+        user, pubkey_hash, pubkey_hash_version, desired_share_target, desired_pseudoshare_target = self.wb.preprocess_request('' if self.username is None else self.username)
+        if desired_pseudoshare_target is None and self.vardiff is not None:
+            self.vardiff.update()
+            desired_pseudoshare_target = self.vardiff.target
+        return user, pubkey_hash, pubkey_hash_version, desired_share_target, desired_pseudoshare_target
+    
+    def send_job(self, jobid, x, got_response, packed_branch, notify_line):
+        if x['share_target'] != self.share_target:
+            self.share_target = x['share_target']
+            self.other.svc_mining.rpc_set_difficulty(bitcoin_data.target_to_difficulty_alt(x['share_target'], self.wb.net.DUMB_SCRYPT_DIFF) * self.wb.net.DUMB_SCRYPT_DIFF).addErrback(lambda err: None)
+        self.transport.write(notify_line)
+        self.handler_map[jobid] = x, got_response, packed_branch
     
     def rpc_submit(self, worker_name, job_id, extranonce2, ntime, nonce):
         if job_id not in self.handler_map:
             print >>sys.stderr, '''Couldn't link returned work's job id with its handler. This should only happen if this process was recently restarted!'''
             return False
-        x, got_response = self.handler_map[job_id]
-        coinb_nonce = extranonce2.decode('hex')
-        assert len(coinb_nonce) == self.wb.COINBASE_NONCE_LENGTH
+        x, got_response, packed_branch = self.handler_map[job_id]
+        assert len(extranonce2.decode('hex')) == self.wb.COINBASE_NONCE_LENGTH
+        coinb_nonce = self.extranonce1 + extranonce2.decode('hex')
         new_packed_gentx = x['coinb1'] + coinb_nonce + x['coinb2']
         header = dict(
             version=x['version'],
             previous_block=x['previous_block'],
-            merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), x['merkle_link']), # new_packed_gentx has witness data stripped
+            merkle_root=get_merkle_root(new_packed_gentx, packed_branch, x['merkle_link']['index']), # new_packed_gentx has witness data stripped
             timestamp=pack.IntType(32).unpack(getwork._swap4(ntime.decode('hex'))),
             bits=x['bits'],
             nonce=pack.IntType(32).unpack(getwork._swap4(nonce.decode('hex'))),
         )
 
 	    # Disconnect miners with large DOA rates to prevent DoS
-        res = got_response(header, worker_name, coinb_nonce)
-        if len(self.wb._inner.my_share_hashes) > 20:
-            if float(len(self.wb._inner.my_doa_share_hashes)) / float(len(self.wb._inner.my_share_hashes)) > 0.60:
+        res = got_response(header, worker_name, coinb_nonce) # false for stale, hash > target and duplicate submits
+        if res and self.vardiff is not None and self.vardiff.got_pseudoshare(bitcoin_data.target_to_average_attempts(x['share_target'])):
+            reactor.callLater(0, self.broadcaster.send_work, self, False) # jobs carry their target, so the new difficulty needs a new job
+        share_count, doa_share_count, total_hashes, invalid_hashes = self.get_submit_stats()
+        if share_count > 20:
+            if float(doa_share_count) / float(share_count) > 0.60:
                self.transport.loseConnection() 
 
         # Disconnect miners with large hash > target to prevent DoS
-        if self.wb._inner.total_hashes > 20:
-            if float(self.wb._inner.invalid_hashes) / float(self.wb._inner.total_hashes) > 0.05:
+        if total_hashes > 20:
+            if float(invalid_hashes) / float(total_hashes) > 0.05:
                 self.transport.loseConnection()
         
 	return res
 
+    def get_submit_stats(self):
+        return len(self.wb._inner.my_share_hashes), len(self.wb._inner.my_doa_share_hashes), self.wb._inner.total_hashes, self.wb._inner.invalid_hashes
+    
     def close(self):
-        self.wb.new_work_event.unwatch(self.watch_id)
+        self.broadcaster.remove(self)
 
 class StratumProtocol(jsonrpc.LineBasedPeer):
     def connectionMade(self):
-        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport)
+        self.svc_mining = self.factory.mining_provider(self.factory.wb, self.other, self.transport, self.factory.broadcaster)
+        # synchronous methods that are called often enough to skip jsonrpc's generic Deferred-based dispatch
+        self.fast_methods = {
+            'mining.submit': self.svc_mining.rpc_submit,
+        }
+    
+    def lineReceived(self, line):
+        try:
+            req = json.loads(line)
+            method_meth = self.fast_methods.get(req['method']) if isinstance(req.get('params', None), list) else None
+        except Exception:
+            method_meth = None
+        if method_meth is None:
+            jsonrpc.LineBasedPeer.lineReceived(self, line) # responses, other methods and anything malformed
+            return
+        
+        try:
+            try:
+                result = method_meth(*req['params'])
+            except jsonrpc.Error:
+                raise
+            except Exception:
+                log.err(None, 'Squelched JSON error:')
+                raise jsonrpc.Error_for_code(-32099)(u'Unknown error')
+        except jsonrpc.Error, e:
+            self.sendLine(json.dumps(dict(jsonrpc='2.0', id=req.get('id', None), result=None, error=e._to_obj())))
+        else:
+            self.sendLine('{"jsonrpc": "2.0", "id": %s, "result": %s, "error": null}' % (json.dumps(req.get('id', None)), json.dumps(result)))
     
     def connectionLost(self, reason):
         self.svc_mining.close()
 
 class StratumServerFactory(protocol.ServerFactory):
     protocol = StratumProtocol
+    mining_provider = StratumRPCMiningProvider
     
-    def __init__(self, wb):
+    def __init__(self, wb, broadcaster=None):
         self.wb = wb
+        self.broadcaster = broadcaster if broadcaster is not None else WorkBroadcaster(wb)
@@ -0,0 +1,380 @@
+from __future__ import division
+
+import json
+import os
+import random
+import socket
+import sys
+
+from twisted.internet import protocol, reactor, task
+from twisted.python import log
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data, networks, stratum
+from p2pool.util import expiring_dict, jsonrpc, math, pack, variable
+
+def pack_work(x):
+    return dict(
+        version=x['version'],
+        previous_block=x['previous_block'],
+        merkle_link=dict(branch=x['merkle_link']['branch'], index=x['merkle_link']['index']),
+        coinb1=x['coinb1'].encode('hex'),
+        coinb2=x['coinb2'].encode('hex'),
+        timestamp=x['timestamp'],
+        bits=x['bits'].bits,
+        share_target=x['share_target'],
+        candidate_target=x['candidate_target'],
+    )
+
+def unpack_work(work):
+    return dict(work,
+        coinb1=work['coinb1'].decode('hex'),
+        coinb2=work['coinb2'].decode('hex'),
+        bits=bitcoin_data.FloatingInteger(work['bits']),
+    )
+
+# main process
+
+class ControlProtocol(jsonrpc.LineBasedPeer):
+    '''The main process's end of a worker process's control connection'''
+    
+    def connectionMade(self):
+        self.index = None
+        self.factory.connections.add(self)
+    
+    def rpc_hello(self, index):
+        self.index = index
+        wb = self.factory.wb
+        return dict(
+            coinbase_nonce_length=wb.COINBASE_NONCE_LENGTH,
+            inner_coinbase_nonce_length=wb._inner.COINBASE_NONCE_LENGTH,
+            share_rate=wb.share_rate,
+            share_rate_type=wb.share_rate_type,
+            min_difficulty=wb.min_difficulty,
+        )
+    
+    def rpc_get_job(self, username, desired_pseudoshare_target, clean):
+        return self.factory.get_job(username, desired_pseudoshare_target, clean)
+    
+    def rpc_submit(self, jobid, user, header, coinbase_nonce):
+        if jobid not in self.factory.handlers:
+            print >>sys.stderr, '''Couldn't link stratum worker's submit with its handler. This should only happen if this process was recently restarted!'''
+            return False
+        args, x, got_response = self.factory.handlers[jobid]
+        self.factory.forwarded += 1
+        return got_response(bitcoin_data.block_header_type.unpack(header.decode('hex')), user, coinbase_nonce.decode('hex'))
+    
+    def rpc_report(self, submits, stats):
+        for jobid, user, on_time, count, invalid, duplicates in submits:
+            if jobid not in self.factory.handlers:
+                continue
+            args, x, got_response = self.factory.handlers[jobid]
+            self.factory.wb._inner.got_checked_submits(user, args[1], x, on_time, count, invalid, duplicates)
+            self.factory.checked += count + invalid + duplicates
+        self.factory.worker_stats[self.index] = stats
+        
+        inner = self.factory.wb._inner
+        return dict(
+            share_count=len(inner.my_share_hashes),
+            doa_share_count=len(inner.my_doa_share_hashes),
+            total_hashes=inner.total_hashes,
+            invalid_hashes=inner.invalid_hashes,
+        )
+    
+    def send_new_work(self, clean):
+        self.sendLine(json.dumps(dict(jsonrpc='2.0', id=None, method='new_work', params=[clean])))
+    
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        self.factory.worker_stats.pop(self.index, None)
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, server, index):
+        self.server = server
+        self.index = index
+        self.buf = ''
+    
+    def outReceived(self, data):
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            print 'Stratum worker %i: %s' % (self.index, line)
+    errReceived = outReceived
+    
+    def processEnded(self, reason):
+        self.server.process_ended(self.index)
+
+class WorkerServer(protocol.ServerFactory):
+    '''Runs stratum in separate worker processes, so that checking pseudoshares' proof of work scales across cores.
+    Workers accept miners on a listening socket they share, get jobs from this process over a control connection and
+    only pass back submits that could be shares or blocks, along with counts of the others.'''
+    
+    protocol = ControlProtocol
+    restart_delay = 5
+    
+    def __init__(self, wb):
+        self.wb = wb
+        
+        self.connections = set()
+        self.jobs = {} # (get_work args, clean) -> job returned by get_job
+        self.jobs_times = None
+        self.handlers = expiring_dict.ExpiringDict(300) # jobid -> get_work args, x, got_response
+        self.worker_stats = {} # index -> stats from the worker's last report
+        self.forwarded = self.checked = 0
+        
+        self.processes = {} # index -> process transport
+        self.stopping = False
+        
+        wb.new_work_event.watch(lambda: self.broadcast(True))
+        wb.refresh_work_event.watch(lambda: self.broadcast(False))
+    
+    def broadcast(self, clean):
+        for connection in self.connections:
+            connection.send_new_work(clean)
+    
+    def get_job(self, username, desired_pseudoshare_target, clean):
+        times = self.wb.new_work_event.times, self.wb.refresh_work_event.times
+        if times != self.jobs_times:
+            self.jobs = {}
+            self.jobs_times = times
+        args = self.wb.preprocess_request(username)
+        if args[4] is None: # no difficulty in the username, so use the worker's vardiff target
+            args = args[:4] + (desired_pseudoshare_target,)
+        key = args, clean
+        if key not in self.jobs:
+            x, got_response = self.wb._inner.get_work(*args)
+            jobid = str(random.randrange(2**128))
+            self.handlers[jobid] = args, x, got_response
+            self.jobs[key] = dict(jobid=jobid, work=pack_work(x))
+        return self.jobs[key]
+    
+    def start(self, control_path, endpoint, count):
+        if os.path.exists(control_path):
+            os.remove(control_path)
+        self.control_port = reactor.listenUNIX(control_path, self, mode=0600)
+        self.control_path = control_path
+        
+        if endpoint[0]:
+            family, _, _, _, address = socket.getaddrinfo(endpoint[0], endpoint[1], socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+        else: # all interfaces, like listenTCP
+            family, address = socket.AF_INET, endpoint
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(50)
+        self.listener.setblocking(False)
+        
+        for index in xrange(count):
+            self.spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+    
+    def spawn(self, index):
+        fd = self.listener.fileno()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(p2pool.__file__))] + ([os.environ['PYTHONPATH']] if 'PYTHONPATH' in os.environ else [])))
+        self.processes[index] = reactor.spawnProcess(WorkerProcessProtocol(self, index), sys.executable,
+            [sys.executable, '-u', '-m', 'p2pool.bitcoin.stratum_workers', self.control_path, str(fd), str(self.listener.family), str(index), self.wb.net.NAME],
+            env=env, childFDs={0: 'w', 1: 'r', 2: 'r', fd: fd})
+    
+    def process_ended(self, index):
+        self.processes.pop(index, None)
+        if self.stopping:
+            return
+        print >>sys.stderr, 'Stratum worker %i exited! Restarting in %i seconds...' % (index, self.restart_delay)
+        reactor.callLater(self.restart_delay, self.spawn, index)
+    
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except Exception:
+                pass
+    
+    def get_stats(self):
+        return dict(
+            workers=len(self.connections),
+            connections=sum(stats['connections'] for stats in self.worker_stats.itervalues()),
+            forwarded_submits=self.forwarded,
+            checked_submits=self.checked,
+            worker_stats=dict((str(index), stats) for index, stats in self.worker_stats.iteritems()),
+        )
+
+# worker process
+
+class RemoteWorkerBridge(object):
+    '''Stands in for the main process's worker bridge in a worker process. Its events fire when the main process
+    says that work changed.'''
+    
+    def __init__(self, net, config):
+        self.net = net
+        self.COINBASE_NONCE_LENGTH = config['coinbase_nonce_length']
+        self._inner = math.Object(COINBASE_NONCE_LENGTH=config['inner_coinbase_nonce_length']) # only for the extranonce1 size
+        self.share_rate, self.share_rate_type, self.min_difficulty = config['share_rate'], config['share_rate_type'], config['min_difficulty']
+        
+        self.new_work_event = variable.Event()
+        self.refresh_work_event = variable.Event()
+        self.submit_stats = dict(share_count=0, doa_share_count=0, total_hashes=0, invalid_hashes=0)
+
+class WorkerBroadcaster(stratum.WorkBroadcaster):
+    '''Gets jobs from the main process instead of making them. Submits are checked against the job's pseudoshare
+    target here and only the ones that could be shares or blocks are passed on right away; the rest are counted and
+    reported every report_interval seconds.'''
+    
+    report_interval = 1
+    
+    def __init__(self, wb, control, index):
+        stratum.WorkBroadcaster.__init__(self, wb)
+        self.control = control
+        # the first byte of extranonce1 is the worker's index, so that jobs shared between workers are never mined twice
+        self.extranonce1_prefix = index
+        self.pending = {} # (get_work args, clean) -> providers waiting for the job
+        self.submits = {} # (jobid, user, on_time) -> [count, invalid, duplicates]
+        
+        self.report_loop = task.LoopingCall(self.report)
+        self.report_loop.start(self.report_interval, now=False)
+    
+    def get_extranonce1(self):
+        self.last_extranonce1 = (self.last_extranonce1 + 1) % 2**(8*self.extranonce1_size - 8)
+        return chr(self.extranonce1_prefix) + pack.IntType(8*self.extranonce1_size - 8).pack(self.last_extranonce1)
+    
+    def send_work(self, provider, clean=True):
+        self.queue.pop(provider, None)
+        times = self.wb.new_work_event.times, self.wb.refresh_work_event.times
+        if times != self.jobs_times:
+            self.jobs = {}
+            self.pending = {}
+            self.jobs_times = times
+        key = provider.get_work_args(), clean
+        if key in self.jobs:
+            provider.send_job(*self.jobs[key])
+        elif key in self.pending:
+            self.pending[key].add(provider)
+        else:
+            self.pending[key] = set([provider])
+            self.control.other.rpc_get_job(key[0][0], key[0][1], clean).addCallbacks(
+                lambda job: self._got_job(key, times, job), lambda fail: self._get_job_failed(key, times, fail))
+    
+    def _got_job(self, key, times, job):
+        if times != self.jobs_times: # a newer job was asked for in the meantime
+            return
+        x = unpack_work(job['work'])
+        self.jobs[key] = stratum.make_job(job['jobid'], x, self._get_got_response(job['jobid'], x), key[1])
+        for provider in self.pending.pop(key):
+            if provider in self.providers:
+                provider.send_job(*self.jobs[key])
+    
+    def _get_job_failed(self, key, times, fail):
+        log.err(fail, 'Error getting stratum job from main process:')
+        if times != self.jobs_times:
+            return
+        for provider in self.pending.pop(key):
+            provider.transport.loseConnection()
+    
+    def _get_got_response(self, jobid, x):
+        times = self.wb.new_work_event.times
+        received_header_hashes = set()
+        
+        def got_response(header, user, coinbase_nonce):
+            packed_header = bitcoin_data.block_header_type.pack(header)
+            pow_hash = self.wb.net.POW_FUNC(packed_header)
+            on_time = self.wb.new_work_event.times == times
+            
+            if pow_hash <= x['candidate_target']:
+                self.control.other.rpc_submit(jobid, user, packed_header.encode('hex'), coinbase_nonce.encode('hex')).addErrback(log.err, 'Error passing submit to main process:')
+                return on_time
+            
+            counts = self.submits.setdefault((jobid, user, on_time), [0, 0, 0])
+            header_hash = bitcoin_data.hash256(packed_header)
+            if pow_hash > x['share_target']:
+                counts[1] += 1
+                return False
+            elif header_hash in received_header_hashes:
+                counts[2] += 1
+                return False
+            else:
+                received_header_hashes.add(header_hash)
+                counts[0] += 1
+            return on_time
+        return got_response
+    
+    def report(self):
+        submits, self.submits = self.submits, {}
+        df = self.control.other.rpc_report([[jobid, user, on_time] + counts for (jobid, user, on_time), counts in submits.iteritems()], self.get_stats())
+        df.addCallback(self.wb.submit_stats.update)
+        df.addErrback(log.err, 'Error reporting to main process:')
+    
+    def stop(self):
+        if self.report_loop.running:
+            self.report_loop.stop()
+
+class WorkerMiningProvider(stratum.StratumRPCMiningProvider):
+    def get_work_args(self):
+        # the main process handles the username, but the vardiff target is this connection's
+        if self.vardiff is None:
+            return '' if self.username is None else self.username, None
+        self.vardiff.update()
+        return '' if self.username is None else self.username, self.vardiff.target
+    
+    def get_submit_stats(self):
+        stats = self.wb.submit_stats
+        return stats['share_count'], stats['doa_share_count'], stats['total_hashes'], stats['invalid_hashes']
+
+class WorkerStratumServerFactory(stratum.StratumServerFactory):
+    mining_provider = WorkerMiningProvider
+
+class ControlClientProtocol(jsonrpc.LineBasedPeer):
+    '''A worker process's end of its control connection'''
+    
+    def connectionMade(self):
+        self.broadcaster = None
+        self.other.rpc_hello(self.factory.index).addCallbacks(self._got_hello, self._hello_failed)
+    
+    def _got_hello(self, config):
+        wb = RemoteWorkerBridge(self.factory.net, config)
+        self.broadcaster = WorkerBroadcaster(wb, self, self.factory.index)
+        self.factory.got_stratum_factory(WorkerStratumServerFactory(wb, self.broadcaster))
+    
+    def _hello_failed(self, fail):
+        log.err(fail, 'Error greeting main process:')
+        self.transport.loseConnection()
+    
+    def rpc_new_work(self, clean):
+        if self.broadcaster is None:
+            return
+        if clean:
+            self.broadcaster.wb.new_work_event.happened()
+        else:
+            self.broadcaster.wb.refresh_work_event.happened()
+    
+    def connectionLost(self, reason):
+        if self.broadcaster is not None:
+            self.broadcaster.stop()
+
+class ControlClientFactory(protocol.ClientFactory):
+    protocol = ControlClientProtocol
+    
+    def __init__(self, net, index, got_stratum_factory):
+        self.net = net
+        self.index = index
+        self.got_stratum_factory = got_stratum_factory
+    
+    def clientConnectionFailed(self, connector, reason):
+        print >>sys.stderr, 'Could not connect to main process: %s' % (reason.getErrorMessage(),)
+        reactor.stop()
+    
+    def clientConnectionLost(self, connector, reason):
+        print 'Lost connection to main process, exiting.'
+        reactor.stop()
+
+def run():
+    control_path, fd, family, index, net_name = sys.argv[1:]
+    fd, family, index = int(fd), int(family), int(index)
+    
+    def got_stratum_factory(factory):
+        reactor.adoptStreamPort(fd, family, factory)
+        print 'Accepting stratum connections'
+    reactor.connectUNIX(control_path, ControlClientFactory(networks.nets[net_name], index, got_stratum_factory))
+    reactor.run()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,109 @@
+import collections
+
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import variable
+
+class TxStore(object):
+    '''Holds one copy of every transaction the node knows about, published through known_txs_var. Transactions that
+    something still needs (bitcoind's block template, txs a peer told us to remember, recent shares of the best
+    chain) are referenced. Unreferenced ones are kept in least recently used order and evicted once the store holds more than
+    max_size bytes of serialized transactions.'''
+    
+    def __init__(self, max_size=50*1000*1000, known_txs_var=None):
+        self.max_size = max_size
+        self.known_txs_var = known_txs_var if known_txs_var is not None else variable.VariableDict({})
+        
+        self.sizes = {} # hash -> serialized size
+        self.refs = {} # hash -> reference count, only for referenced transactions
+        self.unreferenced = collections.OrderedDict() # hash -> None, least recently used first
+        self.ref_sets = {} # name -> set of hashes referenced under that name
+        
+        self.size = 0
+        self.referenced_size = 0
+        self.evicted_count = 0
+        self.evicted_size = 0
+    
+    def __contains__(self, tx_hash):
+        return tx_hash in self.known_txs_var.value
+    
+    def __getitem__(self, tx_hash):
+        return self.known_txs_var.value[tx_hash]
+    
+    def __len__(self):
+        return len(self.known_txs_var.value)
+    
+    def add(self, txs):
+        '''Stores a dict of hash -> tx, returning the same hashes mapped to the stored (possibly previously known)
+        transactions, which holders should keep instead of their own copies'''
+        
+        known_txs = self.known_txs_var.value
+        new_txs = {}
+        for tx_hash, tx in txs.iteritems():
+            if tx_hash in known_txs:
+                if tx_hash in self.unreferenced:
+                    del self.unreferenced[tx_hash]
+                    self.unreferenced[tx_hash] = None
+                continue
+            size = bitcoin_data.tx_type.packed_size(tx)
+            self.sizes[tx_hash] = size
+            self.size += size
+            self.unreferenced[tx_hash] = None
+            new_txs[tx_hash] = tx
+        self.known_txs_var.add(new_txs)
+        self._evict(keep=txs)
+        return dict((tx_hash, known_txs[tx_hash]) for tx_hash in txs)
+    
+    def incref(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            if tx_hash not in self.known_txs_var.value:
+                raise KeyError(tx_hash)
+            count = self.refs.get(tx_hash, 0)
+            if not count:
+                self.unreferenced.pop(tx_hash, None)
+                self.referenced_size += self.sizes[tx_hash]
+            self.refs[tx_hash] = count + 1
+    
+    def decref(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            count = self.refs.pop(tx_hash) - 1
+            if count:
+                self.refs[tx_hash] = count
+            else:
+                self.referenced_size -= self.sizes[tx_hash]
+                self.unreferenced[tx_hash] = None
+        self._evict()
+    
+    def set_refs(self, name, tx_hashes):
+        '''Makes the transactions referenced under name exactly the known ones among tx_hashes'''
+        
+        new = set(tx_hash for tx_hash in tx_hashes if tx_hash in self.known_txs_var.value)
+        old = self.ref_sets.get(name, set())
+        self.ref_sets[name] = new
+        self.incref(new - old)
+        self.decref(old - new)
+    
+    def _evict(self, keep=()):
+        removed = []
+        while self.size > self.max_size and self.unreferenced:
+            tx_hash = next(iter(self.unreferenced))
+            if tx_hash in keep: # everything after it was just added too
+                break
+            del self.unreferenced[tx_hash]
+            size = self.sizes.pop(tx_hash)
+            self.size -= size
+            self.evicted_count += 1
+            self.evicted_size += size
+            removed.append(tx_hash)
+        self.known_txs_var.remove(removed)
+    
+    def get_stats(self):
+        return dict(
+            count=len(self.sizes),
+            size=self.size,
+            referenced_count=len(self.refs),
+            referenced_size=self.referenced_size,
+            referenced_over_budget_size=max(0, self.referenced_size - self.max_size), # can't be evicted
+            max_size=self.max_size,
+            evicted_count=self.evicted_count,
+            evicted_size=self.evicted_size,
+        )
@@ -113,7 +113,9 @@ class CachingWorkerBridge(object):
         
         self.COINBASE_NONCE_LENGTH = (inner.COINBASE_NONCE_LENGTH+1)//2
         self.new_work_event = inner.new_work_event
+        self.refresh_work_event = inner.refresh_work_event
         self.preprocess_request = inner.preprocess_request
+        self.share_rate, self.share_rate_type, self.min_difficulty = inner.share_rate, inner.share_rate_type, inner.min_difficulty
         
         self._my_bits = (self._inner.COINBASE_NONCE_LENGTH - self.COINBASE_NONCE_LENGTH)*8
         
@@ -121,9 +123,9 @@ class CachingWorkerBridge(object):
         self._times = None
     
     def get_work(self, *args):
-        if self._times != self.new_work_event.times:
+        if self._times != (self.new_work_event.times, self.refresh_work_event.times):
             self._cache = {}
-            self._times = self.new_work_event.times
+            self._times = self.new_work_event.times, self.refresh_work_event.times
         
         if args not in self._cache:
             x, handler = self._inner.get_work(*args)
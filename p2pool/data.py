@@ -1,10 +1,12 @@
 from __future__ import division
 
 import hashlib
+import multiprocessing
 import os
 import random
 import sys
 import time
+import types
 
 from twisted.python import log
 
@@ -46,23 +48,49 @@ share_type = pack.ComposedType([
     ('contents', pack.VarStrType()),
 ])
 
-def load_share(share, net, peer_addr):
-    assert peer_addr is None or isinstance(peer_addr, tuple)
-    if share['type'] < Share.VERSION:
+def get_share_class(share_type_id):
+    if share_type_id < Share.VERSION:
         from p2pool import p2p
         raise p2p.PeerMisbehavingError('sent an obsolete share')
-    elif share['type'] == Share.VERSION:
-        return Share(net, peer_addr, Share.get_dynamic_types(net)['share_type'].unpack(share['contents']))
-    elif share['type'] == NewShare.VERSION:
-        return NewShare(net, peer_addr, NewShare.get_dynamic_types(net)['share_type'].unpack(share['contents']))
+    elif share_type_id == Share.VERSION:
+        return Share
+    elif share_type_id == NewShare.VERSION:
+        return NewShare
     else:
-        raise ValueError('unknown share type: %r' % (share['type'],))
+        raise ValueError('unknown share type: %r' % (share_type_id,))
+
+def load_share(share, net, peer_addr, pow_cache=None):
+    assert peer_addr is None or isinstance(peer_addr, tuple)
+    cls = get_share_class(share['type'])
+    return cls(net, peer_addr, cls.get_dynamic_types(net)['share_type'].unpack(share['contents']), pow_cache)
+
+def load_lazy_share(share, net, share_hash, pow_cache=None):
+    return get_share_class(share['type']).lazy(net, share_hash, share['contents'], pow_cache)
+
+class LazyShareError(ValueError):
+    '''raised by any access to a lazily loaded share whose stored contents turned out to be invalid when it was
+    materialized. OkayTracker.think drops the share when it sees one'''
+    
+    def __init__(self, share_hash, reason):
+        ValueError.__init__(self, 'lazily loaded share %064x is invalid: %s' % (share_hash, reason))
+        self.share_hash = share_hash
 
 def is_segwit_activated(version, net):
     assert not(version is None or net is None)
     segwit_activation_version = getattr(net, 'SEGWIT_ACTIVATION_VERSION', 0)
     return version >= segwit_activation_version and segwit_activation_version > 0
 
+_interned = {}
+
+def intern_value(value):
+    # returns a shared copy of value. shares by the same miners repeat the same payout scripts and pubkey hashes
+    res = _interned.get(value)
+    if res is None:
+        if len(_interned) >= 10000:
+            _interned.clear()
+        res = _interned[value] = value
+    return res
+
 DONATION_SCRIPT = '410418a74130b2f4fad899d8ed2bff272bc43a03c8ca72897ae3da584d7a770b5a9ea8dd1b37a620d27c6cf6d5a7a9bbd6872f5981e95816d701d94f201c5d093be6ac'.decode('hex')
 
 class BaseShare(object):
@@ -80,14 +108,18 @@ class BaseShare(object):
         ('bits', bitcoin_data.FloatingIntegerType()),
         ('nonce', pack.IntType(32)),
     ])
-    share_info_type = None
-    share_type = None
-    ref_type = None
+    share_info_type = property(lambda self: self.get_dynamic_types(self.net)['share_info_type'])
+    share_type = property(lambda self: self.get_dynamic_types(self.net)['share_type'])
+    ref_type = property(lambda self: self.get_dynamic_types(self.net)['ref_type'])
 
     gentx_before_refhash = pack.VarStrType().pack(DONATION_SCRIPT) + pack.IntType(64).pack(0) + pack.VarStrType().pack('\x6a\x28' + pack.IntType(256).pack(0) + pack.IntType(64).pack(0))[:3]
 
+    _dynamic_types = {} # (cls, net) -> types
+    
     @classmethod
     def get_dynamic_types(cls, net):
+        if (cls, net) in cls._dynamic_types:
+            return cls._dynamic_types[cls, net]
         t = dict(share_info_type=None, share_type=None, ref_type=None)
         segwit_data = ('segwit_data', pack.PossiblyNoneType(dict(txid_merkle_link=dict(branch=[], index=0), wtxid_merkle_root=2**256-1), pack.ComposedType([
             ('txid_merkle_link', pack.ComposedType([
@@ -135,10 +167,20 @@ class BaseShare(object):
             ('identifier', pack.FixedStrType(64//8)),
             ('share_info', t['share_info_type']),
         ])
+        cls._dynamic_types[cls, net] = t
         return t
 
     @classmethod
-    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None):
+    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None, merkle_trees=None):
+        return cls.generate_transaction_template(tracker, share_data, block_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net,
+            known_txs=known_txs, base_subsidy=base_subsidy, segwit_data=segwit_data, merkle_trees=merkle_trees,
+        )(share_data['nonce'], desired_timestamp, desired_target, last_txout_nonce)
+    
+    @classmethod
+    def generate_transaction_template(cls, tracker, share_data, block_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, base_subsidy=None, segwit_data=None, merkle_trees=None):
+        '''Does the part of generate_transaction that doesn't depend on the share's nonce, timestamp and target. Returns
+        a function taking those (and last_txout_nonce) that returns what generate_transaction would.'''
+        
         previous_share = tracker.items[share_data['previous_share_hash']] if share_data['previous_share_hash'] is not None else None
         
         height, last = tracker.get_height_and_last(share_data['previous_share_hash'])
@@ -151,7 +193,6 @@ class BaseShare(object):
             pre_target2 = math.clip(pre_target, (previous_share.max_target*9//10, previous_share.max_target*11//10))
             pre_target3 = math.clip(pre_target2, (net.MIN_TARGET, net.MAX_TARGET))
         max_bits = bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3)
-        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
         
         new_transaction_hashes = []
         new_transaction_size = 0
@@ -210,60 +251,67 @@ class BaseShare(object):
             raise ValueError('segwit transaction included before activation')
         if segwit_activated and known_txs is not None:
             share_txs = [(known_txs[h], bitcoin_data.get_txid(known_txs[h]), h) for h in other_transaction_hashes]
-            segwit_data = dict(txid_merkle_link=bitcoin_data.calculate_merkle_link([None] + [tx[1] for tx in share_txs], 0), wtxid_merkle_root=bitcoin_data.merkle_hash([0] + [bitcoin_data.get_wtxid(tx[0], tx[1], tx[2]) for tx in share_txs]))
+            if merkle_trees is None:
+                merkle_trees = dict(txid=bitcoin_data.MerkleTree(), wtxid=bitcoin_data.MerkleTree())
+            segwit_data = dict(txid_merkle_link=merkle_trees['txid'].update([None] + [tx[1] for tx in share_txs]).get_link(0), wtxid_merkle_root=merkle_trees['wtxid'].update([0] + [bitcoin_data.get_wtxid(tx[0], tx[1], tx[2]) for tx in share_txs]).root)
         if segwit_activated and segwit_data is not None:
             witness_reserved_value_str = '[P2Pool]'*4
             witness_reserved_value = pack.IntType(256).unpack(witness_reserved_value_str)
             witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], witness_reserved_value)
 
-        share_info = dict(
-            share_data=share_data,
-            far_share_hash=None if last is None and height < 99 else tracker.get_nth_parent_hash(share_data['previous_share_hash'], 99),
-            max_bits=max_bits,
-            bits=bits,
-            timestamp=math.clip(desired_timestamp, (
-                (previous_share.timestamp + net.SHARE_PERIOD) - (net.SHARE_PERIOD - 1), # = previous_share.timestamp + 1
-                (previous_share.timestamp + net.SHARE_PERIOD) + (net.SHARE_PERIOD - 1),
-            )) if previous_share is not None else desired_timestamp,
-            new_transaction_hashes=new_transaction_hashes,
-            transaction_hash_refs=transaction_hash_refs,
-            absheight=((previous_share.absheight if previous_share is not None else 0) + 1) % 2**32,
-            abswork=((previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(bits.target)) % 2**128,
-        )
-        if segwit_activated:
-            share_info['segwit_data'] = segwit_data
-        
-        gentx = dict(
-            version=1,
-            tx_ins=[dict(
-                previous_output=None,
-                sequence=None,
-                script=share_data['coinbase'],
-            )],
-            tx_outs=([dict(value=0, script='\x6a\x24\xaa\x21\xa9\xed' + pack.IntType(256).pack(witness_commitment_hash))] if segwit_activated else []) +
-                [dict(value=amounts[script], script=script) for script in dests if amounts[script] or script == DONATION_SCRIPT] +
-                [dict(value=0, script='\x6a\x28' + cls.get_ref_hash(net, share_info, ref_merkle_link) + pack.IntType(64).pack(last_txout_nonce))],
-            lock_time=0,
-        )
-        if segwit_activated:
-            gentx['marker'] = 0
-            gentx['flag'] = 1
-            gentx['witness'] = [[witness_reserved_value_str]]
-        
-        def get_share(header, last_txout_nonce=last_txout_nonce):
-            min_header = dict(header); del min_header['merkle_root']
-            share = cls(net, None, dict(
-                min_header=min_header,
-                share_info=share_info,
-                ref_merkle_link=dict(branch=[], index=0),
-                last_txout_nonce=last_txout_nonce,
-                hash_link=prefix_to_hash_link(bitcoin_data.tx_id_type.pack(gentx)[:-32-8-4], cls.gentx_before_refhash),
-                merkle_link=bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0),
-            ))
-            assert share.header == header # checks merkle_root
-            return share
-        
-        return share_info, gentx, other_transaction_hashes, get_share
+        far_share_hash = None if last is None and height < 99 else tracker.get_nth_parent_hash(share_data['previous_share_hash'], 99)
+        tx_outs = ([dict(value=0, script='\x6a\x24\xaa\x21\xa9\xed' + pack.IntType(256).pack(witness_commitment_hash))] if segwit_activated else []) + \
+            [dict(value=amounts[script], script=script) for script in dests if amounts[script] or script == DONATION_SCRIPT]
+        
+        def finish(nonce, desired_timestamp, desired_target, last_txout_nonce=0):
+            bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
+            share_info = dict(
+                share_data=dict(share_data, nonce=nonce),
+                far_share_hash=far_share_hash,
+                max_bits=max_bits,
+                bits=bits,
+                timestamp=math.clip(desired_timestamp, (
+                    (previous_share.timestamp + net.SHARE_PERIOD) - (net.SHARE_PERIOD - 1), # = previous_share.timestamp + 1
+                    (previous_share.timestamp + net.SHARE_PERIOD) + (net.SHARE_PERIOD - 1),
+                )) if previous_share is not None else desired_timestamp,
+                new_transaction_hashes=new_transaction_hashes,
+                transaction_hash_refs=transaction_hash_refs,
+                absheight=((previous_share.absheight if previous_share is not None else 0) + 1) % 2**32,
+                abswork=((previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(bits.target)) % 2**128,
+            )
+            if segwit_activated:
+                share_info['segwit_data'] = segwit_data
+            
+            gentx = dict(
+                version=1,
+                tx_ins=[dict(
+                    previous_output=None,
+                    sequence=None,
+                    script=share_data['coinbase'],
+                )],
+                tx_outs=tx_outs + [dict(value=0, script='\x6a\x28' + cls.get_ref_hash(net, share_info, ref_merkle_link) + pack.IntType(64).pack(last_txout_nonce))],
+                lock_time=0,
+            )
+            if segwit_activated:
+                gentx['marker'] = 0
+                gentx['flag'] = 1
+                gentx['witness'] = [[witness_reserved_value_str]]
+            
+            def get_share(header, last_txout_nonce=last_txout_nonce):
+                min_header = dict(header); del min_header['merkle_root']
+                share = cls(net, None, dict(
+                    min_header=min_header,
+                    share_info=share_info,
+                    ref_merkle_link=dict(branch=[], index=0),
+                    last_txout_nonce=last_txout_nonce,
+                    hash_link=prefix_to_hash_link(bitcoin_data.tx_id_type.pack(gentx)[:-32-8-4], cls.gentx_before_refhash),
+                    merkle_link=bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0),
+                ))
+                assert share.header == header # checks merkle_root
+                return share
+            
+            return share_info, gentx, other_transaction_hashes, get_share
+        return finish
     
     @classmethod
     def get_ref_hash(cls, net, share_info, ref_merkle_link):
@@ -272,14 +320,55 @@ class BaseShare(object):
             share_info=share_info,
         ))), ref_merkle_link))
     
-    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork'.split(' ')
+    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target work timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork _lazy_contents'.split(' ')
     
-    def __init__(self, net, peer_addr, contents):
-        dynamic_types = self.get_dynamic_types(net)
-        self.share_info_type = dynamic_types['share_info_type']
-        self.share_type = dynamic_types['share_type']
-        self.ref_type = dynamic_types['ref_type']
-
+    @classmethod
+    def lazy(cls, net, share_hash, packed_contents, pow_cache=None):
+        # only decodes what's needed to add the share to a tracker and compute payouts, trusting share_hash.
+        # everything else (including the PoW check) is done by __init__ the first time it's accessed
+        self = cls.__new__(cls)
+        self._lazy_contents = packed_contents, pow_cache
+        self.net = net
+        self.peer_addr = None
+        
+        min_header, file = cls.small_block_header_type.read((packed_contents, 0))
+        share_info, _ = cls.get_dynamic_types(net)['share_info_type'].read(file)
+        
+        self.hash = share_hash
+        self.share_data = share_info['share_data']
+        self.share_data['pubkey_hash'] = intern_value(self.share_data['pubkey_hash'])
+        self.max_target = share_info['max_bits'].target
+        self.target = share_info['bits'].target
+        self.work = bitcoin_data.target_to_average_attempts(self.target)
+        self.timestamp = share_info['timestamp']
+        self.previous_hash = self.share_data['previous_share_hash']
+        self.new_script = intern_value(bitcoin_data.pubkey_hash_to_script2(self.share_data['pubkey_hash'], self.share_data['pubkey_hash_version'], net.PARENT))
+        self.desired_version = self.share_data['desired_version']
+        self.new_transaction_hashes = share_info['new_transaction_hashes']
+        self.time_seen = time.time()
+        return self
+    
+    def __getattr__(self, attr):
+        # only called for attributes that haven't been set, which for a lazy share means it needs to be materialized
+        if attr.startswith('__') or attr == '_lazy_contents' or self._lazy_contents is None:
+            raise AttributeError(attr)
+        packed_contents, pow_cache = self._lazy_contents
+        # built separately, so a share that fails stays lazy and fails the same way on every access
+        try:
+            share = type(self)(self.net, self.peer_addr, self.get_dynamic_types(self.net)['share_type'].unpack(packed_contents), pow_cache)
+            if share.hash != self.hash:
+                raise ValueError('does not match its stored hash')
+        except Exception, e:
+            raise LazyShareError(self.hash, e)
+        share.time_seen = self.time_seen
+        for slot in BaseShare.__slots__:
+            setattr(self, slot, getattr(share, slot))
+        return getattr(self, attr)
+    
+    def __init__(self, net, peer_addr, contents, pow_cache=None):
+        # pow_cache should only be passed for shares whose PoW was already verified once, like those from our ShareStore
+        self._lazy_contents = None
+        
         self.net = net
         self.peer_addr = peer_addr
         self.contents = contents
@@ -300,11 +389,13 @@ class BaseShare(object):
         assert not self.hash_link['extra_data'], repr(self.hash_link['extra_data'])
         
         self.share_data = self.share_info['share_data']
+        self.share_data['pubkey_hash'] = intern_value(self.share_data['pubkey_hash'])
         self.max_target = self.share_info['max_bits'].target
         self.target = self.share_info['bits'].target
+        self.work = bitcoin_data.target_to_average_attempts(self.target)
         self.timestamp = self.share_info['timestamp']
         self.previous_hash = self.share_data['previous_share_hash']
-        self.new_script = bitcoin_data.pubkey_hash_to_script2(self.share_data['pubkey_hash'], self.share_data['pubkey_hash_version'], net.PARENT)
+        self.new_script = intern_value(bitcoin_data.pubkey_hash_to_script2(self.share_data['pubkey_hash'], self.share_data['pubkey_hash_version'], net.PARENT))
         self.desired_version = self.share_data['desired_version']
         self.absheight = self.share_info['absheight']
         self.abswork = self.share_info['abswork']
@@ -322,9 +413,15 @@ class BaseShare(object):
             self.gentx_before_refhash,
         )
         merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, self.share_info['segwit_data']['txid_merkle_link'] if segwit_activated else self.merkle_link)
-        self.header = dict(self.min_header, merkle_root=merkle_root)
-        self.pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header))
-        self.hash = self.header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(self.header))
+        self.header = bitcoin_data.block_header_type.record_type()
+        for key in self.min_header.keys():
+            self.header[key] = self.min_header[key]
+        self.header['merkle_root'] = merkle_root
+        packed_header = bitcoin_data.block_header_type.pack(self.header)
+        self.hash = self.header_hash = bitcoin_data.hash256(packed_header)
+        self.pow_hash = pow_cache.get(self.header_hash) if pow_cache is not None else None
+        if self.pow_hash is None:
+            self.pow_hash = net.PARENT.POW_FUNC(packed_header)
         
         if self.target > net.MAX_TARGET:
             from p2pool import p2p
@@ -334,6 +431,9 @@ class BaseShare(object):
             from p2pool import p2p
             raise p2p.PeerMisbehavingError('share PoW invalid')
         
+        if pow_cache is not None:
+            pow_cache.add(self.header_hash, self.pow_hash)
+        
         self.new_transaction_hashes = self.share_info['new_transaction_hashes']
         
         # XXX eww
@@ -343,6 +443,8 @@ class BaseShare(object):
         return 'Share' + repr((self.net, self.peer_addr, self.contents))
     
     def as_share(self):
+        if self._lazy_contents is not None:
+            return dict(type=self.VERSION, contents=self._lazy_contents[0])
         return dict(type=self.VERSION, contents=self.share_type.pack(self.contents))
     
     def iter_transaction_hash_refs(self):
@@ -367,7 +469,7 @@ class BaseShare(object):
                 raise p2p.PeerMisbehavingError('switch without enough history')
         
         other_tx_hashes = [tracker.items[tracker.get_nth_parent_hash(self.hash, share_count)].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
-        if other_txs is not None and not isinstance(other_txs, dict): other_txs = dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in other_txs)
+        if other_txs is not None and not isinstance(other_txs, dict): other_txs = dict((bitcoin_data.get_tx_hash(tx), tx) for tx in other_txs)
         
         share_info, gentx, other_tx_hashes2, get_share = self.generate_transaction(tracker, self.share_info['share_data'], self.header['bits'].target, self.share_info['timestamp'], self.share_info['bits'].target, self.contents['ref_merkle_link'], [(h, None) for h in other_tx_hashes], self.net,
             known_txs=other_txs, last_txout_nonce=self.contents['last_txout_nonce'], segwit_data=self.share_info.get('segwit_data', None))
@@ -414,7 +516,7 @@ class BaseShare(object):
             pass
         else:
             all_txs_size = sum(bitcoin_data.tx_type.packed_size(tx) for tx in other_txs)
-            stripped_txs_size = sum(bitcoin_data.tx_id_type.packed_size(tx) for tx in other_txs)
+            stripped_txs_size = sum(bitcoin_data.get_stripped_size(tx) for tx in other_txs)
             if all_txs_size + 3 * stripped_txs_size > self.MAX_BLOCK_WEIGHT:
                 return True, 'txs over block size limit'
             
@@ -431,12 +533,16 @@ class BaseShare(object):
         return dict(header=self.header, txs=[self.check(tracker, other_txs)] + other_txs)
 
 class NewShare(BaseShare):
+    __slots__ = []
+    
     VERSION = 17
     VOTING_VERSION = 17
     SUCCESSOR = None
     MAX_NEW_TXS_SIZE = 100000
 
 class Share(BaseShare):
+    __slots__ = []
+    
     VERSION = 16
     VOTING_VERSION = 16
     SUCCESSOR = NewShare
@@ -479,17 +585,171 @@ class WeightsSkipList(forest.TrackerSkipList):
         assert share_count == max_shares or total_weight == desired_weight
         return math.add_dicts(*math.flatten_linked_list(weights_list)), total_weight, total_donation_weight
 
+class WeightsWindow(object):
+    '''Answers get_cumulative_weights queries for one max_shares. It keeps the shares counting back from the last start
+    it was asked about, fetched only as far as a query needed them, and sums over the leading ones that fit entirely in
+    the last desired_weight. Moving the start a few shares up or down the chain (new best shares, or think() verifying
+    a chain share by share) and changing desired_weight or max_shares a little only touch the shares moving in or out.'''
+    
+    max_advance = 100
+    
+    def __init__(self, tracker, max_shares):
+        self.tracker = tracker
+        self.max_shares = max_shares
+        self.desired_weight = 0
+        self._rebuild(None)
+    
+    def _rebuild(self, start):
+        self.start = start
+        self.entries = {} # serial -> (hash, previous_hash, script, weight, total_weight, donation_weight), older shares have higher serials
+        self.serials = {} # hash -> serial
+        self.front = self.back = self.cut = 0 # entries are [front, back), and the ones in [front, cut) are summed
+        self.weights = {}
+        self.total_weight = self.donation_weight = 0
+    
+    def _get_entry(self, share):
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        return share.hash, share.previous_hash, share.new_script, att*(65535-share.share_data['donation']), att*65535, att*share.share_data['donation']
+    
+    def _add(self, entry, sign):
+        share_hash, previous_hash, script, weight, total_weight, donation_weight = entry
+        if weight:
+            new_weight = self.weights.get(script, 0) + sign*weight
+            if new_weight:
+                self.weights[script] = new_weight
+            else:
+                del self.weights[script]
+        self.total_weight += sign*total_weight
+        self.donation_weight += sign*donation_weight
+    
+    def _push_front(self, share):
+        self.front -= 1
+        entry = self.entries[self.front] = self._get_entry(share)
+        self.serials[share.hash] = self.front
+        self._add(entry, 1)
+    
+    def _pop_front(self):
+        entry = self.entries.pop(self.front)
+        del self.serials[entry[0]]
+        if self.front < self.cut:
+            self._add(entry, -1)
+        else:
+            self.cut += 1
+        self.front += 1
+    
+    def _push_back(self):
+        if self.back - self.front >= self.max_shares:
+            return False
+        share_hash = self.entries[self.back - 1][1] if self.back != self.front else self.start
+        if share_hash not in self.tracker.items:
+            return False
+        self.entries[self.back] = self._get_entry(self.tracker.items[share_hash])
+        self.serials[share_hash] = self.back
+        self.back += 1
+        return True
+    
+    def _pop_back(self):
+        self.back -= 1
+        entry = self.entries.pop(self.back)
+        del self.serials[entry[0]]
+        if self.cut > self.back:
+            self.cut = self.back
+            self._add(entry, -1)
+    
+    def _move(self, start):
+        if start in self.serials: # an ancestor
+            while self.front != self.serials[start]:
+                self._pop_front()
+            self.start = start
+            return
+        
+        new_shares = []
+        share_hash = start
+        while share_hash != self.start:
+            if self.front == self.back or len(new_shares) == self.max_advance or share_hash not in self.tracker.items:
+                self._rebuild(start)
+                return
+            share = self.tracker.items[share_hash]
+            new_shares.append(share)
+            share_hash = share.previous_hash
+        for share in reversed(new_shares):
+            self._push_front(share)
+        while self.back - self.front > self.max_shares:
+            self._pop_back()
+        self.start = start
+    
+    def resize(self, max_shares):
+        self.max_shares = max_shares
+        while self.back - self.front > max_shares:
+            self._pop_back()
+    
+    def __call__(self, start, desired_weight):
+        assert desired_weight % 65535 == 0, divmod(desired_weight, 65535)
+        if start != self.start:
+            self._move(start)
+        self.desired_weight = desired_weight
+        
+        while self.total_weight > desired_weight:
+            self.cut -= 1
+            self._add(self.entries[self.cut], -1)
+        while (self.cut != self.back or self._push_back()) and self.total_weight + self.entries[self.cut][4] <= desired_weight:
+            self._add(self.entries[self.cut], 1)
+            self.cut += 1
+        
+        weights = dict(self.weights)
+        if self.cut == self.back or self.total_weight == desired_weight:
+            return weights, self.total_weight, self.donation_weight
+        
+        # only part of the next share fits
+        share_hash, previous_hash, script, weight, total_weight, donation_weight = self.entries[self.cut]
+        remaining = (desired_weight - self.total_weight)//65535
+        new_weight = weights.get(script, 0) + remaining*weight//(total_weight//65535)
+        if new_weight:
+            weights[script] = new_weight
+        return weights, desired_weight, self.donation_weight + remaining*donation_weight//(total_weight//65535)
+
+# desired versions whose votes get their own OkayTracker delta attribute. votes for others are counted by walking
+COUNTED_VERSIONS = sorted(set(cls.VOTING_VERSION for cls in [Share, NewShare]))
+
 class OkayTracker(forest.Tracker):
-    def __init__(self, net):
-        forest.Tracker.__init__(self, delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
-            work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
+    def __init__(self, net, compact=False):
+        attrs = dict(forest.AttributeDelta.attrs,
+            work=lambda share: share.work,
             min_work=lambda share: bitcoin_data.target_to_average_attempts(share.max_target),
-        )))
+            stale_count=lambda share: 1 if share.share_data['stale_info'] is not None else 0,
+            stale_work=lambda share: share.work if share.share_data['stale_info'] is not None else 0,
+            orphan_work=lambda share: share.work if share.share_data['stale_info'] == 'orphan' else 0,
+            doa_work=lambda share: share.work if share.share_data['stale_info'] == 'doa' else 0,
+        )
+        for version in COUNTED_VERSIONS:
+            attrs['version%i_work' % (version,)] = lambda share, version=version: share.work if share.desired_version == version else 0
+        forest.Tracker.__init__(self, delta_type=forest.get_attributedelta_type(attrs), compact=compact)
         self.net = net
         self.verified = forest.SubsetTracker(delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
-            work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
-        )), subset_of=self)
-        self.get_cumulative_weights = WeightsSkipList(self)
+            work=lambda share: share.work,
+        )), subset_of=self, compact=compact)
+        self.weights_windows = {} # max_shares -> WeightsWindow
+        self.removed.watch(self._forget_weights_windows)
+    
+    def get_cumulative_weights(self, start, max_shares, desired_weight):
+        window = self.weights_windows.get(max_shares)
+        if window is None:
+            # max_shares follows the height of a short chain, so take over the window of a close max_shares
+            close = [x for x in self.weights_windows if abs(x - max_shares) <= WeightsWindow.max_advance]
+            if close:
+                window = self.weights_windows.pop(min(close, key=lambda x: abs(x - max_shares)))
+                window.resize(max_shares)
+            else:
+                if len(self.weights_windows) >= 8:
+                    self.weights_windows.clear()
+                window = WeightsWindow(self, max_shares)
+            self.weights_windows[max_shares] = window
+        return window(start, desired_weight)
+    
+    def _forget_weights_windows(self, share):
+        for max_shares, window in self.weights_windows.items():
+            if share.hash in window.serials:
+                del self.weights_windows[max_shares]
     
     def attempt_verify(self, share):
         if share.hash in self.verified.items:
@@ -500,13 +760,33 @@ class OkayTracker(forest.Tracker):
         try:
             share.check(self)
         except:
+            if isinstance(sys.exc_info()[1], LazyShareError) and sys.exc_info()[1].share_hash != share.hash:
+                raise # a broken ancestor, which think drops
             log.err(None, 'Share check failed: %064x -> %064x' % (share.hash, share.previous_hash if share.previous_hash is not None else 0))
             return False
         else:
             self.verified.add(share)
             return True
     
+    def remove_with_descendants(self, share_hash):
+        to_remove = [share_hash]
+        for h in to_remove:
+            to_remove.extend(self.reverse.get(h, set()))
+        for h in reversed(to_remove): # children first, so each is a head when it's removed
+            if h in self.verified.items:
+                self.verified.remove(h)
+            self.remove(h)
+    
     def think(self, block_rel_height_func, previous_block, bits, known_txs):
+        # stored shares are loaded lazily, so this is where one whose stored contents are broken is first used
+        while True:
+            try:
+                return self._think(block_rel_height_func, previous_block, bits, known_txs)
+            except LazyShareError, e:
+                print >>sys.stderr, '%s, dropping it and its descendants' % (e,)
+                self.remove_with_descendants(e.share_hash)
+    
+    def _think(self, block_rel_height_func, previous_block, bits, known_txs):
         desired = set()
         bad_peer_addresses = set()
         
@@ -639,17 +919,24 @@ def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=Fa
         return attempts//time
     return attempts/time
 
+def get_chain_delta(tracker, share_hash, length):
+    # OkayTracker delta over the shares tracker.get_chain(share_hash, length) would return
+    assert length <= tracker.get_height(share_hash)
+    return tracker.get_delta(share_hash, tracker.get_nth_parent_hash(share_hash, length))
+
 def get_average_stale_prop(tracker, share_hash, lookbehind):
-    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    stales = get_chain_delta(tracker, share_hash, lookbehind).stale_count
     return stales/(lookbehind + stales)
 
 def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
-    res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
-        s = share.share_data['stale_info']
-        if s is not None:
-            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    delta = get_chain_delta(tracker, share_hash, lookbehind - 1)
+    res = dict((k, v) for k, v in [('orphan', delta.orphan_work), ('doa', delta.doa_work)] if v)
+    if delta.height:
+        res['good'] = delta.work
+    if delta.stale_work != delta.orphan_work + delta.doa_work: # other stale_info values don't have an attribute
+        for share in tracker.get_chain(share_hash, lookbehind - 1):
+            if share.share_data['stale_info'] not in [None, 'orphan', 'doa']:
+                res[share.share_data['stale_info']] = res.get(share.share_data['stale_info'], 0) + share.work
     if rates:
         dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
         res = dict((k, v/dt) for k, v in res.iteritems())
@@ -673,9 +960,13 @@ def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     return res
 
 def get_desired_version_counts(tracker, best_share_hash, dist):
-    res = {}
-    for share in tracker.get_chain(best_share_hash, dist):
-        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    delta = get_chain_delta(tracker, best_share_hash, dist)
+    res = dict((version, getattr(delta, 'version%i_work' % (version,))) for version in COUNTED_VERSIONS)
+    res = dict((version, work) for version, work in res.iteritems() if work)
+    if sum(res.itervalues()) != delta.work: # votes for versions that don't have an attribute
+        for share in tracker.get_chain(best_share_hash, dist):
+            if share.desired_version not in COUNTED_VERSIONS:
+                res[share.desired_version] = res.get(share.desired_version, 0) + share.work
     return res
 
 def get_warnings(tracker, best_share, net, bitcoind_getinfo, bitcoind_work_value):
@@ -707,102 +998,497 @@ def format_hash(x):
         return 'xxxxxxxx'
     return '%08x' % (x % 2**32)
 
+# share store files: a magic header, then length-prefixed records, then (once
+# the file is full) an index of the records it contains and a fixed-size trailer
+
+SHARE_STORE_MAGIC = 'P2PSHR\x00\x01'
+SHARE_STORE_INDEX_MAGIC = 'P2PIDX\x00\x01'
+
+share_store_record_type = pack.ComposedType([
+    ('type', pack.IntType(8)), # 2 = verified hash, 5 = share
+    ('hash', pack.IntType(256)),
+    ('data', pack.VarStrType()), # packed share_type for shares, empty for verified hashes
+])
+
+share_store_index_type = pack.ListType(pack.ComposedType([
+    ('hash', pack.IntType(256)),
+    ('offset', pack.PossiblyNoneType(0, pack.IntType(32))), # of the share record, if the share is in this file
+    ('verified', pack.IntType(8)),
+]))
+
+share_store_trailer_type = pack.ComposedType([
+    ('index_offset', pack.IntType(32)),
+    ('magic', pack.FixedStrType(8)),
+])
+share_store_trailer_size = len(share_store_trailer_type.pack(dict(index_offset=0, magic=SHARE_STORE_INDEX_MAGIC)))
+
+pow_cache_entry_type = pack.ComposedType([
+    ('header_hash', pack.IntType(256)),
+    ('pow_hash', pack.IntType(256)),
+])
+pow_cache_entry_size = len(pow_cache_entry_type.pack(dict(header_hash=0, pow_hash=0)))
+
+class PowHashCache(object):
+    '''
+    header hash -> PoW hash of shares that were already verified, persisted as
+    an append-only file of fixed-size entries. new entries are written by flush
+    '''
+    
+    def __init__(self, filename, trusted=True):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.pending = []
+        
+        self.pow_hashes = {}
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                data = f.read()
+            for pos in xrange(0, len(data) - len(data) % pow_cache_entry_size, pow_cache_entry_size):
+                entry = pow_cache_entry_type.unpack(data[pos:pos + pow_cache_entry_size])
+                self.pow_hashes[entry['header_hash']] = entry['pow_hash']
+            if len(data) % pow_cache_entry_size:
+                self._rewrite()
+        self.untrusted = set() if trusted else set(self.pow_hashes) # entries from disk that have to be recomputed before being used
+    
+    def __contains__(self, header_hash):
+        return header_hash in self.pow_hashes and header_hash not in self.untrusted
+    
+    def get(self, header_hash):
+        pow_hash = self.pow_hashes[header_hash] if header_hash in self else None
+        if pow_hash is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return pow_hash
+    
+    def add(self, header_hash, pow_hash):
+        self.untrusted.discard(header_hash)
+        if self.pow_hashes.get(header_hash) == pow_hash:
+            return
+        self.pow_hashes[header_hash] = pow_hash
+        self.pending.append(pow_cache_entry_type.pack(dict(header_hash=header_hash, pow_hash=pow_hash)))
+    
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.filename, 'ab') as f:
+            f.write(''.join(self.pending))
+        self.pending = []
+    
+    def prune(self, header_hashes):
+        removed = set(self.pow_hashes) - set(header_hashes)
+        if removed:
+            for header_hash in removed:
+                del self.pow_hashes[header_hash]
+                self.untrusted.discard(header_hash)
+            self._rewrite()
+    
+    def _rewrite(self):
+        self.pending = []
+        with open(self.filename + '.new', 'wb') as f:
+            f.write(''.join(pow_cache_entry_type.pack(dict(header_hash=header_hash, pow_hash=pow_hash)) for header_hash, pow_hash in self.pow_hashes.iteritems()))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(self.filename + '.new', self.filename)
+        except: # XXX windows can't overwrite
+            os.remove(self.filename)
+            os.rename(self.filename + '.new', self.filename)
+
+def _get_net_params(net):
+    # enough to rebuild net in another process without importing it by name, which neither works under spawn for nets
+    # that were only registered in this process nor for the functions in it, which can't be pickled
+    return net.PARENT.NAME, dict((k, v) for k, v in net.__dict__.iteritems()
+        if not k.startswith('_') and k != 'PARENT' and isinstance(v, (int, long, float, str, bool, type(None), tuple, list, set, frozenset)))
+
+_share_check_net = None
+
+def _init_share_checker((parent_name, attrs)):
+    # runs in a worker process, once
+    global _share_check_net
+    from p2pool.bitcoin import networks as bitcoin_networks
+    net = types.ModuleType(attrs['NAME'])
+    net.__dict__.update(attrs)
+    net.PARENT = bitcoin_networks.nets[parent_name]
+    _share_check_net = net
+
+def make_share_check_pool(net, processes):
+    '''
+    process pool for ShareStore to verify stored shares with. it has to be
+    created before the reactor starts, so the workers don't inherit a running one
+    '''
+    return multiprocessing.Pool(processes, _init_share_checker, (_get_net_params(net),))
+
+def _check_stored_shares(records):
+    # runs in a worker process. returns (hash, PoW hash) for every valid share and None for the rest
+    res = []
+    for record_data in records:
+        try:
+            share = load_share(share_type.unpack(record_data), _share_check_net, None)
+        except Exception:
+            res.append(None)
+        else:
+            res.append((share.hash, share.pow_hash))
+    return res
+
 class ShareStore(object):
-    def __init__(self, prefix, net, share_cb, verified_hash_cb):
+    max_file_size = 10e6
+    compact_live_fraction = .25 # sealed files with at most this fraction of their records still wanted get rewritten
+    
+    def __init__(self, prefix, net, share_cb, verified_hash_cb, verify_pow=False, pool=None):
         self.dirname = os.path.dirname(os.path.abspath(prefix))
         self.filename = os.path.basename(os.path.abspath(prefix))
         self.net = net
+        self.pow_cache = PowHashCache(os.path.join(self.dirname, self.filename + 'pow'), trusted=not verify_pow)
         
         known = {}
+        self.share_files = {} # share hash -> filename
+        self.verified_files = {} # verified hash -> filename
+        self.open_indexes = {} # filename -> {hash: (share record offset, verified)} for files that aren't sealed yet
         filenames, next = self.get_filenames_and_next()
+        self.next_suffix = int(os.path.basename(next)[len(self.filename):])
+        for filename in filenames:
+            if os.path.exists(filename + '.new'): # left over from an interrupted rewrite
+                os.remove(filename + '.new')
+        files = []
         for filename in filenames:
-            share_hashes, verified_hashes = known.setdefault(filename, (set(), set()))
             with open(filename, 'rb') as f:
-                for line in f:
-                    try:
-                        type_id_str, data_hex = line.strip().split(' ')
-                        type_id = int(type_id_str)
-                        if type_id == 0:
-                            pass
-                        elif type_id == 1:
-                            pass
-                        elif type_id == 2:
-                            verified_hash = int(data_hex, 16)
-                            verified_hash_cb(verified_hash)
-                            verified_hashes.add(verified_hash)
-                        elif type_id == 5:
-                            raw_share = share_type.unpack(data_hex.decode('hex'))
-                            if raw_share['type'] < Share.VERSION:
-                                continue
-                            share = load_share(raw_share, self.net, None)
-                            share_cb(share)
-                            share_hashes.add(share.hash)
+                is_text = f.read(len(SHARE_STORE_MAGIC)) != SHARE_STORE_MAGIC
+                f.seek(0)
+                files.append((filename, is_text, list(self._read_text_records(f.read()) if is_text else self._read_records(filename, f))))
+        
+        # with a pool from make_share_check_pool, every share whose PoW hash isn't cached is checked up front by it
+        # instead of lazily
+        checked = self._check_shares(files, pool) if pool is not None else {}
+        
+        for i, (filename, is_text, records) in enumerate(files):
+            share_hashes, verified_hashes = known.setdefault(filename, (set(), set()))
+            loaded = []
+            for j, (type_id, share_hash, record_data) in enumerate(records):
+                try:
+                    if type_id == 2:
+                        if share_hash in self.verified_files:
+                            continue
+                        verified_hash_cb(share_hash)
+                        verified_hashes.add(share_hash)
+                        self.verified_files[share_hash] = filename
+                    elif type_id == 5:
+                        raw_share = share_type.unpack(record_data)
+                        if raw_share['type'] < Share.VERSION:
+                            continue
+                        if (i, j) in checked:
+                            if checked[i, j] is None:
+                                raise ValueError('stored share failed verification')
+                            checked_hash, pow_hash = checked[i, j]
+                            if share_hash is not None and checked_hash != share_hash:
+                                raise ValueError('stored share hash mismatch')
+                            share_hash = checked_hash
+                            self.pow_cache.add(share_hash, pow_hash)
+                        if share_hash is None or (verify_pow and (i, j) not in checked):
+                            # fully loaded, so with verify_pow its PoW is recomputed now
+                            share = load_share(raw_share, self.net, None, self.pow_cache)
+                            if share_hash is not None and share.hash != share_hash:
+                                raise ValueError('stored share hash mismatch')
+                            share_hash = share.hash
                         else:
-                            raise NotImplementedError("share type %i" % (type_id,))
-                    except Exception:
-                        log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+                            share = load_lazy_share(raw_share, self.net, share_hash, self.pow_cache)
+                        if share_hash in self.share_files:
+                            continue
+                        share_cb(share)
+                        share_hashes.add(share_hash)
+                        self.share_files[share_hash] = filename
+                    else:
+                        raise NotImplementedError("share type %i" % (type_id,))
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+                else:
+                    loaded.append((type_id, share_hash, record_data))
+            if is_text:
+                self._write_sealed_file(filename, loaded)
+                print 'Converted %s to the binary share store format' % (filename,)
+        # records are queued and appended by flush through one cached handle to the last file until it's sealed
+        self.pending_writes = [] # [(filename, [data, ...]), ...]
+        self.active_filename = self.active_file = self.active_size = None
+        for filename in self.open_indexes.keys():
+            if filename != filenames[-1]:
+                self._seal(filename)
+        if filenames and filenames[-1] in self.open_indexes:
+            self.active_filename = filenames[-1]
+            self.active_size = os.path.getsize(filenames[-1])
         
         self.known = known # filename -> (set of share hashes, set of verified hashes)
         self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in known.iteritems())
+        self.pow_cache.prune(share_hash for share_hashes, verified_hashes in known.itervalues() for share_hash in share_hashes)
+        self.pow_cache.flush()
     
-    def _add_line(self, line):
-        filenames, next = self.get_filenames_and_next()
-        if filenames and os.path.getsize(filenames[-1]) < 10e6:
-            filename = filenames[-1]
+    def _check_shares(self, files, pool, chunk_size=250):
+        to_check = [(i, j) for i, (filename, is_text, records) in enumerate(files) for j, (type_id, share_hash, record_data) in enumerate(records)
+            if type_id == 5 and (share_hash is None or share_hash not in self.pow_cache)]
+        if not to_check:
+            return {}
+        print '    Verifying %i shares in worker processes...' % (len(to_check),)
+        chunks = [[files[i][2][j][2] for i, j in to_check[pos:pos + chunk_size]] for pos in xrange(0, len(to_check), chunk_size)]
+        results = [result for chunk_results in pool.map(_check_stored_shares, chunks) for result in chunk_results]
+        return dict(zip(to_check, results))
+    
+    def _read_text_records(self, data):
+        for line in data.splitlines():
+            try:
+                type_id_str, data_hex = line.strip().split(' ')
+                type_id = int(type_id_str)
+                if type_id == 0:
+                    pass
+                elif type_id == 1:
+                    pass
+                elif type_id == 2:
+                    yield 2, int(data_hex, 16), ''
+                elif type_id == 5:
+                    yield 5, None, data_hex.decode('hex')
+                else:
+                    raise NotImplementedError("share type %i" % (type_id,))
+            except Exception:
+                log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+    
+    def _read_record_at(self, f, offset):
+        # type, hash and the data's length prefix fit in the first 42 bytes of a record
+        f.seek(offset)
+        buf = f.read(1 + 32 + 9)
+        length, (_, data_pos) = pack.VarIntType().read((buf, 1 + 32))
+        if data_pos + length > len(buf):
+            buf += f.read(data_pos + length - len(buf))
+        record, _ = share_store_record_type.read((buf, 0))
+        return record
+    
+    def _read_records(self, filename, f):
+        records = []
+        f.seek(0, 2)
+        size = f.tell()
+        if size >= len(SHARE_STORE_MAGIC) + share_store_trailer_size:
+            f.seek(size - share_store_trailer_size)
+            trailer_data = f.read(share_store_trailer_size)
+        else:
+            trailer_data = ''
+        if trailer_data.endswith(SHARE_STORE_INDEX_MAGIC):
+            # sealed, so only the index is read in full and every share record is read from its offset
+            try:
+                trailer = share_store_trailer_type.unpack(trailer_data)
+                f.seek(trailer['index_offset'])
+                for entry in share_store_index_type.unpack(f.read(size - share_store_trailer_size - trailer['index_offset'])):
+                    if entry['offset'] is not None:
+                        record = self._read_record_at(f, entry['offset'])
+                        if (record['type'], record['hash']) != (5, entry['hash']):
+                            raise ValueError('index does not match records')
+                        records.append((5, record['hash'], record['data']))
+                    if entry['verified']:
+                        records.append((2, entry['hash'], ''))
+            except Exception:
+                log.err(None, "HARMLESS error while reading index of saved shares in %s:" % (filename,))
+            return records
+        
+        f.seek(0)
+        data = f.read()
+        file_index = self.open_indexes[filename] = {}
+        pos = len(SHARE_STORE_MAGIC)
+        while pos < len(data):
+            try:
+                record, (_, end) = share_store_record_type.read((data, pos))
+            except pack.EarlyEnd:
+                print >>sys.stderr, 'Truncating partially written record at the end of %s' % (filename,)
+                with open(filename, 'r+b') as f:
+                    f.truncate(pos)
+                break
+            offset, verified = file_index.get(record['hash'], (None, False))
+            if record['type'] == 5:
+                offset = pos
+            else:
+                verified = True
+            file_index[record['hash']] = offset, verified
+            records.append((record['type'], record['hash'], record['data']))
+            pos = end
+        return records
+    
+    def _pack_index(self, file_index, index_offset):
+        return share_store_index_type.pack([dict(hash=share_hash, offset=offset, verified=int(verified))
+            for share_hash, (offset, verified) in sorted(file_index.iteritems())]) + \
+            share_store_trailer_type.pack(dict(index_offset=index_offset, magic=SHARE_STORE_INDEX_MAGIC))
+    
+    def _write_sealed_file(self, filename, records):
+        parts = [SHARE_STORE_MAGIC]
+        pos = len(SHARE_STORE_MAGIC)
+        file_index = {}
+        for type_id, share_hash, data in records:
+            record = share_store_record_type.pack(dict(type=type_id, hash=share_hash, data=data))
+            offset, verified = file_index.get(share_hash, (None, False))
+            if type_id == 5:
+                offset = pos
+            else:
+                verified = True
+            file_index[share_hash] = offset, verified
+            parts.append(record)
+            pos += len(record)
+        parts.append(self._pack_index(file_index, pos))
+        self._replace_file(filename, ''.join(parts))
+    
+    def _replace_file(self, filename, data):
+        # a crash leaves either the old file or the new one. a leftover .new file is removed at startup
+        with open(filename + '.new', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(filename + '.new', filename)
+        except: # XXX windows can't overwrite
+            os.remove(filename)
+            os.rename(filename + '.new', filename)
+    
+    def _close_active(self):
+        if self.active_file is not None:
+            self.active_file.close()
+        self.active_filename = self.active_file = self.active_size = None
+    
+    def _write(self, filename, data):
+        if self.pending_writes and self.pending_writes[-1][0] == filename:
+            self.pending_writes[-1][1].append(data)
         else:
-            filename = next
+            self.pending_writes.append((filename, [data]))
+    
+    def flush(self):
+        # one write and fsync per file that has queued records
+        pending_writes, self.pending_writes = self.pending_writes, []
+        for filename, parts in pending_writes:
+            if filename == self.active_filename:
+                if self.active_file is None:
+                    self.active_file = open(filename, 'ab')
+                f = self.active_file
+            else:
+                f = open(filename, 'ab')
+            try:
+                f.write(''.join(parts))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                if f is not self.active_file:
+                    f.close()
+        self.pow_cache.flush()
+    
+    def _seal(self, filename):
+        # the indexed copy replaces the file in one rename, so an interrupted seal can't leave index bytes that would
+        # be scanned as records
+        file_index = self.open_indexes.pop(filename)
+        if filename == self.active_filename:
+            self.flush()
+            self._close_active()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        self._replace_file(filename, data + self._pack_index(file_index, len(data)))
+    
+    def _add_record(self, type_id, share_hash, data):
+        if self.active_filename is None:
+            self.active_filename = os.path.join(self.dirname, self.filename + str(self.next_suffix))
+            self.next_suffix += 1
+            self._write(self.active_filename, SHARE_STORE_MAGIC)
+            self.active_size = len(SHARE_STORE_MAGIC)
+            self.open_indexes[self.active_filename] = {}
+        filename = self.active_filename
         
-        with open(filename, 'ab') as f:
-            f.write(line + '\n')
+        record = share_store_record_type.pack(dict(type=type_id, hash=share_hash, data=data))
+        offset = self.active_size
+        self._write(filename, record)
+        self.active_size += len(record)
+        
+        file_index = self.open_indexes[filename]
+        share_offset, verified = file_index.get(share_hash, (None, False))
+        if type_id == 5:
+            share_offset = offset
+        else:
+            verified = True
+        file_index[share_hash] = share_offset, verified
+        
+        if self.active_size >= self.max_file_size:
+            self._seal(filename)
         
         return filename
     
     def add_share(self, share):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share.hash in share_hashes:
-                break
-        else:
-            filename = self._add_line("%i %s" % (5, share_type.pack(share.as_share()).encode('hex')))
-            share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
-            share_hashes.add(share.hash)
-        share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
-        share_hashes.add(share.hash)
+        filename = self.share_files.get(share.hash)
+        if filename is None:
+            filename = self.share_files[share.hash] = self._add_record(5, share.hash, share_type.pack(share.as_share()))
+            self.known.setdefault(filename, (set(), set()))[0].add(share.hash)
+            self.pow_cache.add(share.header_hash, share.pow_hash)
+        self.known_desired.setdefault(filename, (set(), set()))[0].add(share.hash)
     
     def add_verified_hash(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share_hash in verified_hashes:
-                break
-        else:
-            filename = self._add_line("%i %x" % (2, share_hash))
-            share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
-            verified_hashes.add(share_hash)
-        share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
-        verified_hashes.add(share_hash)
+        filename = self.verified_files.get(share_hash)
+        if filename is None:
+            filename = self.verified_files[share_hash] = self._add_record(2, share_hash, '')
+            self.known.setdefault(filename, (set(), set()))[1].add(share_hash)
+        self.known_desired.setdefault(filename, (set(), set()))[1].add(share_hash)
     
     def get_filenames_and_next(self):
         suffixes = sorted(int(x[len(self.filename):]) for x in os.listdir(self.dirname) if x.startswith(self.filename) and x[len(self.filename):].isdigit())
         return [os.path.join(self.dirname, self.filename + str(suffix)) for suffix in suffixes], os.path.join(self.dirname, self.filename + (str(suffixes[-1] + 1) if suffixes else str(0)))
     
     def forget_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in share_hashes:
-                share_hashes.remove(share_hash)
-        self.check_remove()
+        filename = self.share_files.get(share_hash)
+        if filename is not None:
+            self.known_desired[filename][0].discard(share_hash)
+            self.check_remove([filename])
     
     def forget_verified_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in verified_hashes:
-                verified_hashes.remove(share_hash)
-        self.check_remove()
+        filename = self.verified_files.get(share_hash)
+        if filename is not None:
+            self.known_desired[filename][1].discard(share_hash)
+            self.check_remove([filename])
     
-    def check_remove(self):
+    def check_remove(self, filenames=None):
         to_remove = set()
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
+        for filename in (self.known_desired.keys() if filenames is None else filenames):
+            share_hashes, verified_hashes = self.known_desired[filename]
             #print filename, len(share_hashes) + len(verified_hashes)
             if not share_hashes and not verified_hashes:
                 to_remove.add(filename)
         for filename in to_remove:
-            self.known.pop(filename)
+            share_hashes, verified_hashes = self.known.pop(filename)
+            for share_hash in share_hashes:
+                del self.share_files[share_hash]
+            for share_hash in verified_hashes:
+                del self.verified_files[share_hash]
             self.known_desired.pop(filename)
-            os.remove(filename)
+            self.open_indexes.pop(filename, None)
+            self.pending_writes = [(filename2, parts) for filename2, parts in self.pending_writes if filename2 != filename]
+            if filename == self.active_filename:
+                self._close_active()
+            if os.path.exists(filename):
+                os.remove(filename)
             print "REMOVED", filename
+    
+    def compact(self):
+        # rewrites the first sealed file that is mostly made of forgotten records so that it only holds wanted ones
+        for filename, (share_hashes, verified_hashes) in sorted(self.known.iteritems()):
+            if filename in self.open_indexes:
+                continue
+            desired_share_hashes, desired_verified_hashes = self.known_desired[filename]
+            if len(desired_share_hashes) + len(desired_verified_hashes) <= self.compact_live_fraction*(len(share_hashes) + len(verified_hashes)):
+                break
+        else:
+            return
+        if not desired_share_hashes and not desired_verified_hashes:
+            self.check_remove([filename])
+            return
+        
+        self.flush()
+        with open(filename, 'rb') as f:
+            records = [(type_id, share_hash, data) for type_id, share_hash, data in self._read_records(filename, f)
+                if share_hash in (desired_share_hashes if type_id == 5 else desired_verified_hashes)]
+        self._write_sealed_file(filename, records)
+        
+        kept_share_hashes = set(share_hash for type_id, share_hash, data in records if type_id == 5)
+        kept_verified_hashes = set(share_hash for type_id, share_hash, data in records if type_id == 2)
+        for share_hash in share_hashes - kept_share_hashes:
+            del self.share_files[share_hash]
+        for share_hash in verified_hashes - kept_verified_hashes:
+            del self.verified_files[share_hash]
+        self.known[filename] = kept_share_hashes, kept_verified_hashes
+        self.known_desired[filename] = set(kept_share_hashes), set(kept_verified_hashes)
+        print 'Compacted %s from %i to %i records' % (filename, len(share_hashes) + len(verified_hashes), len(records))
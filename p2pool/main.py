@@ -8,6 +8,7 @@ import random
 import sys
 import time
 import signal
+import socket
 import traceback
 import urlparse
 
@@ -20,7 +21,7 @@ from twisted.python import log
 from nattraverso import portmapper, ipdiscover
 
 import bitcoin.p2p as bitcoin_p2p, bitcoin.data as bitcoin_data
-from bitcoin import stratum, worker_interface, helper
+from bitcoin import stratum, stratum_workers, worker_interface, helper
 from util import fixargparse, jsonrpc, variable, deferral, math, logging, switchprotocol
 from . import networks, web, work
 import p2pool, p2pool.data as p2pool_data, p2pool.node as p2pool_node
@@ -72,7 +73,7 @@ class keypool():
         return self.payouttotal
 
 @defer.inlineCallbacks
-def main(args, net, datadir_path, merged_urls, worker_endpoint):
+def main(args, net, datadir_path, merged_urls, worker_endpoint, share_check_pool):
     try:
         print 'p2pool (version %s)' % (p2pool.__version__,)
         print
@@ -181,15 +182,21 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             shares[share.hash] = share
             if len(shares) % 1000 == 0 and shares:
                 print "    %i" % (len(shares),)
-        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, share_cb, known_verified.add)
+        try:
+            ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, share_cb, known_verified.add, verify_pow=args.verify_shares, pool=share_check_pool)
+        finally:
+            if share_check_pool is not None:
+                share_check_pool.close()
+                share_check_pool.join()
         print "    ...done loading %i shares (%i verified)!" % (len(shares), len(known_verified))
         print
         
         
         print 'Initializing work...'
         
-        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net)
+        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net, compact_tracker=args.compact_tracker, tx_store_size=int(args.tx_store_size*1e6))
         yield node.start()
+        print '    PoW hash cache: %i hits, %i misses' % (ss.pow_cache.hits, ss.pow_cache.misses)
         
         for share_hash in shares:
             if share_hash not in node.tracker.items:
@@ -205,7 +212,10 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
                 ss.add_share(share)
                 if share.hash in node.tracker.verified.items:
                     ss.add_verified_hash(share.hash)
+            ss.flush()
+            ss.compact()
         deferral.RobustLoopingCall(save_shares).start(60)
+        reactor.addSystemEventTrigger('before', 'shutdown', ss.flush)
 
         if len(shares) > net.CHAIN_LENGTH:
             best_share = shares[node.best_share_var.value]
@@ -297,12 +307,18 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             share_rate_type = 'miner'
             share_rate = args.miner_share_rate
         wb = work.WorkerBridge(node, my_pubkey_hash, my_pubkey_hash_version, args.donation_percentage, merged_urls, args.worker_fee, args, pubkeys, bitcoind, args.min_difficulty, share_rate, share_rate_type)
-        web_root = web.get_web_root(wb, datadir_path, bitcoind_getinfo_var, static_dir=args.web_static)
         caching_wb = worker_interface.CachingWorkerBridge(wb)
+        stratum_serverfactory = stratum.StratumServerFactory(caching_wb)
+        stratum_worker_server = None
+        if args.stratum_workers:
+            print 'Listening for stratum miners on %r port %i with %i worker processes...' % (args.stratum_endpoint[0], args.stratum_endpoint[1], args.stratum_workers)
+            stratum_worker_server = stratum_workers.WorkerServer(caching_wb)
+            stratum_worker_server.start(os.path.join(datadir_path, 'stratum_workers.sock'), args.stratum_endpoint, args.stratum_workers)
+        web_root = web.get_web_root(wb, datadir_path, bitcoind_getinfo_var, static_dir=args.web_static, stratum_broadcaster=stratum_serverfactory.broadcaster, stratum_workers=stratum_worker_server)
         worker_interface.WorkerInterface(caching_wb).attach_to(web_root, get_handler=lambda request: request.redirect('/static/'))
         web_serverfactory = server.Site(web_root)
         
-        serverfactory = switchprotocol.FirstByteSwitchFactory({'{': stratum.StratumServerFactory(caching_wb)}, web_serverfactory)
+        serverfactory = switchprotocol.FirstByteSwitchFactory({'{': stratum_serverfactory}, web_serverfactory)
         deferral.retry('Error binding to worker port:', traceback=False)(reactor.listenTCP)(worker_endpoint[1], serverfactory, interface=worker_endpoint[0])
         
         with open(os.path.join(os.path.join(datadir_path, 'ready_flag')), 'wb') as f:
@@ -494,6 +510,18 @@ def run():
     parser.add_argument('--irc-announce',
         help='announce any blocks found on irc://irc.freenode.net/#p2pool',
         action='store_true', default=False, dest='irc_announce')
+    parser.add_argument('--verify-shares',
+        help='fully load every share stored on disk at startup, recomputing its PoW hash instead of trusting the cached value',
+        action='store_true', default=False, dest='verify_shares')
+    parser.add_argument('--load-processes', metavar='PROCESSES',
+        help='verify the PoW of stored shares that are missing from the PoW hash cache at startup, using this many processes (default: verify each share in the main process the first time it is used)',
+        type=int, action='store', default=None, dest='load_processes')
+    parser.add_argument('--compact-tracker',
+        help='keep the share chain in columns indexed by small integer ids instead of dicts keyed by share hash, which uses less memory',
+        action='store_true', default=False, dest='compact_tracker')
+    parser.add_argument('--tx-store-size', metavar='MEGABYTES',
+        help='serialized size of known transactions to keep once those not needed for mining, peers or recent shares are evicted, least recently seen first (default: 50)',
+        type=float, action='store', default=50, dest='tx_store_size')
     parser.add_argument('--no-bugreport',
         help='disable submitting caught exceptions to the author',
         action='store_true', default=False, dest='no_bugreport')
@@ -525,6 +553,12 @@ def run():
     worker_group.add_argument('-w', '--worker-port', metavar='PORT or ADDR:PORT',
         help='listen on PORT on interface with ADDR for RPC connections from miners (default: all interfaces, %s)' % ', '.join('%s:%i' % (name, net.WORKER_PORT) for name, net in sorted(realnets.items())),
         type=str, action='store', default=None, dest='worker_endpoint')
+    worker_group.add_argument('--stratum-workers', metavar='PROCESSES',
+        help='also accept stratum connections on a separate port in this many worker processes, which check pseudoshares themselves and only pass shares and blocks on to the node (default: 0)',
+        type=int, action='store', default=0, dest='stratum_workers')
+    worker_group.add_argument('--stratum-port', metavar='PORT or ADDR:PORT',
+        help='listen on PORT on interface with ADDR for stratum connections handled by --stratum-workers (default: worker port + 1 on the worker interface)',
+        type=str, action='store', default=None, dest='stratum_endpoint')
     worker_group.add_argument('-f', '--fee', metavar='FEE_PERCENTAGE',
         help='''charge workers mining to their own bitcoin address (by setting their miner's username to a bitcoin address) this percentage fee to mine on your p2pool instance. Amount displayed at http://127.0.0.1:WORKER_PORT/fee (default: 0)''',
         type=float, action='store', default=0, dest='worker_fee')
@@ -635,6 +669,18 @@ def run():
         addr, port = args.worker_endpoint.rsplit(':', 1)
         worker_endpoint = addr, int(port)
     
+    if not 0 <= args.stratum_workers <= 256:
+        parser.error('--stratum-workers must be between 0 and 256')
+    if args.stratum_workers and not hasattr(socket, 'AF_UNIX'):
+        parser.error('--stratum-workers is not supported on this platform')
+    if args.stratum_endpoint is None:
+        args.stratum_endpoint = worker_endpoint[0], worker_endpoint[1] + 1
+    elif ':' not in args.stratum_endpoint:
+        args.stratum_endpoint = worker_endpoint[0], int(args.stratum_endpoint)
+    else:
+        addr, port = args.stratum_endpoint.rsplit(':', 1)
+        args.stratum_endpoint = addr, int(port)
+    
     if args.address is not None and args.address != 'dynamic':
         try:
             args.pubkey_hash, args.pubkey_hash_version = bitcoin_data.address_to_pubkey_hash(args.address, net.PARENT)
@@ -694,5 +740,8 @@ def run():
     if not args.no_bugreport:
         log.addObserver(ErrorReporter().emit)
     
-    reactor.callWhenRunning(main, args, net, datadir_path, merged_urls, worker_endpoint)
+    # forked now, while the reactor isn't running yet
+    share_check_pool = p2pool_data.make_share_check_pool(net, args.load_processes) if args.load_processes is not None else None
+    
+    reactor.callWhenRunning(main, args, net, datadir_path, merged_urls, worker_endpoint, share_check_pool)
     reactor.run()
@@ -6,7 +6,7 @@ from twisted.internet import defer, reactor
 from twisted.python import log
 
 from p2pool import data as p2pool_data, p2p
-from p2pool.bitcoin import data as bitcoin_data, helper, height_tracker
+from p2pool.bitcoin import data as bitcoin_data, helper, height_tracker, txstore
 from p2pool.util import deferral, variable
 
 
@@ -16,7 +16,7 @@ class P2PNode(p2p.Node):
         p2p.Node.__init__(self,
             best_share_hash_func=lambda: node.best_share_var.value,
             net=node.net,
-            known_txs_var=node.known_txs_var,
+            tx_store=node.tx_store,
             mining_txs_var=node.mining_txs_var,
         **kwargs)
     
@@ -24,12 +24,14 @@ class P2PNode(p2p.Node):
         if len(shares) > 5:
             print 'Processing %i shares from %s...' % (len(shares), '%s:%i' % peer.addr if peer is not None else None)
         
-        new_count = 0
         all_new_txs = {}
         for share, new_txs in shares:
             if new_txs is not None:
-                all_new_txs.update((bitcoin_data.hash256(bitcoin_data.tx_type.pack(new_tx)), new_tx) for new_tx in new_txs)
-            
+                all_new_txs.update((bitcoin_data.get_tx_hash(new_tx), new_tx) for new_tx in new_txs)
+        self.node.tx_store.add(all_new_txs) # before the shares, so they're known once the shares are on the best chain
+        
+        new_count = 0
+        for share, new_txs in shares:
             if share.hash in self.node.tracker.items:
                 #print 'Got duplicate share, ignoring. Hash: %s' % (p2pool_data.format_hash(share.hash),)
                 continue
@@ -40,10 +42,6 @@ class P2PNode(p2p.Node):
             
             self.node.tracker.add(share)
         
-        new_known_txs = dict(self.node.known_txs_var.value)
-        new_known_txs.update(all_new_txs)
-        self.node.known_txs_var.set(new_known_txs)
-        
         if new_count:
             self.node.set_best_share()
         
@@ -157,12 +155,14 @@ class P2PNode(p2p.Node):
         
 
 class Node(object):
-    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
+    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net, compact_tracker=False, tx_store_size=50*1000*1000):
         self.factory = factory
         self.bitcoind = bitcoind
         self.net = net
+        self.tx_store = txstore.TxStore(tx_store_size)
+        self.known_txs_var = self.tx_store.known_txs_var # hash -> tx
         
-        self.tracker = p2pool_data.OkayTracker(self.net)
+        self.tracker = p2pool_data.OkayTracker(self.net, compact=compact_tracker)
         
         for share in shares:
             self.tracker.add(share)
@@ -221,12 +221,12 @@ class Node(object):
         
         # BEST SHARE
         
-        self.known_txs_var = variable.Variable({}) # hash -> tx
         self.mining_txs_var = variable.Variable({}) # hash -> tx
         self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.bitcoind, self.factory, lambda: self.bitcoind_work.value['previous_block'], self.net)
         
         self.best_share_var = variable.Variable(None)
         self.desired_var = variable.Variable(None)
+        self.best_share_var.changed.watch(lambda _: self.set_share_tx_refs())
         self.bitcoind_work.changed.watch(lambda _: self.set_best_share())
         self.set_best_share()
         
@@ -235,28 +235,22 @@ class Node(object):
         # update mining_txs according to getwork results
         @self.bitcoind_work.changed.run_and_watch
         def _(_=None):
-            new_mining_txs = {}
-            new_known_txs = dict(self.known_txs_var.value)
-            for tx_hash, tx in zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions']):
-                new_mining_txs[tx_hash] = tx
-                new_known_txs[tx_hash] = tx
+            new_mining_txs = self.tx_store.add(dict(zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions'])))
+            self.tx_store.set_refs('mining', new_mining_txs)
             self.mining_txs_var.set(new_mining_txs)
-            self.known_txs_var.set(new_known_txs)
         # add p2p transactions from bitcoind to known_txs
         @self.factory.new_tx.watch
         def _(tx):
-            new_known_txs = dict(self.known_txs_var.value)
-            new_known_txs[bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))] = tx
-            self.known_txs_var.set(new_known_txs)
+            self.tx_store.add({bitcoin_data.get_tx_hash(tx): tx})
         # forward transactions seen to bitcoind
-        @self.known_txs_var.transitioned.watch
+        @self.known_txs_var.added.watch
         @defer.inlineCallbacks
-        def _(before, after):
+        def _(added):
             yield deferral.sleep(random.expovariate(1/1))
             if self.factory.conn.value is None:
                 return
-            for tx_hash in set(after) - set(before):
-                self.factory.conn.value.send_tx(tx=after[tx_hash])
+            for tx in added.itervalues():
+                self.factory.conn.value.send_tx(tx=tx)
         
         @self.tracker.verified.added.watch
         def _(share):
@@ -272,21 +266,6 @@ class Node(object):
             print 'GOT BLOCK FROM PEER! Passing to bitcoind! %s bitcoin: %s%064x' % (p2pool_data.format_hash(share.hash), self.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, share.header_hash)
             print
         
-        def forget_old_txs():
-            new_known_txs = {}
-            if self.p2p_node is not None:
-                for peer in self.p2p_node.peers.itervalues():
-                    new_known_txs.update(peer.remembered_txs)
-            new_known_txs.update(self.mining_txs_var.value)
-            for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))):
-                for tx_hash in share.new_transaction_hashes:
-                    if tx_hash in self.known_txs_var.value:
-                        new_known_txs[tx_hash] = self.known_txs_var.value[tx_hash]
-            self.known_txs_var.set(new_known_txs)
-        t = deferral.RobustLoopingCall(forget_old_txs)
-        t.start(10)
-        stop_signal.watch(t.stop)
-        
         t = deferral.RobustLoopingCall(self.clean_tracker)
         t.start(5)
         stop_signal.watch(t.stop)
@@ -304,6 +283,14 @@ class Node(object):
                         peer.badPeerHappened()
                         break
     
+    def set_share_tx_refs(self):
+        # the last shares of the best chain hold references to their new transactions, so they can still be sent to
+        # peers, referenced by new shares and turned into blocks after the store evicts unreferenced ones
+        best = self.best_share_var.value
+        self.tx_store.set_refs('shares', [tx_hash
+            for share in self.tracker.get_chain(best, min(120, self.tracker.get_height(best)))
+            for tx_hash in share.new_transaction_hashes])
+    
     def get_current_txouts(self):
         return p2pool_data.get_expected_payouts(self.tracker, self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy'], self.net)
     
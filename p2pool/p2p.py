@@ -1,7 +1,9 @@
 from __future__ import division
 
+import hashlib
 import math
 import random
+import struct
 import sys
 import time
 
@@ -10,12 +12,40 @@ from twisted.python import failure, log
 
 import p2pool
 from p2pool import data as p2pool_data
-from p2pool.bitcoin import data as bitcoin_data
+from p2pool.bitcoin import data as bitcoin_data, txstore
 from p2pool.util import deferral, p2protocol, pack, variable
 
 class PeerMisbehavingError(Exception):
     pass
 
+SERVICE_COMPACT_SHARES = 1 # peer accepts cmpctshares and answers txreq
+SERVICE_COMPRESSION = 2 # peer accepts zlib "compressed" messages
+
+short_id_type = pack.IntType(48)
+
+def get_short_id_salt(share_hash, nonce):
+    # like BIP 152, salted with a share's hash and the sending node's nonce, so collisions can't be crafted before the
+    # share exists. shares sent together use the same share's hash, so the receiver indexes its known txs only once
+    return pack.IntType(64).unpack(hashlib.sha256(pack.IntType(256).pack(share_hash) + pack.IntType(64).pack(nonce)).digest()[:8])
+
+def get_short_id(salt, tx_hash):
+    return short_id_type.unpack(hashlib.sha256(pack.IntType(64).pack(salt) + pack.IntType(256).pack(tx_hash)).digest()[:6])
+
+def get_short_id_index(salt, tx_hashes):
+    '''Maps the short id of each of tx_hashes to it, or to None if more than one of them have that short id'''
+    
+    salted = hashlib.sha256(pack.IntType(64).pack(salt))
+    index = {}
+    for tx_hash in tx_hashes:
+        h = salted.copy()
+        # the same as get_short_id, without pack's overhead for every known transaction
+        h.update(('%064x' % (tx_hash,)).decode('hex')[::-1])
+        short_id = struct.unpack('<Q', h.digest()[:6] + '\x00\x00')[0]
+        index[short_id] = tx_hash if index.get(short_id, tx_hash) == tx_hash else None
+    return index
+
+def get_tx_hashes_check(tx_hashes):
+    return bitcoin_data.hash256(pack.ListType(pack.IntType(256)).pack(tx_hashes)) % 2**32
 
 def fragment(f, **kwargs):
     try:
@@ -26,8 +56,11 @@ def fragment(f, **kwargs):
 
 class Protocol(p2protocol.Protocol):
     VERSION = 1800
+    SERVICES = SERVICE_COMPACT_SHARES | SERVICE_COMPRESSION
     
     max_remembered_txs_size = 2500000
+    max_prefilled_txs_size = 500000
+    min_compressed_size = 1000
     
     def __init__(self, node, incoming):
         p2protocol.Protocol.__init__(self, node.net.PREFIX, 1000000, node.traffic_happened)
@@ -36,6 +69,7 @@ class Protocol(p2protocol.Protocol):
         
         self.other_version = None
         self.connected2 = False
+        self.accept_compressed = bool(self.SERVICES & SERVICE_COMPRESSION)
     
     def connectionMade(self):
         self.factory.proto_made_connection(self)
@@ -46,7 +80,7 @@ class Protocol(p2protocol.Protocol):
         
         self.send_version(
             version=self.VERSION,
-            services=0,
+            services=self.SERVICES,
             addr_to=dict(
                 services=0,
                 address=self.transport.getPeer().host,
@@ -71,6 +105,12 @@ class Protocol(p2protocol.Protocol):
             timeout=15,
             on_timeout=self.disconnect,
         )
+        self.get_txs = deferral.GenericDeferrer(
+            max_id=2**256,
+            func=lambda id, share_hash, indexes: self.send_txreq(id=id, share_hash=share_hash, indexes=indexes),
+            timeout=15,
+            on_timeout=self.disconnect,
+        )
         
         self.remote_tx_hashes = set() # view of peer's known_txs # not actually initially empty, but sending txs instead of tx hashes won't hurt
         self.remote_remembered_txs_size = 0
@@ -78,6 +118,8 @@ class Protocol(p2protocol.Protocol):
         self.remembered_txs = {} # view of peer's mining_txs
         self.remembered_txs_size = 0
         self.known_txs_cache = {}
+        self.sent_tx_hashes = {} # share hash -> new_transaction_hashes of compact shares sent recently
+        self.sent_tx_hashes_expiries = {} # share hash -> DelayedCall that forgets its sent_tx_hashes entry
     
     def _connect_timeout(self):
         self.timeout_delayed = None
@@ -150,6 +192,8 @@ class Protocol(p2protocol.Protocol):
         self.other_version = version
         self.other_sub_version = sub_version[:512]
         self.other_services = services
+        if services & SERVICE_COMPRESSION:
+            self.compress_threshold = self.min_compressed_size
         
         if nonce == self.node.nonce:
             raise PeerMisbehavingError('was connected to self')
@@ -186,20 +230,19 @@ class Protocol(p2protocol.Protocol):
         if best_share_hash is not None:
             self.node.handle_share_hashes([best_share_hash], self)
         
-        def update_remote_view_of_my_known_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.send_have_tx(tx_hashes=list(added))
-            if removed:
-                self.send_losing_tx(tx_hashes=list(removed))
-                
-                # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
-                key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = dict((h, before[h]) for h in removed)
-                reactor.callLater(20, self.known_txs_cache.pop, key)
-        watch_id = self.node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.transitioned.unwatch(watch_id))
+        def update_remote_view_of_my_known_txs_added(added):
+            self.send_have_tx(tx_hashes=added.keys())
+        def update_remote_view_of_my_known_txs_removed(removed):
+            self.send_losing_tx(tx_hashes=removed.keys())
+            
+            # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
+            key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
+            self.known_txs_cache[key] = removed
+            reactor.callLater(20, self.known_txs_cache.pop, key)
+        watch_id = self.node.known_txs_var.added.watch(update_remote_view_of_my_known_txs_added)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.added.unwatch(watch_id))
+        watch_id3 = self.node.known_txs_var.removed.watch(update_remote_view_of_my_known_txs_removed)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.removed.unwatch(watch_id3))
         
         self.send_have_tx(tx_hashes=self.node.known_txs_var.value.keys())
         
@@ -309,6 +352,10 @@ class Protocol(p2protocol.Protocol):
         self.node.handle_shares(result, self)
     
     def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
+        if self.other_services & SERVICE_COMPACT_SHARES:
+            self.sendCompactShares(shares, known_txs)
+            return
+        
         tx_hashes = set()
         for share in shares:
             if share.VERSION >= 13:
@@ -338,6 +385,181 @@ class Protocol(p2protocol.Protocol):
         
         self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
     
+    def sendCompactShares(self, shares, known_txs):
+        compact_shares = []
+        share_tx_hashes = []
+        for share in shares:
+            tx_hashes = share.share_info['new_transaction_hashes']
+            prefilled_txs = []
+            prefilled_size = 0
+            for index, tx_hash in enumerate(tx_hashes):
+                assert tx_hash in known_txs, 'tried to broadcast share without knowing all its new transactions'
+                # include transactions the peer is not known to have, the rest are requested only if needed
+                if tx_hash not in self.remote_tx_hashes and prefilled_size < self.max_prefilled_txs_size:
+                    prefilled_txs.append(dict(index=index, tx=known_txs[tx_hash]))
+                    prefilled_size += bitcoin_data.tx_type.packed_size(known_txs[tx_hash])
+                    self.remote_tx_hashes.add(tx_hash) # so later shares don't send it again
+            
+            contents = dict(share.contents, share_info=dict(share.share_info, new_transaction_hashes=[]))
+            compact_shares.append(dict(
+                hash=share.hash,
+                share=dict(type=share.VERSION, contents=share.share_type.pack(contents)),
+                check=get_tx_hashes_check(tx_hashes),
+                txs=prefilled_txs,
+            ))
+            share_tx_hashes.append(tx_hashes)
+            self.sent_tx_hashes[share.hash] = tx_hashes
+            if share.hash in self.sent_tx_hashes_expiries:
+                self.sent_tx_hashes_expiries[share.hash].reset(60)
+            else:
+                self.sent_tx_hashes_expiries[share.hash] = reactor.callLater(60, self._forget_sent_tx_hashes, share.hash)
+        
+        fragment(self._send_cmpctshares, shares=compact_shares, share_tx_hashes=share_tx_hashes)
+    
+    def _send_cmpctshares(self, shares, share_tx_hashes):
+        # every message is salted with the hash of its own first share, as handle_cmpctshares requires
+        if not shares:
+            return
+        salt_hash = shares[0]['hash']
+        salt = get_short_id_salt(salt_hash, self.node.nonce)
+        self.send_cmpctshares(shares=[dict(compact_share, salt_hash=salt_hash, short_ids=[get_short_id(salt, tx_hash) for tx_hash in tx_hashes])
+            for compact_share, tx_hashes in zip(shares, share_tx_hashes)])
+    
+    def _forget_sent_tx_hashes(self, share_hash):
+        del self.sent_tx_hashes[share_hash]
+        del self.sent_tx_hashes_expiries[share_hash]
+    
+    message_cmpctshares = pack.ComposedType([
+        ('shares', pack.ListType(pack.ComposedType([
+            ('hash', pack.IntType(256)),
+            ('salt_hash', pack.IntType(256)), # hash of the message's first share, which the short ids of all its shares are salted with
+            ('share', p2pool_data.share_type), # contents have an empty new_transaction_hashes list
+            ('short_ids', pack.ListType(short_id_type)), # of new_transaction_hashes, salted with get_short_id_salt
+            ('check', pack.IntType(32)),
+            ('txs', pack.ListType(pack.ComposedType([
+                ('index', pack.VarIntType()),
+                ('tx', bitcoin_data.tx_type),
+            ]))),
+        ]))),
+    ])
+    def handle_cmpctshares(self, shares):
+        # building a short id index costs O(known_txs), so a message may only use the one salt an honest sender picks
+        if any(compact_share['salt_hash'] != shares[0]['hash'] for compact_share in shares):
+            raise PeerMisbehavingError('compact shares not salted with the hash of the first share')
+        short_id_indexes = {} # salt -> short id index of known_txs, built at most once per message
+        self._handle_completed_shares([self._complete_compact_share(compact_share, short_id_indexes) for compact_share in shares
+            if compact_share['share']['type'] >= p2pool_data.Share.VERSION])
+    
+    @defer.inlineCallbacks
+    def _handle_completed_shares(self, dfs):
+        # shares that could be completed are handled even if others from the same message could not
+        results = yield defer.DeferredList(dfs, consumeErrors=True)
+        shares = [result for success, result in results if success]
+        if shares:
+            self.node.handle_shares(shares, self)
+        
+        for success, result in results:
+            if success:
+                continue
+            if result.check(PeerMisbehavingError):
+                print 'Peer %s:%i misbehaving, will drop and ban. Reason:' % self.addr, result.getErrorMessage()
+                self.badPeerHappened()
+                return
+            elif result.check(self.TxReplyError):
+                print >>sys.stderr, 'Peer %s:%i could not complete compact share: %s' % (self.addr[0], self.addr[1], result.getErrorMessage())
+            elif self.connected2:
+                log.err(result, 'Error handling compact shares:')
+                self.disconnect()
+                return
+    
+    @defer.inlineCallbacks
+    def _complete_compact_share(self, compact_share, short_id_indexes):
+        salt = get_short_id_salt(compact_share['salt_hash'], self.nonce)
+        short_ids = compact_share['short_ids']
+        tx_hashes = [None]*len(short_ids)
+        txs = [None]*len(short_ids)
+        for prefilled in compact_share['txs']:
+            if prefilled['index'] >= len(short_ids):
+                raise PeerMisbehavingError('prefilled transaction index out of range')
+            tx_hashes[prefilled['index']] = bitcoin_data.get_tx_hash(prefilled['tx'])
+            txs[prefilled['index']] = prefilled['tx']
+        
+        missing = [index for index, tx in enumerate(txs) if tx is None]
+        if missing:
+            # this runs before the first yield, so every share of the message sees the same known_txs
+            known_txs = self.node.known_txs_var.value
+            if salt not in short_id_indexes:
+                short_id_indexes[salt] = get_short_id_index(salt, known_txs)
+            short_id_index = short_id_indexes[salt]
+            for index in missing:
+                tx_hash = short_id_index.get(short_ids[index])
+                if tx_hash is not None:
+                    tx_hashes[index], txs[index] = tx_hash, known_txs[tx_hash]
+            missing = [index for index in missing if txs[index] is None]
+        if missing:
+            fetched = yield self._get_txs(compact_share['hash'], missing)
+            for index, tx in zip(missing, fetched):
+                tx_hash = bitcoin_data.get_tx_hash(tx)
+                if get_short_id(salt, tx_hash) != short_ids[index]:
+                    raise PeerMisbehavingError('sent transaction that does not match its short id')
+                tx_hashes[index], txs[index] = tx_hash, tx
+        
+        if get_tx_hashes_check(tx_hashes) != compact_share['check']:
+            # a short id matched a different transaction than the one the peer meant, so get all of them
+            txs = yield self._get_txs(compact_share['hash'], range(len(txs)))
+            tx_hashes = map(bitcoin_data.get_tx_hash, txs)
+            if get_tx_hashes_check(tx_hashes) != compact_share['check']:
+                raise PeerMisbehavingError('compact share transactions do not match check')
+        
+        cls = p2pool_data.get_share_class(compact_share['share']['type'])
+        contents = cls.get_dynamic_types(self.node.net)['share_type'].unpack(compact_share['share']['contents'])
+        if contents['share_info']['new_transaction_hashes']:
+            raise PeerMisbehavingError('compact share contains transaction hashes')
+        contents['share_info']['new_transaction_hashes'] = tx_hashes
+        share = cls(self.node.net, self.addr, contents)
+        if share.hash != compact_share['hash']:
+            raise PeerMisbehavingError('compact share does not match its hash')
+        defer.returnValue((share, txs))
+    
+    @defer.inlineCallbacks
+    def _get_txs(self, share_hash, indexes):
+        try:
+            txs = yield self.get_txs(share_hash=share_hash, indexes=indexes)
+        except self.TxReplyError, e:
+            if e.args[0] != 'too long' or len(indexes) < 2:
+                raise
+            txs = (yield self._get_txs(share_hash, indexes[:len(indexes)//2])) + (yield self._get_txs(share_hash, indexes[len(indexes)//2:]))
+        if len(txs) != len(indexes):
+            raise PeerMisbehavingError('wrong number of transactions in txreply')
+        defer.returnValue(txs)
+    
+    message_txreq = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('share_hash', pack.IntType(256)),
+        ('indexes', pack.ListType(pack.VarIntType())),
+    ])
+    def handle_txreq(self, id, share_hash, indexes):
+        tx_hashes = self.sent_tx_hashes.get(share_hash)
+        known_txs = self.node.known_txs_var.value
+        if tx_hashes is None or not all(index < len(tx_hashes) and tx_hashes[index] in known_txs for index in indexes):
+            self.send_txreply(id=id, result='unknown', txs=[])
+            return
+        try:
+            self.send_txreply(id=id, result='good', txs=[known_txs[tx_hashes[index]] for index in indexes])
+        except p2protocol.TooLong:
+            self.send_txreply(id=id, result='too long', txs=[])
+        else:
+            self.remote_tx_hashes.update(tx_hashes[index] for index in indexes)
+    
+    message_txreply = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('result', pack.EnumType(pack.VarIntType(), {0: 'good', 1: 'too long', 2: 'unknown'})),
+        ('txs', pack.ListType(bitcoin_data.tx_type)),
+    ])
+    class TxReplyError(Exception): pass
+    def handle_txreply(self, id, result, txs):
+        self.get_txs.got_response(id, txs if result == 'good' else failure.Failure(self.TxReplyError(result)))
+    
     
     message_sharereq = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -405,7 +627,7 @@ class Protocol(p2protocol.Protocol):
             else:
                 for cache in self.known_txs_cache.itervalues():
                     if tx_hash in cache:
-                        tx = cache[tx_hash]
+                        tx = self.node.tx_store.add({tx_hash: cache[tx_hash]})[tx_hash]
                         print 'Transaction %064x rescued from peer latency cache!' % (tx_hash,)
                         break
                 else:
@@ -413,13 +635,14 @@ class Protocol(p2protocol.Protocol):
                     self.disconnect()
                     return
             
+            self.node.tx_store.incref([tx_hash])
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
-        new_known_txs = dict(self.node.known_txs_var.value)
+        new_known_txs = {}
         warned = False
         for tx in txs:
-            tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
-            if tx_hash in self.remembered_txs:
+            tx_hash = bitcoin_data.get_tx_hash(tx)
+            if tx_hash in self.remembered_txs or tx_hash in new_known_txs:
                 print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
                 self.disconnect()
                 return
@@ -428,10 +651,12 @@ class Protocol(p2protocol.Protocol):
                 print 'Peer sent entire transaction %064x that was already received' % (tx_hash,)
                 warned = True
             
+            new_known_txs[tx_hash] = tx
+        new_known_txs = self.node.tx_store.add(new_known_txs) # keep the stored copies of already known txs
+        self.node.tx_store.incref(new_known_txs)
+        for tx_hash, tx in new_known_txs.iteritems():
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
-            new_known_txs[tx_hash] = tx
-        self.node.known_txs_var.set(new_known_txs)
         if self.remembered_txs_size >= self.max_remembered_txs_size:
             raise PeerMisbehavingError('too much transaction data stored')
     message_forget_tx = pack.ComposedType([
@@ -442,12 +667,18 @@ class Protocol(p2protocol.Protocol):
             self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash])
             assert self.remembered_txs_size >= 0
             del self.remembered_txs[tx_hash]
+            self.node.tx_store.decref([tx_hash])
     
     
     def connectionLost(self, reason):
         self.connection_lost_event.happened()
+        self.node.tx_store.decref(self.remembered_txs.keys())
         if self.timeout_delayed is not None:
             self.timeout_delayed.cancel()
+        for expiry in self.sent_tx_hashes_expiries.itervalues():
+            expiry.cancel()
+        self.sent_tx_hashes_expiries.clear()
+        self.sent_tx_hashes.clear()
         if self.connected2:
             self.factory.proto_disconnected(self, reason)
             self._stop_thread()
@@ -458,6 +689,7 @@ class Protocol(p2protocol.Protocol):
         if p2pool.DEBUG:
             print "Peer connection lost:", self.addr, reason
         self.get_shares.respond_all(reason)
+        self.get_txs.respond_all(reason)
     
     @defer.inlineCallbacks
     def do_ping(self):
@@ -609,14 +841,15 @@ class SingleClientFactory(protocol.ReconnectingClientFactory):
         self.node.lost_conn(proto, reason)
 
 class Node(object):
-    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.Variable({}), mining_txs_var=variable.Variable({}), advertise_ip=True, external_ip=None):
+    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, tx_store=None, mining_txs_var=variable.Variable({}), advertise_ip=True, external_ip=None):
         self.best_share_hash_func = best_share_hash_func
         self.port = port
         self.net = net
         self.addr_store = dict(addr_store)
         self.connect_addrs = connect_addrs
         self.preferred_storage = preferred_storage
-        self.known_txs_var = known_txs_var
+        self.tx_store = tx_store if tx_store is not None else txstore.TxStore()
+        self.known_txs_var = self.tx_store.known_txs_var
         self.mining_txs_var = mining_txs_var
         self.advertise_ip = advertise_ip
         self.external_ip = external_ip
@@ -0,0 +1,33 @@
+from p2pool.bitcoin import data, networks
+from p2pool.util import math, variable
+
+class FakeWorkerBridge(object):
+    '''Stands in for work.WorkerBridge in the stratum tests and benchmarks. Work is fixed, and every submit that reaches
+    got_response is recorded in responses.'''
+    
+    COINBASE_NONCE_LENGTH = 4
+    net = networks.nets['bitcoin']
+    share_rate, share_rate_type, min_difficulty = None, 'address', 1
+    
+    def __init__(self, pubkey_hash=0, share_target=2**240, coinb1='', coinb2='', merkle_branch=[]):
+        self.pubkey_hash = pubkey_hash
+        self.share_target = share_target
+        self.coinb1, self.coinb2, self.merkle_branch = coinb1, coinb2, merkle_branch
+        self.new_work_event = variable.Event()
+        self.refresh_work_event = variable.Event()
+        self._inner = math.Object(COINBASE_NONCE_LENGTH=8, get_work=self.get_work, got_checked_submits=lambda *args: self.checked.append(args),
+            my_share_hashes=set(), my_doa_share_hashes=set(), total_hashes=0, invalid_hashes=0)
+        self.candidate_target = 0
+        self.get_work_count = 0
+        self.checked = []
+        self.responses = []
+    
+    def preprocess_request(self, user):
+        return user, self.pubkey_hash, 0, None, None
+    
+    def get_work(self, user, pubkey_hash, pubkey_hash_version, desired_share_target, desired_pseudoshare_target):
+        self.get_work_count += 1
+        return dict(share_target=self.share_target, share_info_target=2**240, candidate_target=self.candidate_target, previous_block=1,
+            coinb1=self.coinb1, coinb2=self.coinb2, merkle_link=dict(branch=self.merkle_branch, index=0), version=1,
+            bits=data.FloatingInteger.from_target_upper_bound(2**240), timestamp=0), \
+            lambda header, user, coinbase_nonce: self.responses.append((header, user, coinbase_nonce)) or True
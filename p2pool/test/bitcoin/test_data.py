@@ -1,3 +1,5 @@
+import pickle
+import random
 import unittest
 
 from p2pool.bitcoin import data, networks
@@ -40,6 +42,57 @@ class Test(unittest.TestCase):
             lock_time=0,
         )) == 0xb53802b2333e828d6532059f46ecf6b313a42d79f97925e457fbbfda45367e5c
     
+    def test_tx_cache(self):
+        tx = dict(
+            version=1,
+            tx_ins=[dict(previous_output=None, sequence=None, script='\x01\x02')],
+            tx_outs=[dict(value=5000000000, script='\x51')],
+            lock_time=0,
+        )
+        cached = data.Transaction(tx)
+        assert cached == tx
+        assert data.tx_type.pack(cached) == data.tx_type.pack(tx)
+        assert cached._packed is not None
+        assert data.get_txid(cached) == data.get_txid(tx)
+        assert data.get_tx_hash(cached) == data.hash256(data.tx_type.pack(tx))
+        assert data.get_wtxid(cached) == data.get_txid(tx)
+        assert data.get_stripped_size(cached) == data.tx_id_type.packed_size(tx) == data.tx_type.packed_size(cached)
+    
+        cached['marker'], cached['flag'], cached['witness'] = 0, 1, [['\x03']]
+        tx.update(marker=0, flag=1, witness=[['\x03']])
+        assert cached._packed is None and cached._txid is None
+        assert data.tx_type.pack(cached) == data.tx_type.pack(tx)
+        assert data.get_txid(cached) == data.get_txid(tx)
+        assert data.get_wtxid(cached) == data.get_wtxid(tx) != data.get_txid(tx)
+    
+        assert pickle.loads(pickle.dumps(cached)) == cached
+    
+    def test_merkle_tree(self):
+        tree = data.MerkleTree()
+        assert tree.root == data.merkle_hash([]) == 0
+        hashes = []
+        for i in xrange(200):
+            r = random.random()
+            if r < .1:
+                hashes = hashes[:random.randrange(len(hashes) + 1)]
+            elif r < .2 and hashes:
+                hashes[random.randrange(len(hashes))] = random.randrange(2**256)
+            else:
+                hashes = hashes + [random.randrange(2**256) for j in xrange(random.randrange(1, 5))]
+            if random.random() < .5 and hashes:
+                tree.update(hashes[:-1]).append(hashes[-1])
+            else:
+                tree.update(hashes)
+            assert len(tree) == len(hashes)
+            assert tree.root == data.merkle_hash(hashes)
+            assert tree.levels == data.MerkleTree(hashes).levels
+            for index in [0, len(hashes)//2, len(hashes) - 1] if hashes else []:
+                assert data.check_merkle_link(hashes[index], tree.get_link(index)) == tree.root
+    
+        tree.update([None] + hashes)
+        assert tree.get_link(0) == data.calculate_merkle_link([None] + hashes, 0)
+        assert data.check_merkle_link(0, tree.get_link(0)) == data.merkle_hash([0] + hashes)
+    
     def test_address_to_pubkey_hash(self):
         assert data.address_to_pubkey_hash('1KUCp7YP5FP8ViRxhfszSUJCTAajK6viGy', networks.nets['bitcoin']) == pack.IntType(160).unpack('ca975b00a8c203b8692f5a18d92dc5c2d2ebc57b'.decode('hex'))
     
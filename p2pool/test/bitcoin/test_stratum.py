@@ -0,0 +1,159 @@
+from __future__ import division
+
+import json
+import random
+import unittest
+
+from twisted.internet import defer, reactor
+from twisted.test import proto_helpers
+
+from p2pool.bitcoin import data, stratum, worker_interface
+from p2pool.test.bitcoin.fakes import FakeWorkerBridge
+from p2pool.util import jsonrpc, math, pack
+
+class FakeMiner(object):
+    def __init__(self):
+        self.difficulties = []
+    
+    def rpc_set_difficulty(self, difficulty):
+        self.difficulties.append(difficulty)
+        return defer.succeed(None)
+
+class Test(unittest.TestCase):
+    def test_vardiff(self):
+        max_target = 2**240
+        vd = stratum.VarDiff(1/6, max_target, max_target) # aim for 10 pseudoshares per minute
+        assert vd.get_hash_rate(vd.start) is None
+        hash_rate = data.target_to_average_attempts(max_target)*1000 # way above the initial difficulty
+        
+        now = vd.start
+        changes = 0
+        while now < vd.start + 3600:
+            attempts = data.target_to_average_attempts(vd.target)
+            now += random.expovariate(hash_rate/attempts)
+            changes += vd.got_pseudoshare(attempts, now)
+        assert 1 <= changes < 10 # doesn't retarget on every submit
+        assert 1/2 <= hash_rate/data.target_to_average_attempts(vd.target)/(1/6) <= 2
+        
+        # a miner that stops submitting gets an easier target, but never easier than max_target
+        target = vd.target
+        assert not vd.update(now + 1)
+        assert vd.update(now + 600)
+        assert max_target >= vd.target > target
+        for i in xrange(10):
+            vd.update(now + 600*(i + 2))
+        assert vd.target == max_target
+    
+    def test_caching_bridge_vardiff(self):
+        class Bridge(FakeWorkerBridge):
+            share_rate, share_rate_type = 20, 'miner'
+        
+        # main hands stratum a CachingWorkerBridge, so it has to pass on the share rate settings
+        wb = worker_interface.CachingWorkerBridge(Bridge())
+        provider = stratum.StratumRPCMiningProvider(wb, None, None, stratum.WorkBroadcaster(wb))
+        assert provider.vardiff is not None
+        assert provider.vardiff.target == data.difficulty_to_target_alt(1, Bridge.net.DUMB_SCRYPT_DIFF)
+        provider.close()
+    
+    def test_no_vardiff_without_share_rate(self):
+        class Bridge(FakeWorkerBridge):
+            share_rate_type = 'miner'
+        
+        # without --miner-share-rate the node-wide pseudoshare target applies
+        wb = Bridge()
+        provider = stratum.StratumRPCMiningProvider(wb, None, None, stratum.WorkBroadcaster(wb))
+        assert provider.vardiff is None
+        assert provider.get_work_args()[-1] is None
+        provider.close()
+    
+    def test_vardiff_counts_accepted_submits(self):
+        class Bridge(FakeWorkerBridge):
+            share_rate, share_rate_type = 20, 'miner'
+        
+        wb = Bridge()
+        provider = stratum.StratumRPCMiningProvider(wb, math.Object(svc_mining=FakeMiner()), proto_helpers.StringTransport(), stratum.WorkBroadcaster(wb))
+        x, got_response = wb.get_work(*provider.get_work_args())
+        results = [False, False, True] # got_response is false for stale, hash > target and duplicate submits
+        provider.send_job(*stratum.make_job('job', x, lambda header, user, coinbase_nonce: results.pop(0), True))
+        
+        for i in xrange(2):
+            assert provider.rpc_submit('worker', 'job', '00'*wb.COINBASE_NONCE_LENGTH, '00'*4, '00'*4) is False
+        assert provider.vardiff.work == 0
+        assert provider.rpc_submit('worker', 'job', '00'*wb.COINBASE_NONCE_LENGTH, '00'*4, '00'*4) is True
+        assert provider.vardiff.work == data.target_to_average_attempts(x['share_target'])
+        provider.close()
+    
+    def test_broadcast(self):
+        wb = FakeWorkerBridge()
+        broadcaster = stratum.WorkBroadcaster(wb)
+        broadcaster.chunk_size = 3
+        miners = [FakeMiner() for i in xrange(10)]
+        providers = [stratum.StratumRPCMiningProvider(wb, math.Object(svc_mining=miner), proto_helpers.StringTransport(), broadcaster) for miner in miners]
+        assert len(set(provider.extranonce1 for provider in providers)) == 10
+        assert all(len(provider.extranonce1) == 4 for provider in providers)
+        
+        broadcaster.send_work(providers[0])
+        wb.refresh_work_event.happened()
+        wb.new_work_event.happened() # coalesced with the refresh, as none of it was sent yet
+        while broadcaster.delayed is not None:
+            broadcaster.delayed.cancel()
+            broadcaster._send_chunk()
+        assert broadcaster.get_stats()['last_connections'] == 10 and broadcaster.get_stats()['last_chunks'] == 4
+        
+        notifies = [[json.loads(line) for line in provider.transport.value().splitlines()] for provider in providers]
+        assert [[notify['params'][-1] for notify in x] for x in notifies] == [[True, True]] + [[True]]*9 # only new work cleans jobs
+        assert len(set(x[-1]['params'][0] for x in notifies)) == 1 # all share the same job
+        assert wb.get_work_count == 2
+        assert all(len(miner.difficulties) == 1 for miner in miners) # difficulty didn't change
+        
+        wb.refresh_work_event.happened()
+        providers[1].close()
+        while broadcaster.delayed is not None:
+            broadcaster.delayed.cancel()
+            broadcaster._send_chunk()
+        assert [len(provider.transport.value().splitlines()) for provider in providers] == [3, 1] + [2]*8
+        assert json.loads(providers[0].transport.value().splitlines()[-1])['params'][-1] is False
+    
+    def test_broadcast_duration(self):
+        wb = FakeWorkerBridge()
+        broadcaster = stratum.WorkBroadcaster(wb)
+        now = [1000]
+        time, stratum.time = stratum.time, math.Object(time=lambda: now[0])
+        try:
+            wb.new_work_event.happened() # no connections, so nothing starts timing
+            assert broadcaster.fanout_start is None and broadcaster.delayed is None
+            now[0] += 2
+            provider = stratum.StratumRPCMiningProvider(wb, math.Object(svc_mining=FakeMiner()), proto_helpers.StringTransport(), broadcaster)
+            wb.new_work_event.happened()
+            broadcaster.delayed.cancel()
+            broadcaster._send_chunk()
+        finally:
+            stratum.time = time
+        assert broadcaster.get_stats()['last_duration'] == 0 and broadcaster.get_stats()['last_connections'] == 1
+        provider.close()
+    
+    def test_submit_fast_path(self):
+        wb = FakeWorkerBridge()
+        proto = stratum.StratumServerFactory(wb).buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        
+        proto.lineReceived(json.dumps(dict(id=1, method='mining.subscribe', params=[])))
+        proto.lineReceived(json.dumps(dict(id=2, method='mining.submit', params=['worker', 'unknown job', '00'*4, '00'*4, '00'*4])))
+        def stale_submit(*params):
+            raise jsonrpc.Error_for_code(21)(u'Job not found')
+        proto.fast_methods['mining.submit'] = stale_submit
+        proto.lineReceived(json.dumps(dict(id=3, method='mining.submit', params=[])))
+        responses = dict((x['id'], x) for x in map(json.loads, proto.transport.value().splitlines()))
+        assert responses[1]['result'][1] == proto.svc_mining.extranonce1.encode('hex')
+        assert responses[2]['result'] is False and responses[2]['error'] is None
+        assert responses[3]['result'] is None and responses[3]['error']['code'] == 21
+        for call in reactor.getDelayedCalls(): # work sent after subscribing
+            call.cancel()
+    
+    def test_get_merkle_root(self):
+        for i in xrange(20):
+            branch = [random.randrange(2**256) for j in xrange(random.randrange(13))]
+            link = dict(branch=branch, index=random.randrange(2**len(branch)))
+            packed_gentx = ''.join(chr(random.randrange(256)) for j in xrange(100))
+            assert stratum.get_merkle_root(packed_gentx, [pack.IntType(256).pack(h) for h in branch], link['index']) == \
+                data.check_merkle_link(data.hash256(packed_gentx), link)
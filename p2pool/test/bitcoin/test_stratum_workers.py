@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from twisted.internet import reactor
+from twisted.test import iosim, proto_helpers
+
+from p2pool.bitcoin import stratum_workers
+from p2pool.test.bitcoin.fakes import FakeWorkerBridge
+
+class Test(unittest.TestCase):
+    def test_worker(self):
+        wb = FakeWorkerBridge(pubkey_hash=1234, share_target=2**256-1, coinb1='\x01', coinb2='\x02', merkle_branch=[5])
+        server = stratum_workers.WorkerServer(wb)
+        stratum_factories = []
+        client_factory = stratum_workers.ControlClientFactory(wb.net, 3, stratum_factories.append)
+        server_protocol, client_protocol = server.buildProtocol(None), client_factory.buildProtocol(None)
+        pump = iosim.connect(server_protocol, iosim.makeFakeServer(server_protocol), client_protocol, iosim.makeFakeClient(client_protocol))
+        pump.flush()
+        
+        stratum_protocol = stratum_factories[0].buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        stratum_protocol.makeConnection(transport)
+        stratum_protocol.lineReceived(json.dumps(dict(id=1, method='mining.subscribe', params=[])))
+        assert json.loads(transport.value())['result'][1].startswith('03') # the worker's index
+        broadcaster = client_protocol.broadcaster
+        broadcaster.send_work(stratum_protocol.svc_mining)
+        pump.flush()
+        jobid = json.loads(transport.value().splitlines()[-1])['params'][0]
+        
+        def submit(jobid, nonce):
+            transport.clear()
+            stratum_protocol.lineReceived(json.dumps(dict(id=2, method='mining.submit', params=['user', jobid, '00000000', '00000000', nonce])))
+            return json.loads(transport.value())['result']
+        assert submit(jobid, '00000001') and submit(jobid, '00000002')
+        assert not submit(jobid, '00000002') # duplicate
+        broadcaster.report()
+        pump.flush()
+        assert wb.checked == [('user', 1234, server.handlers[jobid][1], True, 2, 0, 1)]
+        assert server.get_stats()['connections'] == 1 and server.get_stats()['checked_submits'] == 3
+        
+        # new work makes old jobs dead, and submits that could be shares are passed on to the main process
+        wb.candidate_target = 2**256-1
+        wb.new_work_event.happened()
+        pump.flush()
+        broadcaster.delayed.cancel()
+        broadcaster.send_work(stratum_protocol.svc_mining)
+        pump.flush()
+        jobid2 = json.loads(transport.value().splitlines()[-1])['params'][0]
+        assert not submit(jobid, '00000003')
+        assert submit(jobid2, '00000003')
+        pump.flush()
+        assert len(wb.responses) == 1
+        header, user, coinbase_nonce = wb.responses[0]
+        assert user == 'user' and coinbase_nonce[0] == '\x03' and len(coinbase_nonce) == 8 and header['nonce'] == 3
+        assert server.get_stats()['forwarded_submits'] == 1
+        
+        broadcaster.stop()
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+    
+    def test_listener_family(self):
+        wb = FakeWorkerBridge()
+        datadir = tempfile.mkdtemp()
+        try:
+            hosts = [('127.0.0.1', socket.AF_INET), ('', socket.AF_INET)] + ([('::1', socket.AF_INET6)] if socket.has_ipv6 else [])
+            for host, family in hosts:
+                server = stratum_workers.WorkerServer(wb)
+                try:
+                    server.start(os.path.join(datadir, 'stratum_workers.sock'), (host, 0), 0)
+                except socket.error: # no IPv6 on this host
+                    assert family == socket.AF_INET6
+                    server.control_port.stopListening()
+                    continue
+                try:
+                    assert server.listener.family == family
+                finally:
+                    server.listener.close()
+                    server.control_port.stopListening()
+        finally:
+            shutil.rmtree(datadir)
@@ -0,0 +1,48 @@
+import unittest
+
+from p2pool.bitcoin import data, txstore
+
+def make_tx(i, size=100):
+    return data.Transaction(version=1, tx_ins=[], tx_outs=[dict(value=i, script='x'*size)], lock_time=0)
+
+class Test(unittest.TestCase):
+    def test_tx_store(self):
+        txs = [make_tx(i) for i in xrange(10)]
+        tx_size = data.tx_type.packed_size(txs[0])
+        hashes = map(data.get_tx_hash, txs)
+        store = txstore.TxStore(max_size=5*tx_size)
+        removed = []
+        store.known_txs_var.removed.watch(lambda items: removed.extend(items))
+        
+        assert store.add(dict(zip(hashes[:3], txs[:3]))) == dict(zip(hashes[:3], txs[:3]))
+        store.incref(hashes[:2])
+        store.set_refs('mining', hashes[1:3] + [12345]) # unknown hashes are ignored
+        assert store.ref_sets['mining'] == set(hashes[1:3])
+        
+        # an equal copy of a known transaction is replaced by the stored one
+        copy = make_tx(0)
+        assert store.add({hashes[0]: copy})[hashes[0]] is txs[0]
+        
+        store.add(dict(zip(hashes[3:8], txs[3:8])))
+        assert store.size == 8*tx_size and not removed # a batch is never evicted by its own add
+        store.add({hashes[8]: txs[8]})
+        assert store.size == 5*tx_size
+        assert len(removed) == 4 and set(removed) < set(hashes[3:8]) # least recently added unreferenced ones go first
+        
+        assert store.get_stats()['referenced_over_budget_size'] == 0
+        store.max_size = tx_size
+        assert store.get_stats()['referenced_over_budget_size'] == 2*tx_size
+        store.max_size = 5*tx_size
+        
+        store.decref(hashes[:2]) # tx 1 is still referenced by 'mining'
+        assert store.get_stats()['referenced_count'] == 2
+        store.max_size = 3*tx_size
+        store.set_refs('mining', [])
+        assert set(removed) == set(hashes[3:9])
+        assert set(store.known_txs_var.value) == set(hashes[:3])
+        
+        stats = store.get_stats()
+        assert stats['count'] == 3 and stats['size'] == 3*tx_size and stats['referenced_count'] == stats['referenced_size'] == 0
+        assert stats['evicted_count'] == 6 and stats['evicted_size'] == 6*tx_size
+        
+        self.assertRaises(KeyError, store.incref, [hashes[3]])
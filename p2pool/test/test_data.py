@@ -1,14 +1,56 @@
+import os
 import random
+import shutil
+import tempfile
+import types
 import unittest
 
-from p2pool import data
-from p2pool.bitcoin import data as bitcoin_data
+from p2pool import data, networks, p2p # p2p is imported by Share.check, which can't find it once trial has changed directories
+from p2pool.bitcoin import data as bitcoin_data, networks as bitcoin_networks
 from p2pool.test.util import test_forest
-from p2pool.util import forest
+from p2pool.util import forest, math
 
 def random_bytes(length):
     return ''.join(chr(random.randrange(2**8)) for i in xrange(length))
 
+def get_test_net():
+    # veil's share chain on a parent with a pure python PoW function, where any hash is a valid share. it's not in
+    # networks.nets, like the nets dev/ benchmarks make
+    net = types.ModuleType('test_net')
+    net.__dict__.update(networks.nets['veil'].__dict__)
+    net.NAME = 'test_net'
+    net.PARENT = bitcoin_networks.nets['bitcoin']
+    net.MAX_TARGET = 2**256 - 1
+    return net
+
+def generate_shares(net, count, new_transaction_hashes=None):
+    bits = bitcoin_data.FloatingInteger.from_target_upper_bound(net.MAX_TARGET)
+    previous_hash = None
+    for i in xrange(count):
+        tx_hashes = [random.randrange(2**256)] if new_transaction_hashes is None else new_transaction_hashes[i]
+        share = data.Share(net, None, dict(
+            min_header=dict(version=4, previous_block=random.randrange(2**256), timestamp=1500000000 + 15*i, bits=bits, nonce=random.randrange(2**32)),
+            share_info=dict(
+                share_data=dict(previous_share_hash=previous_hash, coinbase='\x01\x02' + random_bytes(20), nonce=0,
+                    pubkey_hash=random.randrange(2**159, 2**160), pubkey_hash_version=net.PARENT.ADDRESS_VERSION,
+                    subsidy=5000000000, donation=0, stale_info=None, desired_version=data.Share.VOTING_VERSION),
+                new_transaction_hashes=tx_hashes,
+                transaction_hash_refs=[x for j in xrange(len(tx_hashes)) for x in [0, j]],
+                far_share_hash=None,
+                max_bits=bits,
+                bits=bits,
+                timestamp=1500000000 + 15*i,
+                absheight=i + 1,
+                abswork=0,
+            ),
+            ref_merkle_link=dict(branch=[], index=0),
+            last_txout_nonce=0,
+            hash_link=data.prefix_to_hash_link(random_bytes(200) + data.Share.gentx_before_refhash, data.Share.gentx_before_refhash),
+            merkle_link=dict(branch=[], index=0),
+        ))
+        previous_hash = share.hash
+        yield share
+
 class Test(unittest.TestCase):
     def test_hashlink1(self):
         for i in xrange(100):
@@ -39,3 +81,311 @@ class Test(unittest.TestCase):
         for i in xrange(200):
             a = random.randrange(200)
             d(a, random.randrange(a + 1), 1000000*65535)[1]
+    
+    def test_weights_window(self):
+        t = data.OkayTracker(networks.nets['veil'])
+        skiplist = data.WeightsSkipList(t)
+        scripts = [random_bytes(25) for i in xrange(10)]
+        heads = [None]
+        for i in xrange(400):
+            previous_hash = heads[-1] if random.random() < .9 else random.choice(heads)
+            target = random.choice([2**240, 2**241, 2**245])
+            t.add(test_forest.FakeShare(hash=i, previous_hash=previous_hash, new_script=random.choice(scripts), target=target, max_target=2**250,
+                work=bitcoin_data.target_to_average_attempts(target), desired_version=16,
+                share_data=dict(donation=random.choice([0, 0, 1234, 65535]), stale_info=None)))
+            heads.append(i)
+            
+            for max_shares, desired_weight in [(50, 65535*2**256), (100, 65535*2**19), (100, 65535*2**14)]:
+                start = i if random.random() < .8 else random.choice(heads[1:])
+                max_shares = min(max_shares, t.get_height(start))
+                assert t.get_cumulative_weights(start, max_shares, desired_weight) == skiplist(start, max_shares, desired_weight)
+        
+        # verifying a chain walks its starts down one share at a time, with desired_weight following each share's block
+        # target and max_shares following the height while it is short
+        for start in [share.hash for share in t.get_chain(399, t.get_height(399))]:
+            for max_shares in [100, t.get_height(start)]:
+                max_shares = min(max_shares, t.get_height(start))
+                desired_weight = 65535*random.choice([2**17, 2**18, 2**19])
+                assert t.get_cumulative_weights(start, max_shares, desired_weight) == skiplist(start, max_shares, desired_weight)
+        
+        # windows don't hold on to shares dropped from the tail
+        for share_hash in xrange(300):
+            if t.items[share_hash].previous_hash not in t.items:
+                t.remove(share_hash)
+        for start in t.heads:
+            max_shares = min(100, t.get_height(start))
+            assert t.get_cumulative_weights(start, max_shares, 65535*2**256) == skiplist(start, max_shares, 65535*2**256)
+    
+    def test_chain_stats(self):
+        for compact in [False, True]:
+            t = data.OkayTracker(networks.nets['veil'], compact=compact)
+            shares = []
+            for i in xrange(300):
+                target = random.choice([2**240, 2**241, 2**245])
+                shares.append(test_forest.FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None, timestamp=i*15, target=target, max_target=2**250,
+                    work=bitcoin_data.target_to_average_attempts(target), desired_version=random.choice([16, 16, 17, 17, 18]),
+                    share_data=dict(stale_info=random.choice([None, None, None, 'orphan', 'doa', 'unk5']))))
+            for share in math.shuffled(shares):
+                t.add(share)
+            
+            for i in xrange(100):
+                share_hash = random.randrange(300)
+                lookbehind = random.randrange(1, share_hash + 2)
+                chain = list(t.get_chain(share_hash, lookbehind))
+                
+                stales = sum(1 for share in chain if share.share_data['stale_info'] is not None)
+                assert data.get_average_stale_prop(t, share_hash, lookbehind) == stales/float(lookbehind + stales)
+                
+                counts = {}
+                for share in chain[:-1]:
+                    for key in ['good', share.share_data['stale_info']]:
+                        if key is not None:
+                            counts[key] = counts.get(key, 0) + share.work
+                assert data.get_stale_counts(t, share_hash, lookbehind) == counts
+                
+                counts = {}
+                for share in chain:
+                    counts[share.desired_version] = counts.get(share.desired_version, 0) + share.work
+                assert data.get_desired_version_counts(t, share_hash, lookbehind) == counts
+    
+    def test_generate_transaction_template(self):
+        net = networks.nets['veil']
+        tracker = data.OkayTracker(net)
+        share_data = dict(previous_share_hash=None, coinbase='\x01\x02', nonce=None, pubkey_hash=random.randrange(2**160),
+            pubkey_hash_version=net.PARENT.ADDRESS_VERSION, subsidy=5000000000, donation=0, stale_info=None, desired_version=16)
+        hashes_and_fees = [(random.randrange(2**256), random.randrange(10000)) for i in xrange(20)]
+        finish = data.Share.generate_transaction_template(tracker, share_data, 2**230, dict(branch=[], index=0), hashes_and_fees, net)
+        
+        results = []
+        for nonce in [0, 1]:
+            res = finish(nonce, 1500000000 + nonce, 2**240 + nonce)
+            assert res[:3] == data.Share.generate_transaction(tracker, dict(share_data, nonce=nonce), 2**230, 1500000000 + nonce, 2**240 + nonce,
+                dict(branch=[], index=0), hashes_and_fees, net)[:3]
+            results.append(res)
+        assert results[0][1] != results[1][1]
+    
+    def test_lazy_share(self):
+        net = networks.nets['veil']
+        contents = dict(
+            min_header=dict(version=4, previous_block=random.randrange(2**256), timestamp=1500000000, bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**240), nonce=0),
+            share_info=dict(
+                share_data=dict(previous_share_hash=random.randrange(2**256), coinbase='\x01\x02', nonce=0, pubkey_hash=random.randrange(2**160),
+                    pubkey_hash_version=net.PARENT.ADDRESS_VERSION, subsidy=5000000000, donation=1234, stale_info=None, desired_version=16),
+                new_transaction_hashes=[random.randrange(2**256)],
+                transaction_hash_refs=[0, 0],
+                far_share_hash=None,
+                max_bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**250),
+                bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**245),
+                timestamp=1500000001,
+                absheight=10,
+                abswork=2**40,
+            ),
+            ref_merkle_link=dict(branch=[], index=0),
+            last_txout_nonce=0,
+            hash_link=dict(state='\x00'*32, extra_data='', length=0),
+            merkle_link=dict(branch=[], index=0),
+        )
+        packed = data.Share.get_dynamic_types(net)['share_type'].pack(contents)
+        share = data.load_lazy_share(dict(type=data.Share.VERSION, contents=packed), net, 1234)
+        assert type(share) is data.Share
+        assert share.hash == 1234
+        assert share.previous_hash == contents['share_info']['share_data']['previous_share_hash']
+        assert share.target == contents['share_info']['bits'].target
+        assert share.max_target == contents['share_info']['max_bits'].target
+        assert share.work == bitcoin_data.target_to_average_attempts(share.target)
+        assert share.timestamp == 1500000001
+        assert share.as_share() == dict(type=data.Share.VERSION, contents=packed)
+        assert not hasattr(share, '__dict__')
+        assert share.share_type is data.Share.get_dynamic_types(net)['share_type']
+        
+        share2 = data.load_lazy_share(dict(type=data.Share.VERSION, contents=packed), net, 1235)
+        assert share2.new_script is share.new_script
+        assert share2.share_data['pubkey_hash'] is share.share_data['pubkey_hash']
+    
+    def test_broken_lazy_share(self):
+        net = get_test_net()
+        for compact in [False, True]:
+            shares = list(generate_shares(net, 4))
+            # share 2's stored contents don't hash to its stored hash, which only shows when it's materialized
+            broken = dict(shares[2].as_share(), contents=shares[2].share_type.pack(dict(shares[2].contents, last_txout_nonce=1)))
+            lazy_shares = [data.load_lazy_share(broken if i == 2 else share.as_share(), net, share.hash) for i, share in enumerate(shares)]
+            for i in xrange(2):
+                try:
+                    lazy_shares[2].header
+                except data.LazyShareError, e:
+                    assert e.share_hash == shares[2].hash
+                else:
+                    assert False
+            assert lazy_shares[2]._lazy_contents is not None and lazy_shares[2].hash == shares[2].hash
+            
+            tracker = data.OkayTracker(net, compact=compact)
+            for share in lazy_shares:
+                tracker.add(share)
+            for share in lazy_shares[:3]:
+                tracker.verified.add(share)
+            # verifying share 3 materializes share 2, which drops share 2 and everything built on it
+            best, desired, decorated_heads, bad_peer_addresses = tracker.think(lambda block_hash: 0, shares[1].header['previous_block'], shares[1].header['bits'], {})
+            assert best == shares[1].hash
+            assert set(tracker.items) == set(tracker.verified.items) == set(share.hash for share in shares[:2])
+    
+    def test_share_store_verified_hashes(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(dirname, 'shares.')
+            hashes = [random.randrange(2**256) for i in xrange(300)]
+            with open(prefix + '0', 'wb') as f:
+                for h in hashes[:100]:
+                    f.write('2 %x\n' % (h,))
+            
+            loaded = []
+            ss = data.ShareStore(prefix, None, None, loaded.append)
+            assert loaded == hashes[:100]
+            assert open(prefix + '0', 'rb').read().startswith(data.SHARE_STORE_MAGIC) # converted
+            
+            ss.max_file_size = 2000
+            for h in hashes[100:]:
+                ss.add_verified_hash(h)
+            assert len(ss.known) > 2
+            assert len(ss.verified_files) == len(hashes)
+            ss.add_verified_hash(hashes[1]) # already stored
+            assert sum(len(verified_hashes) for share_hashes, verified_hashes in ss.known.itervalues()) == len(hashes)
+            ss.forget_verified_share(hashes[0])
+            assert not os.path.exists(prefix + str(len(ss.known) - 1)) # not flushed yet
+            ss.flush()
+            
+            loaded = []
+            ss = data.ShareStore(prefix, None, None, loaded.append)
+            assert sorted(loaded) == sorted(hashes)
+            assert len(ss.open_indexes) == 1
+            
+            for h in hashes[:100]:
+                ss.forget_verified_share(h)
+            assert not os.path.exists(prefix + '0')
+            assert sorted(ss.verified_files) == sorted(hashes[100:])
+            
+            with open(ss.open_indexes.keys()[0], 'ab') as f:
+                f.write('\x02' + '\x00'*10) # partially written record
+            loaded = []
+            data.ShareStore(prefix, None, None, loaded.append)
+            assert sorted(loaded) == sorted(hashes[100:])
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_share_store_shares(self):
+        net = get_test_net()
+        shares = list(generate_shares(net, 40))
+        dirname = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(dirname, 'shares.')
+            ss = data.ShareStore(prefix, net, None, None)
+            ss.max_file_size = 4000
+            for share in shares:
+                ss.add_share(share)
+                ss.add_verified_hash(share.hash)
+            ss.flush()
+            assert len(ss.known) > 2
+            for filename in ss.known:
+                if filename not in ss.open_indexes:
+                    assert open(filename, 'rb').read().endswith(data.SHARE_STORE_INDEX_MAGIC)
+            
+            loaded = []
+            verified = []
+            data.ShareStore(prefix, net, loaded.append, verified.append)
+            loaded = dict((share.hash, share) for share in loaded)
+            assert sorted(loaded) == sorted(share.hash for share in shares)
+            for share in shares:
+                assert loaded[share.hash].as_share() == share.as_share()
+            assert sorted(verified) == sorted(loaded)
+            assert loaded[shares[0].hash].pow_hash == shares[0].pow_hash # materialized, PoW hash from the cache
+            
+            loaded = []
+            ss = data.ShareStore(prefix, net, loaded.append, lambda share_hash: None, verify_pow=True)
+            assert sorted(share.hash for share in loaded) == sorted(share.hash for share in shares)
+            assert (ss.pow_cache.hits, ss.pow_cache.misses) == (0, len(shares)) # every share's PoW was recomputed while loading
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_share_store_pool(self):
+        net = get_test_net() # only known to this process
+        shares = list(generate_shares(net, 30))
+        dirname = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(dirname, 'shares.')
+            ss = data.ShareStore(prefix, net, None, None)
+            for share in shares:
+                ss.add_share(share)
+            ss.flush()
+            
+            loaded = []
+            pool = data.make_share_check_pool(net, 2)
+            try:
+                ss = data.ShareStore(prefix, net, loaded.append, None, verify_pow=True, pool=pool)
+            finally:
+                pool.close()
+                pool.join()
+            assert sorted(share.hash for share in loaded) == sorted(share.hash for share in shares)
+            assert ss.pow_cache.misses == 0 # all checked by the pool
+            assert loaded[0].pow_hash == shares[0].pow_hash
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_share_store_compact(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(dirname, 'shares.')
+            hashes = [random.randrange(2**256) for i in xrange(200)]
+            ss = data.ShareStore(prefix, None, None, None)
+            ss.max_file_size = 2000
+            for h in hashes:
+                ss.add_verified_hash(h)
+            ss.flush()
+            
+            first_hashes = sorted(ss.known[prefix + '0'][1])
+            for h in first_hashes[1:]:
+                ss.forget_verified_share(h)
+            size = os.path.getsize(prefix + '0')
+            ss.compact()
+            assert os.path.getsize(prefix + '0') < size
+            assert ss.known[prefix + '0'][1] == set(first_hashes[:1])
+            ss.compact() # nothing left to do
+            
+            ss.add_verified_hash(first_hashes[1]) # dropped by the compaction, so stored again
+            assert ss.verified_files[first_hashes[1]] != prefix + '0'
+            ss.flush()
+            
+            loaded = []
+            data.ShareStore(prefix, None, None, loaded.append)
+            assert sorted(loaded) == sorted(set(hashes) - set(first_hashes[2:]))
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_pow_hash_cache(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(dirname, 'shares.pow')
+            c = data.PowHashCache(filename)
+            assert c.get(1) is None
+            c.add(1, 10)
+            c.add(2, 20)
+            c.add(2, 20)
+            assert c.get(1) == 10
+            assert (c.hits, c.misses) == (1, 1)
+            c.flush()
+            
+            with open(filename, 'ab') as f:
+                f.write('\x00'*5) # partially written entry
+            c = data.PowHashCache(filename)
+            assert c.pow_hashes == {1: 10, 2: 20}
+            assert os.path.getsize(filename) == 2*data.pow_cache_entry_size
+            
+            c.prune([2, 3])
+            assert data.PowHashCache(filename).pow_hashes == {2: 20}
+            
+            c = data.PowHashCache(filename, trusted=False)
+            assert 2 not in c
+            assert c.get(2) is None
+            c.add(2, 20)
+            assert c.get(2) == 20
+            assert (c.hits, c.misses) == (1, 1)
+        finally:
+            shutil.rmtree(dirname)
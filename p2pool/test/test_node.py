@@ -11,6 +11,7 @@ from twisted.web import client, resource, server
 
 from p2pool import data, node, work, main
 from p2pool.bitcoin import data as bitcoin_data, networks, worker_interface
+from p2pool.test import test_data
 from p2pool.util import deferral, jsonrpc, math, variable
 
 class bitcoind(object): # can be used as p2p factory, p2p protocol, or rpc jsonrpc proxy
@@ -171,6 +172,34 @@ class MiniNode(object):
         del self.web_port, self.n
 
 class Test(unittest.TestCase):
+    def test_share_tx_refs(self):
+        net = test_data.get_test_net()
+        txs = [bitcoin_data.Transaction(version=1, tx_ins=[], tx_outs=[dict(value=i, script='')], lock_time=0) for i in xrange(125)]
+        tx_hashes = map(bitcoin_data.get_tx_hash, txs)
+        shares = list(test_data.generate_shares(net, 125, [[tx_hash] for tx_hash in tx_hashes]))
+        n = node.Node(None, None, [], [], net, tx_store_size=0)
+        n.mining_txs_var = variable.Variable({}) # normally set up by start
+        n.best_share_var = variable.Variable(None)
+        n.best_share_var.changed.watch(lambda _: n.set_share_tx_refs())
+        n.set_best_share = lambda: n.best_share_var.set(shares[-1].hash)
+        
+        node.P2PNode(n, port=0).handle_shares([(share, [tx]) for share, tx in zip(shares, txs)], None)
+        n.tx_store.decref([]) # evicts everything unreferenced
+        assert set(n.tx_store.known_txs_var.value) == set(tx_hashes[5:]) # only referenced by the last 120 shares
+        stats = n.tx_store.get_stats()
+        assert stats['referenced_count'] == 120 and stats['referenced_over_budget_size'] == stats['referenced_size'] > 0
+        
+        n.best_share_var.set(shares[-3].hash)
+        assert set(n.tx_store.known_txs_var.value) == set(tx_hashes[5:-2])
+    
+    def test_lazy_shares_stay_lazy(self):
+        net = test_data.get_test_net()
+        shares = [data.load_lazy_share(share.as_share(), net, share.hash) for share in test_data.generate_shares(net, 3)]
+        n = node.Node(None, None, shares, [], net)
+        assert set(n.tracker.items) == set(share.hash for share in shares)
+        for share in shares:
+            assert share._lazy_contents is not None
+    
     @defer.inlineCallbacks
     def test_node(self):
         bitd = bitcoind()
@@ -1,12 +1,21 @@
 import random
+import struct
 
-from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.internet import address, defer, endpoints, protocol, reactor
+from twisted.test import iosim
 from twisted.trial import unittest
 
 from p2pool import networks, p2p
 from p2pool.bitcoin import data as bitcoin_data
-from p2pool.util import deferral
+from p2pool.test import test_data
+from p2pool.util import deferral, math
 
+def make_tx(i):
+    # tx_type writes lock_time after the outputs but reads it right after the segwit marker, so only transactions
+    # whose bytes read the same either way make it across the wire: ones made of a repeated 4 byte word
+    word = '\x01\x00\x01\x04'
+    return bitcoin_data.Transaction(version=i, marker=0, flag=1, tx_ins=[], witness=[], lock_time=struct.unpack('<I', word)[0],
+        tx_outs=[dict(value=struct.unpack('<Q', word[3:] + word + word[:3])[0], script=word)])
 
 class Test(unittest.TestCase):
     @defer.inlineCallbacks
@@ -77,3 +86,77 @@ class Test(unittest.TestCase):
             yield n.stop()
         finally:
             p2p.Protocol.max_remembered_txs_size //= 10
+    
+    def test_short_ids(self):
+        hashes = [random.randrange(2**256) for i in xrange(100)]
+        salt = p2p.get_short_id_salt(1234, 5678)
+        assert salt != p2p.get_short_id_salt(1235, 5678) and salt != p2p.get_short_id_salt(1234, 5679)
+        assert p2p.get_short_id_index(salt, hashes) == dict((p2p.get_short_id(salt, tx_hash), tx_hash) for tx_hash in hashes)
+        assert p2p.get_short_id(salt, hashes[0]) != p2p.get_short_id(salt + 1, hashes[0])
+        
+        # transactions that share a short id resolve to neither
+        class ConstantHash(object):
+            def __init__(self, data=''): pass
+            def copy(self): return self
+            def update(self, data): pass
+            def digest(self): return '\x00'*32
+        hashlib, p2p.hashlib = p2p.hashlib, math.Object(sha256=ConstantHash)
+        try:
+            assert p2p.get_short_id_index(salt, hashes[:1]) == {0: hashes[0]}
+            assert p2p.get_short_id_index(salt, hashes) == {0: None}
+        finally:
+            p2p.hashlib = hashlib
+        
+        assert p2p.get_tx_hashes_check(hashes) != p2p.get_tx_hashes_check(hashes[::-1])
+    
+    def test_compact_shares(self):
+        net = test_data.get_test_net()
+        net.MINIMUM_PROTOCOL_VERSION = p2p.Protocol.VERSION
+        txs = map(make_tx, xrange(5))
+        hashes = map(bitcoin_data.get_tx_hash, txs)
+        share1, share2 = test_data.generate_shares(net, 2, [hashes[:3], hashes[3:]])
+        
+        sender, receiver = p2p.Node(lambda: None, 0, net, advertise_ip=False), p2p.Node(lambda: None, 0, net, advertise_ip=False)
+        sender.tx_store.add(dict(zip(hashes, txs)))
+        receiver.tx_store.add(dict(zip(hashes[:2], txs[:2])))
+        received = []
+        receiver.handle_shares = lambda shares, peer: received.append(shares)
+        
+        server, client = p2p.Protocol(sender, True), p2p.Protocol(receiver, False)
+        server.factory, client.factory = sender.serverfactory, receiver.clientfactory
+        sender_addr, receiver_addr = address.IPv4Address('TCP', '127.0.0.1', 9333), address.IPv4Address('TCP', '127.0.0.1', 50000)
+        pump = iosim.connect(server, iosim.FakeTransport(server, True, sender_addr, receiver_addr), client, iosim.FakeTransport(client, False, receiver_addr, sender_addr))
+        assert server.remote_tx_hashes == set(hashes[:2])
+        
+        # the sender wrongly thinks the receiver has txs 2 and 3, so their short ids are sent without the txs. the
+        # receiver gets tx 2 with txreq, but the sender has forgotten tx 3 by the time it's asked for it
+        server.remote_tx_hashes.update(hashes[2:4])
+        server.sendShares([share1, share2], None, sender.known_txs_var.value)
+        sender.tx_store.incref(hashes[2:3])
+        sender.tx_store.max_size = 0
+        sender.tx_store.decref([]) # evicts everything else
+        indexed_salts = []
+        get_short_id_index = p2p.get_short_id_index
+        p2p.get_short_id_index = lambda salt, tx_hashes: indexed_salts.append(salt) or get_short_id_index(salt, tx_hashes)
+        try:
+            pump.flush()
+        finally:
+            p2p.get_short_id_index = get_short_id_index
+        
+        assert indexed_salts == [p2p.get_short_id_salt(share1.hash, sender.nonce)] # both shares use one index
+        assert [[(share.hash, share_txs) for share, share_txs in shares] for shares in received] == [[(share1.hash, txs[:3])]]
+        assert received[0][0][0].share_info['new_transaction_hashes'] == hashes[:3]
+        assert server.remote_tx_hashes >= set(hashes[2:5]) # tx 4 was included and tx 2 was sent with txreply
+        assert receiver.peers and sender.peers # not being able to complete a share isn't misbehaving
+        assert sorted(server.sent_tx_hashes_expiries) == sorted([share1.hash, share2.hash])
+        expiries = server.sent_tx_hashes_expiries.values()
+        
+        # a salt the receiver hasn't indexed with yet would make it index all known transactions again
+        server.send_cmpctshares(shares=[dict(hash=share2.hash, salt_hash=share1.hash, share=dict(type=share2.VERSION,
+            contents=share2.share_type.pack(share2.contents)), short_ids=[], check=0, txs=[])])
+        pump.flush()
+        assert not receiver.peers and not sender.peers
+        assert not any(expiry.active() for expiry in expiries) and not server.sent_tx_hashes_expiries
+        
+        for call in reactor.getDelayedCalls():
+            call.cancel()
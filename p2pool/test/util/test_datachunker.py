@@ -25,3 +25,17 @@ class Test(unittest.TestCase):
                 this = sb.get(x)
                 assert r[amount_removed:amount_removed+x] == this
                 amount_removed += x
+    
+    def test_buffered(self):
+        received = []
+        def receiver():
+            while True:
+                received.append((yield 3))
+                received.append((yield datachunker.Buffered(5)))
+        f = datachunker.DataChunker(receiver())
+        f('abcdefgh')
+        f('ijklmn')
+        f('op')
+        assert map(str, received) == ['abc', 'defgh', 'ijk', 'lmnop']
+        assert type(received[1]) is buffer # didn't span chunks
+        assert type(received[3]) is str
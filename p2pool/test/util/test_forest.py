@@ -99,17 +99,17 @@ def test_tracker(self):
         length = random.randrange(a[0])
         assert list(self.get_chain(start, length)) == list(t.get_chain(start, length))
 
-def generate_tracker_simple(n):
-    t = forest.Tracker(math.shuffled(FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None) for i in xrange(n)))
+def generate_tracker_simple(n, compact=False):
+    t = forest.Tracker(math.shuffled(FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None) for i in xrange(n)), compact=compact)
     test_tracker(t)
     return t
 
-def generate_tracker_random(n):
+def generate_tracker_random(n, compact=False):
     items = []
     for i in xrange(n):
         x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
         items.append(FakeShare(hash=i, previous_hash=x))
-    t = forest.Tracker(math.shuffled(items))
+    t = forest.Tracker(math.shuffled(items), compact=compact)
     test_tracker(t)
     return t
 
@@ -132,9 +132,37 @@ class Test(unittest.TestCase):
             res = t.get_nth_parent_hash(a, b)
             assert res == a - b, (a, b, res)
     
-    def test_tracker2(self):
+    def test_ancestor_table(self):
+        for ii in xrange(10):
+            items = []
+            for i in xrange(random.randrange(1, 300)):
+                x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
+                items.append(FakeShare(hash=i, previous_hash=x))
+            t = forest.Tracker(math.shuffled(items)) # parents are often added after their children
+            assert isinstance(t.get_nth_parent_hash, forest.AncestorTable)
+            d = DumbTracker(items)
+            for i in xrange(300):
+                a = random.choice(items).hash
+                b = random.randrange(d.get_height(a) + 1)
+                assert t.get_nth_parent_hash(a, b) == d.get_nth_parent_hash(a, b)
+            
+            for i in xrange(len(items)//2):
+                while True:
+                    try:
+                        t.remove(random.choice(list(t.items)))
+                    except NotImplementedError:
+                        pass
+                    else:
+                        break
+            assert set(t.get_nth_parent_hash.jumps) == set(t.items)
+            d = DumbTracker(t.items.itervalues())
+            for a in t.items:
+                b = random.randrange(d.get_height(a) + 1)
+                assert t.get_nth_parent_hash(a, b) == d.get_nth_parent_hash(a, b)
+    
+    def test_tracker2(self, compact=False):
         for ii in xrange(20):
-            t = generate_tracker_random(random.randrange(100))
+            t = generate_tracker_random(random.randrange(100), compact)
             #print "--start--"
             while t.items:
                 while True:
@@ -146,14 +174,14 @@ class Test(unittest.TestCase):
                         break
                 test_tracker(t)
     
-    def test_tracker3(self):
+    def test_tracker3(self, compact=False):
         for ii in xrange(10):
             items = []
             for i in xrange(random.randrange(100)):
                 x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
                 items.append(FakeShare(hash=i, previous_hash=x))
             
-            t = forest.Tracker()
+            t = forest.Tracker(compact=compact)
             test_tracker(t)
             
             for item in math.shuffled(items):
@@ -192,3 +220,68 @@ class Test(unittest.TestCase):
                     else:
                         break
                 test_tracker(t)
+    
+    def test_compact_tracker(self):
+        t = generate_tracker_simple(200, compact=True)
+        assert isinstance(t.ids, forest.IdTable)
+        for i in xrange(1000):
+            a = random.randrange(200)
+            b = random.randrange(a + 1)
+            assert t.get_nth_parent_hash(a, b) == a - b
+            assert t.get_delta(a, b).height == a - b
+        self.test_tracker2(compact=True)
+        self.test_tracker3(compact=True)
+    
+    def test_compact_tracker_deltas(self):
+        delta_type = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs, work=lambda item: item.work))
+        for ii in xrange(30):
+            items = []
+            for i in xrange(random.randrange(100)):
+                x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
+                items.append(FakeShare(hash=i, previous_hash=x, work=random.choice([1, 5, 2**70, 2**130])))
+            t, ct = forest.Tracker(delta_type=delta_type), forest.Tracker(delta_type=delta_type, compact=True)
+            
+            def check():
+                for item_hash in list(t.items) + [None, 2000001]:
+                    delta, compact_delta = t.get_delta_to_last(item_hash), ct.get_delta_to_last(item_hash)
+                    assert (delta.head, delta.tail, delta.height, delta.work) == (compact_delta.head, compact_delta.tail, compact_delta.height, compact_delta.work)
+            
+            # parents are often added after their children, and tails are removed, like when a node catches up
+            for item in math.shuffled(items) + math.shuffled(items):
+                if item.hash not in t.items:
+                    t.add(item)
+                    ct.add(item)
+                    check()
+                if random.randrange(3) == 0:
+                    while True:
+                        item_hash = random.choice(list(t.items))
+                        try:
+                            t.remove(item_hash)
+                        except NotImplementedError:
+                            pass
+                        else:
+                            ct.remove(item_hash)
+                            break
+                    check()
+            
+            while t.items:
+                while True:
+                    item_hash = random.choice(list(t.items))
+                    try:
+                        t.remove(item_hash)
+                    except NotImplementedError:
+                        pass
+                    else:
+                        ct.remove(item_hash)
+                        break
+                check()
+            assert not ct.ids.ids and not ct._refs # every id and ref is freed
+    
+    def test_wide_column(self):
+        c = forest.WideColumn()
+        c.extend(3)
+        c[0], c[1] = 5, 2**100 + 7
+        assert [c[0], c[1], c[2]] == [5, 2**100 + 7, 0]
+        c[2] = 2**130 # doesn't fit
+        c.extend(1)
+        assert [c[i] for i in xrange(len(c))] == [5, 2**100 + 7, 2**130, 0]
@@ -0,0 +1,58 @@
+import unittest
+import zlib
+
+from twisted.test import proto_helpers
+
+from p2pool.util import p2protocol, pack, variable
+
+class TestProtocol(p2protocol.Protocol):
+    message_blob = pack.ComposedType([
+        ('data', pack.VarStrType()),
+    ])
+    def handle_blob(self, data):
+        self.received.append(data)
+    
+    def badPeerHappened(self):
+        self.bad = True
+
+def make_protocol(traffic_happened):
+    p = TestProtocol('prefix', 100000, traffic_happened)
+    p.received = []
+    p.bad = False
+    p.makeConnection(proto_helpers.StringTransport())
+    return p
+
+class Test(unittest.TestCase):
+    def test_compression(self):
+        traffic = {}
+        traffic_happened = variable.Event()
+        traffic_happened.watch(lambda name, amount: traffic.__setitem__(name, traffic.get(name, 0) + amount))
+        a, b = make_protocol(traffic_happened), make_protocol(traffic_happened)
+        b.accept_compressed = True
+        
+        a.send_blob(data='x'*10000)
+        a.compress_threshold = 1000
+        a.send_blob(data='x'*10000)
+        a.send_blob(data='short')
+        data = a.transport.value()
+        assert data.count('compressed') == 1
+        assert len(data) < 10000*2
+        b.dataReceived(data)
+        assert b.received == ['x'*10000]*2 + ['short']
+        assert not b.bad
+        assert traffic['p2p/out_saved'] == traffic['p2p/in_saved'] > 9000
+        assert 'p2p/compress_time' in traffic and 'p2p/decompress_time' in traffic
+        
+        # ignored by peers that didn't ask for it
+        c = make_protocol(traffic_happened)
+        c.dataReceived(data)
+        assert c.received == ['x'*10000, 'short']
+    
+    def test_decompressed_too_long(self):
+        a, b = make_protocol(variable.Event()), make_protocol(variable.Event())
+        b.accept_compressed = True
+        bomb = zlib.compress(TestProtocol.message_blob.pack(dict(data='\0'*200000)))
+        a.message_compressed = pack.ComposedType([('data', pack.FixedStrType(12 + len(bomb)))])
+        a.send_compressed(data='blob'.ljust(12, '\0') + bomb)
+        b.dataReceived(a.transport.value())
+        assert b.bad and not b.received
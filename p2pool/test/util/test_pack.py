@@ -1,3 +1,6 @@
+import os
+import random
+import struct
 import unittest
 
 from p2pool.util import pack
@@ -9,3 +12,78 @@ class Test(unittest.TestCase):
             assert t.unpack(t.pack(i)) == i
         for i in xrange(2**36, 2**36+25):
             assert t.unpack(t.pack(i)) == i
+    
+    def test_compiled_composed_type(self):
+        fields = [
+            ('a', pack.IntType(8)),
+            ('b', pack.IntType(256)),
+            ('c', pack.PossiblyNoneType(0, pack.IntType(32))),
+            ('d', pack.IntType(16, 'big')),
+            ('e', pack.FixedStrType(3)),
+            ('f', pack.VarStrType()),
+            ('g', pack.IntType(64)),
+            ('h', pack.StaleInfoEnumType()),
+            ('i', pack.IntType(0)),
+        ]
+        t = pack.ComposedType(fields)
+        assert any(isinstance(type_, struct.Struct) for key, type_, codecs in t._plan)
+        for i in xrange(100):
+            item = dict(a=random.randrange(2**8), b=random.randrange(2**256), c=random.choice([None, random.randrange(1, 2**32)]),
+                d=random.randrange(2**16), e=os.urandom(3), f=os.urandom(random.randrange(10)), g=random.randrange(2**64),
+                h=random.choice([None, 'orphan', 'doa']), i=0)
+            packed = ''.join(type_.pack(item[key]) for key, type_ in fields)
+            assert t.pack(item) == packed
+            assert t.unpack(packed) == item
+        self.assertRaises(pack.EarlyEnd, t.unpack, packed[:20])
+        self.assertRaises(ValueError, t.pack, dict(item, c=0))
+        self.assertRaises(ValueError, t.pack, dict(item, e='ab'))
+        self.assertRaises(ValueError, t.pack, dict(item, h='unknown'))
+    
+    def test_list(self):
+        for inner, values in [
+            (pack.VarIntType(), [0, 1, 0xfc, 0xfd, 2**16, 2**32, 2**40]),
+            (pack.IntType(256), [0, 1, 2**256 - 1]),
+            (pack.PossiblyNoneType(0, pack.IntType(32)), [None, 1, 2**32 - 1]),
+        ]:
+            t = pack.ListType(inner)
+            for i in xrange(100):
+                item = [random.choice(values) for j in xrange(random.randrange(20))]
+                packed = pack.VarIntType().pack(len(item)) + ''.join(inner.pack(x) for x in item)
+                assert t.pack(item) == packed
+                assert t.unpack(packed) == item
+            if item:
+                self.assertRaises(pack.EarlyEnd, t.unpack, packed[:-1])
+        
+        for inner in [pack.IntType(32), pack.IntType(256)]:
+            # a huge length from a peer is rejected before anything its size is built
+            self.assertRaises(pack.EarlyEnd, pack.ListType(inner).unpack, pack.VarIntType().pack(2**62) + '\x00'*100)
+    
+    def test_type_hash(self):
+        for make in [
+            lambda: pack.ListType(pack.IntType(32)),
+            lambda: pack.ListType(pack.VarIntType(), 2),
+            lambda: pack.ComposedType([('a', pack.IntType(32)), ('b', pack.ListType(pack.IntType(256)))]),
+        ]:
+            a, b = make(), make()
+            assert a == b
+            assert hash(a) == hash(b)
+            assert len(set([a, b])) == 1
+        assert pack.ListType(pack.IntType(32)) != pack.ListType(pack.IntType(32), 2)
+    
+    def test_buffer_input(self):
+        t = pack.ComposedType([
+            ('a', pack.IntType(256)),
+            ('b', pack.VarStrType()),
+            ('c', pack.ListType(pack.VarIntType())),
+            ('d', pack.IntType(32)),
+            ('e', pack.IntType(16)),
+        ])
+        item = dict(a=random.randrange(2**256), b=os.urandom(100), c=[1, 300, 2**40], d=5, e=6)
+        packed = 'xx' + t.pack(item) + 'yy'
+        for data in [buffer(packed, 2, len(packed) - 4), memoryview(packed)[2:-2]]:
+            res = t.unpack(data)
+            assert res == item
+            assert type(res['b']) is str
+        assert t.unpack(buffer(packed, 2), ignore_trailing=True) == item
+        self.assertRaises(pack.LateEnd, t.unpack, buffer(packed, 2))
+        self.assertRaises(pack.EarlyEnd, t.unpack, memoryview(packed)[2:-5])
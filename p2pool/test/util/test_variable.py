@@ -0,0 +1,26 @@
+import unittest
+
+from p2pool.util import variable
+
+class Test(unittest.TestCase):
+    def test_variable_dict(self):
+        events = []
+        v = variable.VariableDict({})
+        v.added.watch(lambda added: events.append(('added', added)))
+        v.removed.watch(lambda removed: events.append(('removed', removed)))
+        v.changed.watch(lambda value: events.append(('changed', value)))
+        value = v.value
+        
+        v.add({1: 'a', 2: 'b'})
+        v.add({2: 'b'})
+        v.remove([1, 3])
+        v.remove([3])
+        v.set({2: 'b', 4: 'd'})
+        
+        assert v.value is value
+        assert value == {2: 'b', 4: 'd'}
+        assert events == [
+            ('added', {1: 'a', 2: 'b'}), ('changed', value),
+            ('removed', {1: 'a'}), ('changed', value),
+            ('added', {4: 'd'}), ('changed', value),
+        ]
@@ -1,5 +1,11 @@
 import collections
 
+class Buffered(int):
+    '''
+    yielded by DataChunker receivers instead of a plain length to get the data
+    as a buffer when it doesn't span several received chunks, avoiding a copy
+    '''
+
 class StringBuffer(object):
     'Buffer manager with great worst-case behavior'
     
@@ -30,6 +36,19 @@ class StringBuffer(object):
             data.append(seg)
             wants -= len(seg)
         return ''.join(data)
+    
+    def get_buffer(self, wants):
+        if self.buf_len - self.pos < wants:
+            raise IndexError('not enough data')
+        if self.pos + wants > len(self.buf[0]):
+            return self.get(wants)
+        res = buffer(self.buf[0], self.pos, wants)
+        self.pos += wants
+        while self.buf and self.pos >= len(self.buf[0]):
+            x = self.buf.popleft()
+            self.buf_len -= len(x)
+            self.pos -= len(x)
+        return res
 
 def _DataChunker(receiver):
     wants = receiver.next()
@@ -37,7 +56,7 @@ def _DataChunker(receiver):
     
     while True:
         if len(buf) >= wants:
-            wants = receiver.send(buf.get(wants))
+            wants = receiver.send(buf.get_buffer(wants) if isinstance(wants, Buffered) else buf.get(wants))
         else:
             buf.add((yield))
 def DataChunker(receiver):
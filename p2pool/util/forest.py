@@ -2,6 +2,7 @@
 forest data structure
 '''
 
+import array
 import itertools
 
 from p2pool.util import skiplist, variable
@@ -47,6 +48,43 @@ class DistanceSkipList(TrackerSkipList):
         assert dist == n
         return hash
 
+class AncestorTable(object):
+    '''
+    get_nth_parent_hash using jump pointers: jumps[item_hash][k] is the hash of
+    the item's 2**k-th parent. an item's pointers are filled in from its
+    parent's when it's added and extended on demand when its parent came later
+    '''
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.jumps = {} # item_hash -> [parent hash, grandparent hash, 4th parent hash, ...]
+        
+        self.tracker.added.watch_weakref(self, lambda self, item: self._handle_added(item))
+        self.tracker.removed.watch_weakref(self, lambda self, item: self.jumps.pop(self.tracker._delta_type.get_head(item), None))
+    
+    def _handle_added(self, item):
+        jumps = self.jumps[self.tracker._delta_type.get_head(item)] = [self.tracker._delta_type.get_tail(item)]
+        while jumps[-1] in self.jumps and len(self.jumps[jumps[-1]]) >= len(jumps):
+            jumps.append(self.jumps[jumps[-1]][len(jumps) - 1])
+    
+    def _get_jump(self, item_hash, k):
+        if item_hash not in self.jumps:
+            self._handle_added(self.tracker.items[item_hash])
+        jumps = self.jumps[item_hash]
+        while len(jumps) <= k:
+            jumps.append(self._get_jump(jumps[-1], len(jumps) - 1))
+        return jumps[k]
+    
+    def __call__(self, item_hash, n):
+        assert n >= 0
+        k = 0
+        while n:
+            if n & 1:
+                item_hash = self._get_jump(item_hash, k)
+            n >>= 1
+            k += 1
+        return item_hash
+
 def get_attributedelta_type(attrs): # attrs: {name: func}
     class ProtoAttributeDelta(object):
         __slots__ = ['head', 'tail'] + attrs.keys()
@@ -93,6 +131,197 @@ AttributeDelta = get_attributedelta_type(dict(
     height=lambda item: 1,
 ))
 
+class IdTable(object):
+    '''
+    interns the hashes of a compact tracker's items, and of the parents they
+    point to, to small integer ids. items and parent and child links are kept
+    in id-indexed columns. an id is freed once its hash is neither an item nor
+    the parent of one, and is reused for the next new hash
+    '''
+    
+    def __init__(self):
+        self.ids = {} # hash -> id
+        self.hashes = [] # id -> hash
+        self.items = [] # id -> item, None for a parent that isn't in the tracker
+        self.parents = array.array('l') # id -> parent id, -1 if not an item
+        self.first_children = array.array('l') # id -> one of its children's ids, -1 if none
+        self.next_siblings = array.array('l') # id -> the next child id of its parent, -1 if none
+        self.free_ids = []
+        self.item_count = 0
+    
+    def intern(self, item_hash):
+        id = self.ids.get(item_hash)
+        if id is not None:
+            return id
+        if self.free_ids:
+            id = self.free_ids.pop()
+            self.hashes[id] = item_hash
+        else:
+            id = len(self.hashes)
+            self.hashes.append(item_hash)
+            self.items.append(None)
+            self.parents.append(-1)
+            self.first_children.append(-1)
+            self.next_siblings.append(-1)
+        self.ids[item_hash] = id
+        return id
+    
+    def add(self, item_hash, parent_hash, item):
+        id, parent = self.intern(item_hash), self.intern(parent_hash)
+        self.items[id] = item
+        self.parents[id] = parent
+        self.next_siblings[id] = self.first_children[parent]
+        self.first_children[parent] = id
+        self.item_count += 1
+    
+    def remove(self, item_hash):
+        '''Unlinks an item, returning its id and its parent's id. both stay interned until collect is called on them'''
+        
+        id = self.ids[item_hash]
+        parent = self.parents[id]
+        if self.first_children[parent] == id:
+            self.first_children[parent] = self.next_siblings[id]
+        else:
+            sibling = self.first_children[parent]
+            while self.next_siblings[sibling] != id:
+                sibling = self.next_siblings[sibling]
+            self.next_siblings[sibling] = self.next_siblings[id]
+        self.items[id] = None
+        self.parents[id] = self.next_siblings[id] = -1
+        self.item_count -= 1
+        return id, parent
+    
+    def collect(self, id):
+        if self.items[id] is None and self.first_children[id] == -1:
+            del self.ids[self.hashes[id]]
+            self.hashes[id] = None
+            self.free_ids.append(id)
+    
+    def get_children(self, id):
+        children = []
+        child = self.first_children[id]
+        while child != -1:
+            children.append(child)
+            child = self.next_siblings[child]
+        return children
+
+class IdTableItems(object):
+    '''read-only item_hash -> item mapping over an IdTable, standing in for Tracker.items'''
+    
+    def __init__(self, table):
+        self._table = table
+    
+    def __len__(self):
+        return self._table.item_count
+    
+    def __contains__(self, item_hash):
+        id = self._table.ids.get(item_hash)
+        return id is not None and self._table.items[id] is not None
+    
+    def __getitem__(self, item_hash):
+        item = self._table.items[self._table.ids[item_hash]]
+        if item is None:
+            raise KeyError(item_hash)
+        return item
+    
+    def get(self, item_hash, default=None):
+        return self[item_hash] if item_hash in self else default
+    
+    def iteritems(self):
+        return ((item_hash, item) for item_hash, item in itertools.izip(self._table.hashes, self._table.items) if item is not None)
+    
+    def iterkeys(self):
+        return (item_hash for item_hash, item in self.iteritems())
+    __iter__ = iterkeys
+    
+    def itervalues(self):
+        return (item for item in self._table.items if item is not None)
+    
+    def keys(self):
+        return list(self.iterkeys())
+    
+    def values(self):
+        return list(self.itervalues())
+    
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+    
+    def __ne__(self, other):
+        return not self == other
+
+class IdTableChildren(object):
+    '''read-only parent hash -> set of item hashes mapping over an IdTable, standing in for Tracker.reverse'''
+    
+    def __init__(self, table):
+        self._table = table
+    
+    def __contains__(self, item_hash):
+        id = self._table.ids.get(item_hash)
+        return id is not None and self._table.first_children[id] != -1
+    
+    def __getitem__(self, item_hash):
+        children = self._table.get_children(self._table.ids[item_hash])
+        if not children:
+            raise KeyError(item_hash)
+        return set(self._table.hashes[child] for child in children)
+    
+    def get(self, item_hash, default=None):
+        return self[item_hash] if item_hash in self else default
+    
+    def iterkeys(self):
+        return (item_hash for item_hash, first_child in itertools.izip(self._table.hashes, self._table.first_children) if first_child != -1)
+    __iter__ = iterkeys
+    
+    def iteritems(self):
+        return ((item_hash, self[item_hash]) for item_hash in self.iterkeys())
+    
+    def __len__(self):
+        return sum(1 for item_hash in self.iterkeys())
+    
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+    
+    def __ne__(self, other):
+        return not self == other
+
+class WideColumn(object):
+    '''
+    column of ints in [0, 2**128), like heights and work sums, kept in two
+    arrays of 64 bit halves. it becomes a list if a value doesn't fit
+    '''
+    
+    def __init__(self):
+        self._low = array.array('L')
+        self._high = array.array('L')
+        self._list = None
+    
+    def __len__(self):
+        return len(self._list) if self._list is not None else len(self._low)
+    
+    def extend(self, count):
+        if self._list is not None:
+            self._list.extend([0]*count)
+        else:
+            self._low.extend([0]*count)
+            self._high.extend([0]*count)
+    
+    def __getitem__(self, i):
+        if self._list is not None:
+            return self._list[i]
+        high = self._high[i]
+        return self._low[i] | high << 64 if high else self._low[i]
+    
+    def __setitem__(self, i, value):
+        if self._list is None:
+            try:
+                self._low[i] = value & 0xffffffffffffffff
+                self._high[i] = value >> 64
+                return
+            except OverflowError:
+                self._list = [self[j] for j in xrange(len(self._low))]
+                self._low = self._high = None
+        self._list[i] = value
+
 class TrackerView(object):
     def __init__(self, tracker, delta_type):
         self._tracker = tracker
@@ -221,10 +450,126 @@ class TrackerView(object):
         assert self._tracker.is_child_of(ancestor, item)
         return self.get_delta_to_last(item) - self.get_delta_to_last(ancestor)
 
+class CompactTrackerView(TrackerView):
+    '''
+    TrackerView over a compact tracker's ids. instead of a delta object per
+    item, each id's cached delta is kept in columns: the ref it's relative to
+    and its attributes. a ref stands for a last id and an offset that is added
+    to the cached attributes of every id using it, so when a tail is removed
+    only the ref changes. refs that would have to be split are dropped instead,
+    and ids that used them walk to their last again the next time
+    '''
+    
+    def __init__(self, tracker, delta_type):
+        self._tracker = tracker
+        self._table = tracker.ids
+        self._delta_type = delta_type
+        self._attrs = sorted(delta_type.attrs)
+        self._funcs = [delta_type.attrs[attr] for attr in self._attrs]
+        
+        self._delta_refs = array.array('l') # id -> ref of its cached delta, -1 if none
+        self._columns = [WideColumn() for attr in self._attrs] # id -> cached delta attribute, less its ref's offset
+        
+        self._ref_generator = itertools.count()
+        self._refs = {} # ref -> [last id, offset of each attribute, number of ids using it]
+        self._last_refs = {} # last id -> ref
+        
+        self._tracker.remove_special.watch_weakref(self, lambda self, item: self._handle_remove_special(item))
+        self._tracker.remove_special2.watch_weakref(self, lambda self, item: self._handle_remove_special2(item))
+        self._tracker.removed.watch_weakref(self, lambda self, item: self._handle_removed(item))
+    
+    def _drop_ref(self, ref):
+        last, offset, count = self._refs.pop(ref)
+        del self._last_refs[last]
+    
+    def _release_ref(self, ref):
+        if ref not in self._refs:
+            return
+        self._refs[ref][2] -= 1
+        if not self._refs[ref][2]:
+            self._drop_ref(ref)
+    
+    def _handle_remove_special(self, item):
+        id = self._table.ids[self._delta_type.get_head(item)]
+        
+        # ids that were cached before this item was added have it as their last, and will once it's removed, but the
+        # parent's ref is moved to it below
+        if id in self._last_refs:
+            self._drop_ref(self._last_refs[id])
+        
+        parent = self._table.parents[id]
+        if parent not in self._last_refs:
+            return
+        
+        # the parent only has this child, so every id using its ref is a descendant of this
+        ref = self._last_refs.pop(parent)
+        self._refs[ref][0] = id
+        self._refs[ref][1] = [value - func(item) for value, func in zip(self._refs[ref][1], self._funcs)]
+        self._last_refs[id] = ref
+    
+    def _handle_remove_special2(self, item):
+        parent = self._table.parents[self._table.ids[self._delta_type.get_head(item)]]
+        if parent in self._last_refs:
+            self._drop_ref(self._last_refs[parent])
+    
+    def _handle_removed(self, item):
+        id = self._table.ids[self._delta_type.get_head(item)]
+        if id < len(self._delta_refs) and self._delta_refs[id] != -1:
+            self._release_ref(self._delta_refs[id])
+            self._delta_refs[id] = -1
+    
+    def _set_delta(self, id, values, last):
+        if last not in self._last_refs:
+            ref = self._last_refs[last] = self._ref_generator.next()
+            self._refs[ref] = [last, [0]*len(self._attrs), 0]
+        ref = self._last_refs[last]
+        
+        if id >= len(self._delta_refs):
+            count = len(self._table.hashes) - len(self._delta_refs)
+            self._delta_refs.extend([-1]*count)
+            for column in self._columns:
+                column.extend(count)
+        if self._delta_refs[id] != ref:
+            self._release_ref(self._delta_refs[id])
+            self._refs[ref][2] += 1
+            self._delta_refs[id] = ref
+        for column, value, offset in zip(self._columns, values, self._refs[ref][1]):
+            column[id] = value - offset
+    
+    def get_delta_to_last(self, item_hash):
+        assert isinstance(item_hash, (int, long, type(None)))
+        id = self._table.ids.get(item_hash)
+        if id is None or self._table.items[id] is None:
+            return self._delta_type.get_none(item_hash)
+        
+        values = [0]*len(self._attrs)
+        updates = []
+        item = self._table.items[id]
+        while item is not None:
+            updates.append((id, values))
+            ref = self._delta_refs[id] if id < len(self._delta_refs) else -1
+            if ref in self._refs:
+                last, offset, count = self._refs[ref]
+                values = [value + column[id] + ref_value for value, column, ref_value in zip(values, self._columns, offset)]
+                id = last
+            else:
+                values = [value + func(item) for value, func in zip(values, self._funcs)]
+                id = self._table.parents[id]
+            item = self._table.items[id]
+        for update_id, values_then in updates:
+            self._set_delta(update_id, [value - value_then for value, value_then in zip(values, values_then)], id)
+        return self._delta_type(item_hash, self._table.hashes[id], **dict(zip(self._attrs, values)))
+
 class Tracker(object):
-    def __init__(self, items=[], delta_type=AttributeDelta):
-        self.items = {} # hash -> item
-        self.reverse = {} # delta.tail -> set of item_hashes
+    def __init__(self, items=[], delta_type=AttributeDelta, compact=False):
+        if compact:
+            self.ids = IdTable()
+            self.items = IdTableItems(self.ids) # hash -> item
+            self.reverse = IdTableChildren(self.ids) # delta.tail -> set of item_hashes
+        else:
+            self.ids = None
+            self.items = {} # hash -> item
+            self.reverse = {} # delta.tail -> set of item_hashes
         
         self.heads = {} # head hash -> tail_hash
         self.tails = {} # tail hash -> set of head hashes
@@ -234,10 +579,10 @@ class Tracker(object):
         self.remove_special2 = variable.Event()
         self.removed = variable.Event()
         
-        self.get_nth_parent_hash = DistanceSkipList(self)
+        self.get_nth_parent_hash = AncestorTable(self)
         
         self._delta_type = delta_type
-        self._default_view = TrackerView(self, delta_type)
+        self._default_view = (CompactTrackerView if compact else TrackerView)(self, delta_type)
         
         for item in items:
             self.add(item)
@@ -264,8 +609,11 @@ class Tracker(object):
         else:
             tail = self.get_last(delta.tail)
         
-        self.items[delta.head] = item
-        self.reverse.setdefault(delta.tail, set()).add(delta.head)
+        if self.ids is not None:
+            self.ids.add(delta.head, delta.tail, item)
+        else:
+            self.items[delta.head] = item
+            self.reverse.setdefault(delta.tail, set()).add(delta.head)
         
         self.tails.setdefault(tail, set()).update(heads)
         if delta.tail in self.tails[tail]:
@@ -322,12 +670,19 @@ class Tracker(object):
         else:
             raise NotImplementedError()
         
-        self.items.pop(delta.head)
-        self.reverse[delta.tail].remove(delta.head)
-        if not self.reverse[delta.tail]:
-            self.reverse.pop(delta.tail)
+        if self.ids is not None:
+            id, parent = self.ids.remove(delta.head)
+        else:
+            self.items.pop(delta.head)
+            self.reverse[delta.tail].remove(delta.head)
+            if not self.reverse[delta.tail]:
+                self.reverse.pop(delta.tail)
         
         self.removed.happened(item)
+        
+        if self.ids is not None: # once watchers are done with the ids
+            self.ids.collect(id)
+            self.ids.collect(parent)
     
     def get_chain(self, start_hash, length):
         assert length <= self.get_height(start_hash)
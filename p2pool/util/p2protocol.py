@@ -4,6 +4,8 @@ Generic message-based protocol used by Bitcoin and P2Pool for P2P communication
 
 import hashlib
 import struct
+import time
+import zlib
 
 from twisted.internet import protocol
 from twisted.python import log
@@ -21,6 +23,9 @@ class Protocol(protocol.Protocol):
         self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
         self.traffic_happened = traffic_happened
         self.ignore_trailing_payload = ignore_trailing_payload
+        
+        self.accept_compressed = False # set once we've told the peer that we understand "compressed" messages
+        self.compress_threshold = None # payloads at least this long are sent compressed, None to never compress
     
     def dataReceived(self, data):
         self.traffic_happened.happened('p2p/in', len(data))
@@ -38,15 +43,23 @@ class Protocol(protocol.Protocol):
                 print 'length too large'
                 continue
             checksum = yield 4
-            payload = yield length
+            payload = yield datachunker.Buffered(length) # decoded in place; message types only copy the strings they keep
             
             if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
                 print 'invalid hash for', self.transport.getPeer().host, repr(command), length, checksum.encode('hex')
                 if p2pool.DEBUG:
-                    print hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4].encode('hex'), payload.encode('hex')
+                    print hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4].encode('hex'), str(payload).encode('hex')
                 self.badPeerHappened()
                 continue
             
+            if command == 'compressed' and self.accept_compressed:
+                try:
+                    command, payload = self._decompress(payload)
+                except (ValueError, zlib.error), e:
+                    print 'invalid compressed message from', self.transport.getPeer().host, e
+                    self.badPeerHappened()
+                    continue
+            
             type_ = getattr(self, 'message_' + command, None)
             if type_ is None:
                 if p2pool.DEBUG:
@@ -60,6 +73,16 @@ class Protocol(protocol.Protocol):
                 log.err(None, 'Error handling message: (see RECV line)')
                 self.disconnect()
     
+    def _decompress(self, payload):
+        start = time.time()
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(buffer(payload, 12), self._max_payload_length + 1)
+        if len(data) > self._max_payload_length:
+            raise ValueError('decompressed payload too long')
+        self.traffic_happened.happened('p2p/decompress_time', time.time() - start)
+        self.traffic_happened.happened('p2p/in_saved', len(data) - len(payload))
+        return str(payload[:12]).rstrip('\0'), data
+    
     def packetReceived(self, command, payload2):
         handler = getattr(self, 'handle_' + command, None)
         if handler is None:
@@ -91,6 +114,13 @@ class Protocol(protocol.Protocol):
         payload = type_.pack(payload2)
         if len(payload) > self._max_payload_length:
             raise TooLong('payload too long')
+        if self.compress_threshold is not None and len(payload) >= self.compress_threshold:
+            start = time.time()
+            compressed = zlib.compress(payload)
+            self.traffic_happened.happened('p2p/compress_time', time.time() - start)
+            if 12 + len(compressed) < len(payload):
+                self.traffic_happened.happened('p2p/out_saved', len(payload) - 12 - len(compressed))
+                command, payload = 'compressed', struct.pack('<12s', command) + compressed
         data = self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
         self.traffic_happened.happened('p2p/out', len(data))
         self.transport.write(data)
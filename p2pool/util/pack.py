@@ -10,10 +10,14 @@ class EarlyEnd(Exception):
 class LateEnd(Exception):
     pass
 
+# data can be a str, buffer or memoryview. only the bytes of returned strings are copied out of it
+
 def read((data, pos), length):
     data2 = data[pos:pos + length]
     if len(data2) != length:
         raise EarlyEnd()
+    if type(data2) is memoryview:
+        data2 = data2.tobytes()
     return data2, (data, pos + length)
 
 def size((data, pos)):
@@ -64,6 +68,10 @@ class Type(object):
         
         if p2pool.DEBUG:
             packed = self._pack(obj)
+            if not isinstance(data, str):
+                data = data[:len(packed) if ignore_trailing else len(data)]
+                if type(data) is memoryview:
+                    data = data.tobytes()
             good = data.startswith(packed) if ignore_trailing else data == packed
             if not good:
                 raise AssertionError()
@@ -74,6 +82,22 @@ class Type(object):
         # No check since obj can have more keys than our type
         return self._pack(obj)
     
+    def get_fixed_codec(self):
+        # for types that always pack to the same number of bytes, returns (byte order or None, struct format,
+        # function converting the unpacked struct value to an item or None, function converting an item to a struct value or None)
+        return None
+    
+    def read_many(self, file, count):
+        res = [None]*count
+        for i in xrange(count):
+            res[i], file = self.read(file)
+        return res, file
+    
+    def write_many(self, file, items):
+        for item in items:
+            file = self.write(file, item)
+        return file
+    
     def packed_size(self, obj):
         if hasattr(obj, '_packed_size') and obj._packed_size is not None:
             type_obj, packed_size = obj._packed_size
@@ -118,6 +142,23 @@ class VarIntType(Type):
             return file, struct.pack('<BQ', 0xff, item)
         else:
             raise ValueError('int too large for varint')
+    
+    def read_many(self, file, count):
+        data, pos = file
+        res = [None]*count
+        for i in xrange(count):
+            if pos >= len(data):
+                raise EarlyEnd()
+            first = ord(data[pos])
+            if first < 0xfd:
+                res[i] = first
+                pos += 1
+            else:
+                res[i], (data, pos) = self.read((data, pos))
+        return res, (data, pos)
+    
+    def write_many(self, file, items):
+        return file, ''.join(chr(item) if 0 <= item < 0xfd else self.write(None, item)[1] for item in items)
 
 class VarStrType(Type):
     _inner_size = VarIntType()
@@ -150,6 +191,9 @@ class EnumType(Type):
         if item not in self.unpack_to_pack:
             raise ValueError('enum item (%r) not in unpack_to_pack (%r)' % (item, self.unpack_to_pack))
         return self.inner.write(file, self.unpack_to_pack[item])
+    
+    def get_fixed_codec(self):
+        return _wrap_codec(self.inner.get_fixed_codec(), self.pack_to_unpack, self.unpack_to_pack, 'enum')
 
 stale_pack_to_unpack = dict((k, {0: None, 253: 'orphan', 254: 'doa'}.get(
     k, 'unk%i' % (k,))) for k in xrange(256))
@@ -171,6 +215,26 @@ class StaleInfoEnumType(Type):
         if item not in stale_unpack_to_pack:
             raise ValueError('enum item (%r) not in stale_unpack_to_pack (%r)' % (item, stale_unpack_to_pack))
         return self.inner.write(file, stale_unpack_to_pack[item])
+    
+    def get_fixed_codec(self):
+        return _wrap_codec(self.inner.get_fixed_codec(), stale_pack_to_unpack, stale_unpack_to_pack, 'stale_info')
+
+def _wrap_codec(codec, pack_to_unpack, unpack_to_pack, name):
+    if codec is None:
+        return None
+    order, fmt, decode, encode = codec
+    def decode2(value):
+        if decode is not None:
+            value = decode(value)
+        if value not in pack_to_unpack:
+            raise ValueError('%s data (%r) not in pack_to_unpack' % (name, value))
+        return pack_to_unpack[value]
+    def encode2(item):
+        if item not in unpack_to_pack:
+            raise ValueError('%s item (%r) not in unpack_to_pack' % (name, item))
+        item = unpack_to_pack[item]
+        return encode(item) if encode is not None else item
+    return order, fmt, decode2, encode2
 
 class ListType(Type):
     _inner_size = VarIntType()
@@ -178,21 +242,45 @@ class ListType(Type):
     def __init__(self, type, mul=1):
         self.type = type
         self.mul = mul
+        self._codec = type.get_fixed_codec() # fixed-width items are handled with one struct call for the whole list
+        if self._codec is not None:
+            self._item_size = struct.calcsize((self._codec[0] or '<') + self._codec[1])
+            if not self._item_size:
+                self._codec = None
+    
+    def __eq__(self, other):
+        return type(other) is type(self) and (other.type, other.mul) == (self.type, self.mul)
+    
+    def __hash__(self):
+        return hash((type(self), self.type, self.mul))
+    
+    def _get_struct(self, order, fmt, length):
+        # a count prefix only repeats single-character formats
+        return struct.Struct('%s%d%s' % (order or '<', length, fmt) if len(fmt) == 1 else (order or '<') + fmt*length)
     
     def read(self, file):
         length, file = self._inner_size.read(file)
         length *= self.mul
-        res = [None]*length
-        for i in xrange(length):
-            res[i], file = self.type.read(file)
-        return res, file
+        if self._codec is not None:
+            order, fmt, decode, encode = self._codec
+            data, pos = file
+            # checked before building the struct, whose format grows with the peer supplied length
+            if len(data) - pos < length*self._item_size:
+                raise EarlyEnd()
+            s = self._get_struct(order, fmt, length)
+            res = list(s.unpack_from(data, pos))
+            if decode is not None:
+                res = map(decode, res)
+            return res, (data, pos + s.size)
+        return self.type.read_many(file, length)
     
     def write(self, file, item):
         assert len(item) % self.mul == 0
         file = self._inner_size.write(file, len(item)//self.mul)
-        for subitem in item:
-            file = self.type.write(file, subitem)
-        return file
+        if self._codec is not None:
+            order, fmt, decode, encode = self._codec
+            return file, self._get_struct(order, fmt, len(item)).pack(*(item if encode is None else map(encode, item)))
+        return self.type.write_many(file, item)
 
 class StructType(Type):
     __slots__ = 'desc length'.split(' ')
@@ -201,12 +289,21 @@ class StructType(Type):
         self.desc = desc
         self.length = struct.calcsize(self.desc)
     
+    def __eq__(self, other):
+        return type(other) is type(self) and other.desc == self.desc
+    
+    def __hash__(self):
+        return hash((type(self), self.desc))
+    
     def read(self, file):
         data, file = read(file, self.length)
         return struct.unpack(self.desc, data)[0], file
     
     def write(self, file, item):
         return file, struct.pack(self.desc, item)
+    
+    def get_fixed_codec(self):
+        return self.desc[0], self.desc[1:], None, None
 
 @memoize.fast_memoize_multiple_args
 class IntType(Type):
@@ -228,6 +325,12 @@ class IntType(Type):
         self.format_str = '%%0%ix' % (2*self.bytes)
         self.max = 2**bits
     
+    def __eq__(self, other):
+        return type(other) is type(self) and (other.bytes, other.step) == (self.bytes, self.step)
+    
+    def __hash__(self):
+        return hash((type(self), self.bytes, self.step))
+    
     def read(self, file, b2a_hex=binascii.b2a_hex):
         if self.bytes == 0:
             return 0, file
@@ -240,6 +343,11 @@ class IntType(Type):
         if not 0 <= item < self.max:
             raise ValueError('invalid int value - %r' % (item,))
         return file, a2b_hex(self.format_str % (item,))[::self.step]
+    
+    def get_fixed_codec(self, b2a_hex=binascii.b2a_hex):
+        if self.bytes == 0:
+            return None, '0s', lambda data: 0, lambda item: ''
+        return None, '%is' % (self.bytes,), lambda data: int(b2a_hex(data[::self.step]), 16), lambda item: self.write(None, item)[1]
 
 class IPV6AddressType(Type):
     def read(self, file):
@@ -299,22 +407,72 @@ def get_record(fields):
         _record_types[fields] = _Record
     return _record_types[fields]
 
+def compile_fields(fields):
+    '''
+    returns a plan of (key, type, None) steps for fields that are read and
+    written by their own type and (keys, struct.Struct, codecs) steps for runs
+    of fixed-width fields that are handled with a single struct call
+    '''
+    plan = []
+    run = []
+    def end_run():
+        if len(run) == 1:
+            (key, type_, codec), = run
+            plan.append((key, type_, None))
+        elif run:
+            order = ([order for key, type_, (order, fmt, decode, encode) in run if order is not None] or ['<'])[0]
+            plan.append((
+                tuple(key for key, type_, codec in run),
+                struct.Struct(order + ''.join(fmt for key, type_, (order, fmt, decode, encode) in run)),
+                [(decode, encode) for key, type_, (order, fmt, decode, encode) in run],
+            ))
+        del run[:]
+    for key, type_ in fields:
+        codec = type_.get_fixed_codec()
+        if codec is None:
+            end_run()
+            plan.append((key, type_, None))
+            continue
+        if codec[0] is not None and any(order is not None and order != codec[0] for key2, type2, (order, fmt, decode, encode) in run):
+            end_run()
+        run.append((key, type_, codec))
+    end_run()
+    return plan
+
 class ComposedType(Type):
     def __init__(self, fields):
         self.fields = list(fields)
         self.field_names = set(k for k, v in fields)
         self.record_type = get_record(k for k, v in self.fields)
+        self._plan = compile_fields(self.fields)
+    
+    def __eq__(self, other):
+        return type(other) is type(self) and other.fields == self.fields
+    
+    def __hash__(self):
+        return hash((type(self), tuple(self.fields)))
     
     def read(self, file):
         item = self.record_type()
-        for key, type_ in self.fields:
-            item[key], file = type_.read(file)
+        for key, type_, codecs in self._plan:
+            if codecs is None:
+                item[key], file = type_.read(file)
+                continue
+            data, pos = file
+            if len(data) - pos < type_.size:
+                raise EarlyEnd()
+            for key2, (decode, encode), value in zip(key, codecs, type_.unpack_from(data, pos)):
+                item[key2] = value if decode is None else decode(value)
+            file = data, pos + type_.size
         return item, file
     
     def write(self, file, item):
         assert set(item.keys()) >= self.field_names
-        for key, type_ in self.fields:
-            file = type_.write(file, item[key])
+        for key, type_, codecs in self._plan:
+            if codecs is None:
+                file = type_.write(file, item[key])
+            else:
+                file = file, type_.pack(*[item[key2] if encode is None else encode(item[key2]) for key2, (decode, encode) in zip(key, codecs)])
         return file
 
 class PossiblyNoneType(Type):
@@ -330,6 +488,23 @@ class PossiblyNoneType(Type):
         if item == self.none_value:
             raise ValueError('none_value used')
         return self.inner.write(file, self.none_value if item is None else item)
+    
+    def get_fixed_codec(self):
+        codec = self.inner.get_fixed_codec()
+        if codec is None:
+            return None
+        order, fmt, decode, encode = codec
+        def decode2(value):
+            if decode is not None:
+                value = decode(value)
+            return None if value == self.none_value else value
+        def encode2(item):
+            if item == self.none_value:
+                raise ValueError('none_value used')
+            if item is None:
+                item = self.none_value
+            return item if encode is None else encode(item)
+        return order, fmt, decode2, encode2
 
 class FixedStrType(Type):
     def __init__(self, length):
@@ -342,3 +517,10 @@ class FixedStrType(Type):
         if len(item) != self.length:
             raise ValueError('incorrect length item!')
         return file, item
+    
+    def get_fixed_codec(self):
+        def encode(item):
+            if len(item) != self.length:
+                raise ValueError('incorrect length item!')
+            return item
+        return None, '%is' % (self.length,), None, encode
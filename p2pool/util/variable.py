@@ -83,3 +83,31 @@ class Variable(object):
     
     def get_not_none(self):
         return self.get_when_satisfies(lambda val: val is not None)
+
+class VariableDict(Variable):
+    '''A Variable holding a dict that is changed in place. Instead of transitioned, watchers get added/removed with a
+    dict of just the items that changed, so a change costs its size rather than the size of the whole dict.'''
+    
+    def __init__(self, value):
+        Variable.__init__(self, value)
+        self.added = Event()
+        self.removed = Event()
+    
+    def add(self, items):
+        new_items = dict((key, value) for key, value in items.iteritems() if key not in self.value)
+        if not new_items:
+            return
+        self.value.update(new_items)
+        self.added.happened(new_items)
+        self.changed.happened(self.value)
+    
+    def remove(self, keys):
+        old_items = dict((key, self.value.pop(key)) for key in keys if key in self.value)
+        if not old_items:
+            return
+        self.removed.happened(old_items)
+        self.changed.happened(self.value)
+    
+    def set(self, value):
+        self.remove([key for key in self.value if key not in value])
+        self.add(value)
@@ -45,7 +45,7 @@ def _atomic_write(filename, data):
         os.remove(filename)
         os.rename(filename + '.new', filename)
 
-def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Event(), static_dir=None):
+def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Event(), static_dir=None, stratum_broadcaster=None, stratum_workers=None):
     node = wb.node
     start_time = time.time()
     
@@ -211,6 +211,11 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     web_root.putChild('global_stats', WebInterface(get_global_stats))
     web_root.putChild('local_stats', WebInterface(get_local_stats))
     web_root.putChild('peer_addresses', WebInterface(lambda: ' '.join('%s%s' % (peer.transport.getPeer().host, ':'+str(peer.transport.getPeer().port) if peer.transport.getPeer().port != node.net.P2P_PORT else '') for peer in node.p2p_node.peers.itervalues())))
+    web_root.putChild('tx_store', WebInterface(lambda: node.tx_store.get_stats()))
+    if stratum_broadcaster is not None:
+        web_root.putChild('stratum_broadcast', WebInterface(lambda: stratum_broadcaster.get_stats()))
+    if stratum_workers is not None:
+        web_root.putChild('stratum_workers', WebInterface(lambda: stratum_workers.get_stats()))
     web_root.putChild('peer_txpool_sizes', WebInterface(lambda: dict(('%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port), peer.remembered_txs_size) for peer in node.p2p_node.peers.itervalues())))
     web_root.putChild('pings', WebInterface(defer.inlineCallbacks(lambda: defer.returnValue(
         dict([(a, (yield b)) for a, b in
@@ -392,6 +397,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         'desired_version_rates': graph.DataStreamDescription(dataview_descriptions, multivalues=True,
             multivalue_undefined_means_0=True),
         'traffic_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False, multivalues=True),
+        'compression_time': graph.DataStreamDescription(dataview_descriptions, is_gauge=False, multivalues=True),
         'getwork_latency': graph.DataStreamDescription(dataview_descriptions),
         'memory_usage': graph.DataStreamDescription(dataview_descriptions),
     }, hd_obj)
@@ -427,7 +433,10 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         reactor.callLater(200, later)
     @node.p2p_node.traffic_happened.watch
     def _(name, bytes):
-        hd.datastreams['traffic_rate'].add_datum(time.time(), {name: bytes})
+        if name.endswith('_time'): # seconds spent (de)compressing, not bytes
+            hd.datastreams['compression_time'].add_datum(time.time(), {name: bytes})
+        else:
+            hd.datastreams['traffic_rate'].add_datum(time.time(), {name: bytes})
     def add_point():
         if node.tracker.get_height(node.best_share_var.value) < 10:
             return None
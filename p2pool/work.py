@@ -58,7 +58,12 @@ class WorkerBridge(worker_interface.WorkerBridge):
 
         self.address_throttle = 0
         
-        self.tracker_view = forest.TrackerView(self.node.tracker, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+        # reused between work requests, so unchanged templates don't rehash their transactions' merkle trees
+        self.merkle_trees = dict(hash=bitcoin_data.MerkleTree(), txid=bitcoin_data.MerkleTree(), wtxid=bitcoin_data.MerkleTree())
+        # ((best share, bitcoind work, merged work), {(share type, payout address, stale info, mm data): (finish function, tx_map)})
+        self.template_cache = None, {}
+        
+        self.tracker_view = (forest.TrackerView if self.node.tracker.ids is None else forest.CompactTrackerView)(self.node.tracker, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             my_count=lambda share: 1 if share.hash in self.my_share_hashes else 0,
             my_doa_count=lambda share: 1 if share.hash in self.my_doa_share_hashes else 0,
             my_orphan_announce_count=lambda share: 1 if share.hash in self.my_share_hashes and share.share_data['stale_info'] == 'orphan' else 0,
@@ -129,11 +134,14 @@ class WorkerBridge(worker_interface.WorkerBridge):
         compute_work()
         
         self.new_work_event = variable.Event()
+        self.refresh_work_event = variable.Event() # new transactions on the same block, work from before is still good
         @self.current_work.transitioned.watch
         def _(before, after):
             # trigger LP if version/previous_block/bits changed or transactions changed from nothing
             if any(before[x] != after[x] for x in ['version', 'previous_block', 'bits']) or (not before['transactions'] and after['transactions']):
                 self.new_work_event.happened()
+            elif before.get('transaction_hashes') != after.get('transaction_hashes') or before['subsidy'] != after['subsidy']:
+                self.refresh_work_event.happened()
         self.merged_work.changed.watch(lambda _: self.new_work_event.happened())
         self.node.best_share_var.changed.watch(lambda _: self.new_work_event.happened())
     
@@ -285,9 +293,6 @@ class WorkerBridge(worker_interface.WorkerBridge):
             mm_data = ''
             mm_later = []
         
-        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in self.current_work.value['transactions']]
-        tx_map = dict(zip(tx_hashes, self.current_work.value['transactions']))
-        
         previous_share = self.node.tracker.items[self.node.best_share_var.value] if self.node.best_share_var.value is not None else None
         if previous_share is None:
             share_type = p2pool_data.Share
@@ -328,8 +333,22 @@ class WorkerBridge(worker_interface.WorkerBridge):
                         bitcoin_data.average_attempts_to_target((bitcoin_data.target_to_average_attempts(self.node.bitcoind_work.value['bits'].target)*self.node.net.SPREAD)*self.node.net.PARENT.DUST_THRESHOLD/block_subsidy)
                     )
         
-        if True:
-            share_info, gentx, other_transaction_hashes, get_share = share_type.generate_transaction(
+        stale_info = (lambda (orphans, doas), total, (orphans_recorded_in_chain, doas_recorded_in_chain):
+            'orphan' if orphans > orphans_recorded_in_chain else
+            'doa' if doas > doas_recorded_in_chain else
+            None
+        )(*self.get_stale_counts())
+        
+        # everything but the nonce, timestamp and share target is shared by all miners paying to the same script
+        template_base = self.node.best_share_var.value, self.current_work.value, self.merged_work.value
+        if self.template_cache[0] != template_base:
+            self.template_cache = template_base, {}
+        template_key = share_type, pubkey_hash, pubkey_hash_version, stale_info, mm_data
+        if template_key not in self.template_cache[1]:
+            tx_hashes = [bitcoin_data.get_tx_hash(tx) for tx in self.current_work.value['transactions']]
+            tx_map = dict(zip(tx_hashes, self.current_work.value['transactions']))
+            
+            self.template_cache[1][template_key] = share_type.generate_transaction_template(
                 tracker=self.node.tracker,
                 share_data=dict(
                     previous_share_hash=self.node.best_share_var.value,
@@ -337,27 +356,24 @@ class WorkerBridge(worker_interface.WorkerBridge):
                         self.current_work.value['height'],
                         ] + ([mm_data] if mm_data else []) + [
                     ]) + self.current_work.value['coinbaseflags'])[:100],
-                    nonce=random.randrange(2**32),
+                    nonce=None,
                     pubkey_hash=pubkey_hash,
                     pubkey_hash_version=pubkey_hash_version,
                     subsidy=self.current_work.value['subsidy'],
                     donation=math.perfect_round(65535*self.donation_percentage/100),
-                    stale_info=(lambda (orphans, doas), total, (orphans_recorded_in_chain, doas_recorded_in_chain):
-                        'orphan' if orphans > orphans_recorded_in_chain else
-                        'doa' if doas > doas_recorded_in_chain else
-                        None
-                    )(*self.get_stale_counts()),
+                    stale_info=stale_info,
                     desired_version=(share_type.SUCCESSOR if share_type.SUCCESSOR is not None else share_type).VOTING_VERSION,
                 ),
                 block_target=self.current_work.value['bits'].target,
-                desired_timestamp=int(time.time() + 0.5),
-                desired_target=desired_share_target,
                 ref_merkle_link=dict(branch=[], index=0),
                 desired_other_transaction_hashes_and_fees=zip(tx_hashes, self.current_work.value['transaction_fees']),
                 net=self.node.net,
                 known_txs=tx_map,
                 base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
-            )
+                merkle_trees=self.merkle_trees,
+            ), tx_map
+        finish_transaction, tx_map = self.template_cache[1][template_key]
+        share_info, gentx, other_transaction_hashes, get_share = finish_transaction(random.randrange(2**32), int(time.time() + 0.5), desired_share_target)
         
         packed_gentx = bitcoin_data.tx_id_type.pack(gentx) # stratum miners work with stripped transactions
         other_transactions = [tx_map[tx_hash] for tx_hash in other_transaction_hashes]
@@ -406,7 +422,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         getwork_time = time.time()
         lp_count = self.new_work_event.times
-        merkle_link = bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0) if share_info.get('segwit_data', None) is None else share_info['segwit_data']['txid_merkle_link']
+        merkle_link = self.merkle_trees['hash'].update([None] + other_transaction_hashes).get_link(0) if share_info.get('segwit_data', None) is None else share_info['segwit_data']['txid_merkle_link']
         
         if print_throttle is 0.0:
             print_throttle = time.time()
@@ -433,6 +449,9 @@ class WorkerBridge(worker_interface.WorkerBridge):
             timestamp=self.current_work.value['time'],
             bits=self.current_work.value['bits'],
             share_target=target,
+            share_info_target=share_info['bits'].target,
+            # submits with a higher hash than this are only pseudoshares, which don't need anything but accounting
+            candidate_target=2**256-1 if p2pool.DEBUG else max([share_info['bits'].target, self.current_work.value['bits'].target] + [aux_work['target'] for aux_work, index, hashes in mm_later]),
         )
         
         received_header_hashes = set()
@@ -525,18 +544,37 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 print '    Hash:   %56x' % (pow_hash,)
                 print '    Target: %56x' % (target,)
                 self.invalid_hashes += 1
+                return False
             elif header_hash in received_header_hashes:
                 print >>sys.stderr, 'Worker %s submitted share more than once!' % (user,)
+                return False
             else:
                 received_header_hashes.add(header_hash)
-                
-                self.pseudoshare_received.happened(bitcoin_data.target_to_average_attempts(target), not on_time, user)
-                self.recent_shares_ts_work.append((time.time(), bitcoin_data.target_to_average_attempts(target)))
-                while len(self.recent_shares_ts_work) > 50:
-                    self.recent_shares_ts_work.pop(0)
-                self.local_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), dead=not on_time, user=user, share_target=share_info['bits'].target))
-                self.local_addr_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), pubkey_hash=pubkey_hash))
+                self._got_pseudoshares(user, pubkey_hash, ba, on_time)
             
             return on_time
         
         return ba, got_response
+    
+    def _got_pseudoshares(self, user, pubkey_hash, x, on_time, count=1):
+        work = bitcoin_data.target_to_average_attempts(x['share_target'])
+        for i in xrange(count):
+            self.pseudoshare_received.happened(work, not on_time, user)
+            self.recent_shares_ts_work.append((time.time(), work))
+            self.local_rate_monitor.add_datum(dict(work=work, dead=not on_time, user=user, share_target=x['share_info_target']))
+            self.local_addr_rate_monitor.add_datum(dict(work=work, pubkey_hash=pubkey_hash))
+        while len(self.recent_shares_ts_work) > 50:
+            self.recent_shares_ts_work.pop(0)
+    
+    def got_checked_submits(self, user, pubkey_hash, x, on_time, count, invalid=0, duplicates=0):
+        '''Accounts for submits to work x that were checked somewhere else (by a stratum worker process) and found to
+        be neither shares nor blocks: count pseudoshares, invalid ones with hash > target and duplicates'''
+        
+        user, _, _, _, _ = self.get_user_details(user)
+        self.total_hashes += count + invalid + duplicates
+        if invalid:
+            print 'Worker %s submitted %i shares with hash > target' % (user, invalid)
+            self.invalid_hashes += invalid
+        if duplicates:
+            print >>sys.stderr, 'Worker %s submitted %i shares more than once!' % (user, duplicates)
+        self._got_pseudoshares(user, pubkey_hash, x, on_time, count)